@@ -21,12 +21,17 @@
 
 targetdir=/usr/local/bin/
 
+# the scripts run with python3 (see their first line)
+command -v python3 > /dev/null || { echo "python3 not found, please install it (aptitude install python3 python3-pigpio)"; exit 1; }
+
 mkdir -p $targetdir 
 
 exe1=scd30-service.py
+lib1=scd30
 serv1=scd30.service
 
 rsync -raxc --info=name $exe1 $targetdir
+rsync -raxc --info=name --exclude=__pycache__ $lib1 $targetdir
 
 rsync -raxc --info=name $serv1 /etc/systemd/system/
 
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+from __future__ import print_function
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+from scd30 import bench
+
+parser = ArgumentParser(description='benchmark the scd30 scripts against an emulated SCD30.\n\nDefaults in {curly braces}', formatter_class=RawTextHelpFormatter)
+parser.add_argument("-v", "--verbose", dest="verbose", action='store_true',
+    help="show the output of the benchmarked code")
+subparsers = parser.add_subparsers(dest="benchmark")
+subparsers.required = True
+
+service = subparsers.add_parser("service", help="samples/s, i2c transactions, cpu time and time to first sample of scd30-service.py")
+service.add_argument("-n", "--samples", dest="samples", type=int, default=100,
+    help="number of samples {100}", metavar="n")
+service.add_argument("-i", "--interval", dest="interval", type=int, default=2,
+    help="sensor measurement interval in s {2}", metavar="s")
+service.add_argument("--stretch", dest="stretch", type=float, default=0.0,
+    help="clock stretching per read in s {0}", metavar="s")
+service.add_argument("--nack-rate", dest="nack_rate", type=float, default=0.0,
+    help="probability of a NACK per transaction {0}", metavar="p")
+service.add_argument("--crc-error-rate", dest="crc_error_rate", type=float, default=0.0,
+    help="probability of a bit error per word read {0}", metavar="p")
+service.add_argument("--rdy", dest="rdy", action='store_true',
+    help="wait for the RDY pin edge instead of polling data ready")
+service.add_argument("--call-latency", dest="call_latency", type=float, default=0.0,
+    help="round trip time of a transport call in s, e.g. 0.0005 for pigpiod {0}", metavar="s")
+service.add_argument("--realtime", dest="realtime", action='store_true',
+    help="really sleep instead of using a virtual clock")
+service.add_argument("--no-phase-lock", dest="phase_lock", action='store_false',
+    help="sleep MEAS_INTERVAL - 0.1 s after every sample instead of tracking the sensor's phase")
+service.add_argument("--drift", dest="drift", type=float, default=0.0,
+    help="error of the sensor clock, e.g. 0.02 for 2 %% slow {0}", metavar="f")
+service.add_argument("--io-jitter", dest="io_jitter", type=float, default=0.0,
+    help="up to this many s of other I/O per loop {0}", metavar="s")
+
+transport = subparsers.add_parser("transport", help="latency per i2c transaction of transports")
+transport.add_argument("-t", "--transport", dest="transports", action='append',
+    choices=('pigpio', 'i2cdev', 'i2cdev-emulated', 'emulator'),
+    help="transport to measure, repeat to compare {pigpio, i2cdev}")
+transport.add_argument("-n", "--transactions", dest="transactions", type=int, default=1000,
+    help="number of transactions {1000}", metavar="n")
+transport.add_argument("--host", dest="host", default='127.0.0.1',
+    help="pigpio host {127.0.0.1}")
+transport.add_argument("--bus", dest="bus", type=int, default=1,
+    help="i2c bus {1}")
+
+codec = subparsers.add_parser("codec", help="frame crc/decode/encode against the former crcmod based code")
+codec.add_argument("-n", "--number", dest="number", type=int, default=100000,
+    help="calls per case {100000}", metavar="n")
+
+history = subparsers.add_parser("history", help="range queries on a full in-memory history")
+history.add_argument("-c", "--capacity", dest="capacity", type=int, default=43200,
+    help="samples in the buffer {43200}", metavar="n")
+
+storage = subparsers.add_parser("storage", help="bytes written per sample and read throughput of the persistent history")
+storage.add_argument("-n", "--samples", dest="samples", type=int, default=43200,
+    help="number of samples {43200 = 1 day at 2 s}", metavar="n")
+storage.add_argument("-f", "--flush", dest="flush", type=float, default=900,
+    help="seconds between segment writes {900}", metavar="s")
+
+mqtt = subparsers.add_parser("mqtt", help="MQTT batching throughput and memory through a simulated broker outage")
+mqtt.add_argument("-n", "--samples", dest="samples", type=int, default=20000,
+    help="number of samples {20000}", metavar="n")
+mqtt.add_argument("-b", "--batch", dest="batch", type=int, default=30,
+    help="samples per message {30}", metavar="n")
+mqtt.add_argument("--outage", dest="outage", type=float, default=0.5,
+    help="fraction of the samples during which the broker is offline {0.5}", metavar="f")
+mqtt.add_argument("--binary", dest="payload", action='store_const', const='binary', default='json',
+    help="binary instead of json payloads")
+
+multi = subparsers.add_parser("multi", help="memory and cpu per sensor of one process running many emulated sensors")
+multi.add_argument("-c", "--count", dest="counts", type=int, action='append',
+    help="number of sensors, repeatable {1, 8, 32, 64}", metavar="n")
+multi.add_argument("-s", "--seconds", dest="seconds", type=int, default=600,
+    help="sensor time to run {600}", metavar="s")
+
+aio = subparsers.add_parser("aio", help="asyncio pigpiod client against a fake pigpiod: latency, pipelining, sensors as coroutines")
+aio.add_argument("-l", "--latency", dest="latency", type=float, default=0.001,
+    help="round trip time to the fake pigpiod in s {0.001}", metavar="s")
+aio.add_argument("-n", "--transactions", dest="transactions", type=int, default=500,
+    help="transfers per case {500}", metavar="n")
+aio.add_argument("-s", "--sensors", dest="sensors", type=int, default=32,
+    help="emulated sensors read as coroutines {32}, 0: skip", metavar="n")
+
+schedule = subparsers.add_parser("schedule", help="data ready polls and timing jitter per sample, fixed sleep against phase lock")
+schedule.add_argument("-n", "--samples", dest="samples", type=int, default=1000,
+    help="number of samples per case {1000}", metavar="n")
+schedule.add_argument("--io-jitter", dest="io_jitter", type=float, default=0.05,
+    help="up to this many s of other I/O per loop {0.05}", metavar="s")
+
+pressure = subparsers.add_parser("pressure", help="cost of reading the pressure for compensation per sample, former code against scd30.pressure")
+pressure.add_argument("-n", "--calls", dest="calls", type=int, default=10000,
+    help="get_pressure calls {10000}", metavar="n")
+
+hysteresis = subparsers.add_parser("hysteresis", help="measurement restarts for pressure compensation, former code against the PRESSURE_* filter")
+hysteresis.add_argument("-n", "--samples", dest="samples", type=int, default=3600,
+    help="samples {3600}", metavar="n")
+hysteresis.add_argument("--noise", dest="noise", type=float, default=0.3,
+    help="noise of the pressure readings in hPa {0.3}", metavar="hPa")
+hysteresis.add_argument("--trend", dest="trend", type=float, default=1.0,
+    help="pressure change in hPa/h {1}", metavar="hPa")
+hysteresis.add_argument("--restart-delay", dest="restart_delay", type=float, default=None,
+    help="s from a measurement (re)start to the first sample {interval}", metavar="s")
+
+recovery = subparsers.add_parser("recovery", help="faults injected into the emulator, in-process recovery against exit and restart")
+recovery.add_argument("-n", "--samples", dest="samples", type=int, default=1000,
+    help="samples {1000}", metavar="n")
+recovery.add_argument("-e", "--every", dest="every", type=int, default=50,
+    help="samples between faults {50}", metavar="n")
+recovery.add_argument("-f", "--fault", dest="faults", action='append', choices=bench.FAULTS,
+    help="kind of fault, repeat for several {all}")
+recovery.add_argument("--restart-time", dest="restart_time", type=float, default=2.0,
+    help="s a restart by systemd takes until configure() {2}", metavar="s")
+recovery.add_argument("--rdy", dest="rdy", action='store_true',
+    help="wait for the RDY pin edge instead of polling data ready")
+
+crc = subparsers.add_parser("crc", help="samples lost to crc errors, former wait against immediate re-reads")
+crc.add_argument("-n", "--samples", dest="samples", type=int, default=1000,
+    help="samples {1000}", metavar="n")
+
+startup = subparsers.add_parser("startup", help="time to the first sample on cold start and restarts, with the cached configuration")
+
+trace = subparsers.add_parser("trace", help="size and cost of recording an i2c trace, and its replay through the service")
+trace.add_argument("-n", "--samples", dest="samples", type=int, default=2000,
+    help="samples {2000}", metavar="n")
+
+shm = subparsers.add_parser("shm", help="latest sample for local readers: prometheus file against the shared sample file")
+shm.add_argument("-n", "--calls", dest="calls", type=int, default=20000,
+    help="reads per case {20000}", metavar="n")
+
+control = subparsers.add_parser("control", help="calibration, ASC and interval requests to the running service on its control socket")
+control.add_argument("-n", "--samples", dest="samples", type=int, default=1000,
+    help="samples {1000}", metavar="n")
+
+warmup = subparsers.add_parser("warmup", help="time to a forced recalibration and the error it leaves, fixed warm-up against convergence")
+
+fleet = subparsers.add_parser("fleet", help="recalibrate many emulated sensors at once against one after another")
+fleet.add_argument("-c", "--count", dest="counts", type=int, action='append',
+    help="number of sensors, repeat for several runs (default: 1, 8, 32)", metavar="n")
+
+metrics = subparsers.add_parser("metrics", help="cpu time per sample and page size of the service's self-metrics")
+metrics.add_argument("-n", "--samples", dest="samples", type=int, default=2000,
+    help="samples {2000}", metavar="n")
+
+args = parser.parse_args()
+
+if args.benchmark == 'service':
+  bench.report("scd30-service.py against emulator", bench.bench_service(
+    args.samples, args.interval, args.stretch, args.nack_rate, args.crc_error_rate,
+    args.realtime, args.rdy, args.call_latency, verbose=args.verbose,
+    phase_lock=args.phase_lock, drift=args.drift, io_jitter=args.io_jitter))
+elif args.benchmark == 'transport':
+  for kind in args.transports or ['pigpio', 'i2cdev']:
+    bench.report(kind + " transport", bench.bench_transport(kind, args.transactions, args.host, args.bus))
+elif args.benchmark == 'codec':
+  bench.report("scd30.codec", bench.bench_codec(args.number))
+elif args.benchmark == 'history':
+  bench.report("scd30.history", bench.bench_history(args.capacity))
+elif args.benchmark == 'storage':
+  bench.report("scd30.storage", bench.bench_storage(args.samples, flush_interval=args.flush))
+elif args.benchmark == 'mqtt':
+  bench.report("scd30.mqtt", bench.bench_mqtt(args.samples, args.batch, args.outage, args.payload))
+elif args.benchmark == 'multi':
+  bench.report("scd30.multi", bench.bench_multi(args.counts or (1, 8, 32, 64), args.seconds))
+elif args.benchmark == 'aio':
+  bench.report("scd30.aiopigpio", bench.bench_aio(args.latency, args.transactions, sensors=args.sensors))
+elif args.benchmark == 'schedule':
+  bench.report("sampling schedule of scd30-service.py", bench.bench_schedule(args.samples, io_jitter=args.io_jitter))
+elif args.benchmark == 'pressure':
+  bench.report("pressure compensation input", bench.bench_pressure(args.calls))
+elif args.benchmark == 'hysteresis':
+  bench.report("pressure compensation restarts", bench.bench_hysteresis(args.samples, args.noise, args.trend, args.restart_delay))
+
+elif args.benchmark == 'recovery':
+  bench.report("fault recovery", bench.bench_recovery(args.samples, args.every, tuple(args.faults or bench.FAULTS), args.restart_time,
+                                                    rdy=args.rdy))
+
+elif args.benchmark == 'crc':
+  bench.report("crc errors", bench.bench_crc(args.samples))
+
+elif args.benchmark == 'startup':
+  bench.report("service startup", bench.bench_startup())
+
+elif args.benchmark == 'trace':
+  bench.report("i2c trace", bench.bench_trace(args.samples))
+
+elif args.benchmark == 'shm':
+  bench.report("latest sample", bench.bench_shm(args.calls))
+
+elif args.benchmark == 'control':
+  bench.report("control socket", bench.bench_control(args.samples))
+
+elif args.benchmark == 'warmup':
+  bench.report("frc warm-up", bench.bench_warmup())
+
+elif args.benchmark == 'fleet':
+  bench.report("scd30.fleet", bench.bench_fleet(args.counts or (1, 8, 32)))
+
+elif args.benchmark == 'metrics':
+  bench.report("self-metrics", bench.bench_metrics(args.samples))
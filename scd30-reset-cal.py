@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # coding=utf-8
 #
 # Copyright © 2018 UnravelTEC
@@ -19,25 +19,37 @@
 #
 # If you want to relicense this code under another license, please contact info+github@unraveltec.com.
 
-# hints from https://www.raspberrypi.org/forums/viewtopic.php?p=600515#p600515
+# forced recalibration (FRC) of the SCD30 of the running scd30-service.py,
+# through its control socket (see scd30/control.py): sampling goes on, and
+# the service stays the only user of the bus. The service recalibrates once
+# the readings are stable (see scd30/warmup.py), until then this asks again.
+#
+# With -s, the sensors given are recalibrated all at once directly on their
+# buses instead (see scd30/fleet.py), e.g. a room of sensors next to a
+# reference; no scd30-service.py may use them meanwhile.
 
 from __future__ import print_function
 
-# This module uses the services of the C pigpio library. pigpio must be running on the Pi(s) whose GPIO are to be manipulated. 
-# cmd ref: http://abyz.me.uk/rpi/pigpio/python.html#i2c_write_byte_data
-import pigpio # aptitude install python-pigpio
-import time
-import struct
 import sys
-import crcmod # aptitude install python-crcmod
-import os, signal
-from subprocess import call
+import time
+
+from scd30.control import command
 
 from argparse import ArgumentParser, RawTextHelpFormatter
 
-parser = ArgumentParser(description='scrape files in /run/sensors in prometheus format and send as json mqtt messages.\n\nDefaults in {curly braces}',formatter_class=RawTextHelpFormatter)
+CONTROL_SOCKET = '/run/sensors/scd30/control.sock'
+SENSOR_FOLDER = '/run/sensors/'
+PRESSURE_SENSORS = ['bme280', 'bme680'] # as in scd30-service.py, for -s without -p
+
+parser = ArgumentParser(description='recalibrate the SCD30 of the running scd30-service.py to a known CO2 concentration, e.g. fresh outside air.\n\nDefaults in {curly braces}',formatter_class=RawTextHelpFormatter)
 parser.add_argument("-c", "--value", dest="calvalue", type=int, default=415,
-    help="calibrate to value in ppm (default: 415", metavar="nnn")
+    help="calibrate to value in ppm {415}", metavar="nnn")
+parser.add_argument("-t", "--timeout", dest="timeout", type=int, default=900,
+    help="give up if the readings are not stable within s {900}", metavar="s")
+parser.add_argument("-s", "--sensor", dest="sensors", action='append', default=[],
+    help="recalibrate this sensor directly instead of the one of scd30-service.py,\nrepeat for each: NAME[:TRANSPORT[:HOST[:BUS[:SLAVE]]]]\n(see scd30/multi.py), all are done at once", metavar="spec")
+parser.add_argument("-p", "--pressure", dest="pressure", type=int,
+    help="with -s: ambient pressure in mbar to compensate for, 700-1400\n{pressure_hPa of " + SENSOR_FOLDER + "<" + "|".join(PRESSURE_SENSORS) + ">/last, else 972}", metavar="mbar")
 parser.add_argument("-D", "--debug", dest="debug", action='store_true',
                                     help="print debug messages")
 
@@ -46,289 +58,67 @@ args = parser.parse_args()
 def eprint(*args, **kwargs):
   print(*args, file=sys.stderr, **kwargs)
 
-SENSOR_FOLDER = '/run/sensors/'
-SENSOR_NAME = 'scd30'
-LOGFILE = SENSOR_FOLDER + SENSOR_NAME + '/last'
-PRESSURE_SENSORS = ['bme280', 'bme680']
-MEAS_INTERVAL = 2 # integer between 1 and 255 (if longer needed, change code below)
-
-PIGPIO_HOST = '127.0.0.1'
-I2C_SLAVE = 0x61
-I2C_BUS = 1
-
 DEBUG = args.debug
 
-def exit_gracefully(a,b):
-  print("exit")
-  stop_measurement()
-  os.path.isfile(LOGFILE) and os.access(LOGFILE, os.W_OK) and os.remove(LOGFILE)
-  pi.i2c_close(h)
-  exit(0)
-
-signal.signal(signal.SIGINT, exit_gracefully)
-signal.signal(signal.SIGTERM, exit_gracefully)
-
-
-deviceOnI2C = call("i2cdetect -y 1 0x61 0x61|grep '\--' -q", shell=True) # grep exits 0 if match found
-if deviceOnI2C:
-  print("I2Cdetect found " + SENSOR_NAME)
-else:
-  print(SENSOR_NAME + " (0x61) not found on I2C bus")
-  exit(1)
-
-pi = pigpio.pi(PIGPIO_HOST)
-if not pi.connected:
-  print("no connection to pigpio daemon at " + PIGPIO_HOST + ".")
-  exit(1)
-
-try:
-  pi.i2c_close(0)
-except:
-  if sys.exc_value and str(sys.exc_value) != "'unknown handle'":
-    eprint("Unknown error: ", sys.exc_type, ":", sys.exc_value)
-
-try:
-  h = pi.i2c_open(I2C_BUS, I2C_SLAVE)
-except:
-  eprint("i2c open failed")
-  exit(1)
+def residuals(answer):
+  return "co2 sd {co2_sd:.1f} ppm, slope {co2_slope:.2f} ppm/min, temperature slope {temperature_slope:.3f} degC/min over {samples} samples".format(**answer)
 
-print("connected to pigpio daemon at " + PIGPIO_HOST + ".")
-
-call(["mkdir", "-p", SENSOR_FOLDER + SENSOR_NAME])
-
-f_crc8 = crcmod.mkCrcFun(0x131, 0xFF, False, 0x00)
-def calcCRC(TwoBdataArray):
-  byteData = ''.join(chr(x) for x in TwoBdataArray)
-  return f_crc8(byteData)
-
-def read_n_bytes(n):
+def current_pressure():
+  # -> (mbar, where it is from), as scd30-service.py would start with
+  if args.pressure:
+    if not 700 <= args.pressure <= 1400:
+      eprint("the pressure has to be 700-1400 mbar")
+      exit(1)
+    return (args.pressure, "-p")
+  from scd30.pressure import FileSource
+  for name in PRESSURE_SENSORS:
+    source = FileSource(SENSOR_FOLDER + name + '/last')
+    source.load()
+    if source.value is not None:
+      return (int(round(source.value)), source.path)
+  return (972, "default, 300 m above sea level")
+
+def calibrate_fleet(specs):
+  from scd30.fleet import FleetCalibration, CALIBRATED, report
+  from scd30.multi import open_sensors, parse_sensor
+  (pressure, source) = current_pressure()
   try:
-    (count, data) = pi.i2c_read_device(h, n)
-  except:
-    eprint("error: i2c_read failed")
+    (sensors, connections) = open_sensors([parse_sensor(spec) for spec in specs], None, 2, 0)
+  except (IOError, ValueError) as e:
+    eprint(str(e))
     exit(1)
-
-  if count == n:
-    DEBUG and print("read_n_bytes(" + str(n) + ") successful")
-    return data
-  else:
-    eprint("error: read bytes didnt return " + str(n) + " B, but " + str(count) + " B")
-    return False
-
-# takes an array of bytes (integer-array)
-def i2cWrite(data):
+  fleet = FleetCalibration(sensors, args.calvalue, args.timeout, connections=connections, pressure=pressure,
+                           log=lambda *a: print(*a) if DEBUG else None)
+  print("recalibrating " + str(len(sensors)) + " sensors to " + str(args.calvalue) + " ppm at " + str(pressure) + " mbar (" + source + ") once their readings are stable")
   try:
-    pi.i2c_write_device(h, data)
-  except:
-    eprint("error: i2c_write failed")
-    return -1
-  return True
-
-def read_firmware_version():
-  i2cWrite([0xD1,0x00])
-  firmware_version = read_n_bytes(3)
-  print("firmware version: " + hex(firmware_version[0]) + hex(firmware_version[1]))
-
-def read_meas_interval():
-  ret = i2cWrite([0x46, 0x00])
-  if ret == -1:
-    return -1
-
+    calibrations = fleet.run()
+  finally:
+    fleet.close()
+  for line in report(calibrations):
+    print(line)
+  exit(0 if all(c.status == CALIBRATED for c in calibrations) else 1)
+
+if args.sensors:
+  calibrate_fleet(args.sensors)
+
+start = time.time()
+while True:
   try:
-    (count, data) = pi.i2c_read_device(h, 3)
-  except:
-    eprint("error: i2c_read failed")
+    answer = command(CONTROL_SOCKET, 'frc ' + str(args.calvalue))
+  except (IOError, OSError) as e:
+    eprint("scd30-service.py not reachable on " + CONTROL_SOCKET + ": " + str(e))
     exit(1)
-
-  if count == 3:
-    if len(data) == 3:
-      interval = int(data[0])*256 + int(data[1])
-      #print "measurement interval: " + str(interval) + "s, checksum " + str(data[2])
-      return interval
-    else:
-      eprint("error: no array len 3 returned, instead " + str(len(data)) + "type: " + str(type(data)))
-  else:
-    eprint("error: read measurement interval didnt return 3B")
-  
-  return -1
-
-def read_asc_status():
-  ret = i2cWrite([0x53,0x06])
-  if ret == -1:
-    return -1
-
-  data = read_n_bytes(3)
-  if data == False:
-    print("read asc unsuccessful")
-    return -1
-
-  print("answer: " + hex(data[0]) + " " + hex(data[1]) + " " + hex(data[2]) + ".")
-
-  if data[1] == 1:
-    print("asc enabled")
-    return 1
-
-  if data[1] == 0:
-    print("asc disabled")
-    return 0
-
-  print("asc status unknown")
-  return -1
-
-
-def stop_measurement():
-  ret = i2cWrite([0x01, 0x04])
-  if ret == -1:
-    eprint("error: sending stop measurement command unsuccessful")
-
-def reset():
-  print("reset")
-  ret = i2cWrite([0xD3,0x04])
-  if ret == -1:
-    print("reset unsuccessful")
-
-read_firmware_version()
-
-read_meas_result = read_meas_interval()
-if read_meas_result == -1:
-  eprint("read_meas_interval unsuccessful")
-  exit(1)
-
-print("current measurement interval: " + str(read_meas_result))
-if read_meas_result != MEAS_INTERVAL:
-# if not every 1s, set it
-  print("setting interval to " + str(MEAS_INTERVAL))
-  ret = i2cWrite([0x46, 0x00, 0x00, MEAS_INTERVAL, calcCRC([0x00, MEAS_INTERVAL])])
-  if ret == -1:
-    exit(1)
-  read_meas_result = read_meas_interval()
-  if read_meas_result != MEAS_INTERVAL:
-    eprint("setting measurement interval unsuccessful, returned " + str(read_meas_result))
-    exit(1)
-
-
-asc_status = read_asc_status()
-print("asc status: " + str(asc_status))
-if asc_status == 0:
-  #activating ASC
-  print("enabling asc...")
-  i2cWrite([0x53, 0x06, 0x00, 0x01, calcCRC([0x00,0x01])])
-  time.sleep(MEAS_INTERVAL+1)
-  asc_status = read_asc_status()
-  print("asc status: " + str(asc_status))
-
-
-def calcFloat(sixBArray):
-  struct_float = struct.pack('>BBBB', sixBArray[0], sixBArray[1], sixBArray[3], sixBArray[4])
-  float_values = struct.unpack('>f', struct_float)
-  first = float_values[0]
-  return first
-
-def get_pressure(last_pressure):
-  for sensor in PRESSURE_SENSORS:
-    pressure_mbar = last_pressure
-    pressure_filename = SENSOR_FOLDER + sensor + '/last'
-    current_pressure = 0
-    if os.path.isfile(pressure_filename):
-      pressure_file = open(pressure_filename,'r')
-      for line in pressure_file:
-        if line.startswith('pressure_hPa'):
-          line_array = line.split()
-          if len(line_array) > 1 and (isinstance(line_array[1],float)):
-            current_pressure = int(float(line_array[1]))
-            if current_pressure > 300:
-              break
-      if current_pressure > 300:
-        if last_pressure != current_pressure:
-          print('pressure compensation changed from', last_pressure, 'to', current_pressure)
-          pressure_mbar = current_pressure
-        break
-  return pressure_mbar
-
-def start_cont_measurement(pressure_mbar):
-  LSB = 0xFF & pressure_mbar
-  MSB = 0xFF & (pressure_mbar >> 8)
-  i2cWrite([0x00, 0x10, MSB, LSB, calcCRC([MSB,LSB])])
-
-def set_forced_cal():
-  ppm = args.calvalue
-  LSB = 0xFF & ppm
-  MSB = 0xFF & (ppm >> 8)
-  i2cWrite([0x52, 0x04, MSB, LSB, calcCRC([MSB,LSB])])
-  if ret == -1:
-    print("setting cal to "+str(ppm)+" unsuccessful")
-    exit(1)
-  print("setting cal to "+str(ppm)+" successful")
-
-
-pressure_mbar = 972 # 300 metres above sea level
-start_cont_measurement(pressure_mbar)
-last_pressure = pressure_mbar
-
-print("waiting two minutes to stabilize before FRC")
-for frc_warmup_count in range(60):
-  new_pressure = get_pressure(last_pressure)
-  if new_pressure != last_pressure:
-    # print("pressure for compensation: " + str(pressure_mbar))
-    start_cont_measurement(new_pressure)
-    last_pressure = new_pressure
-
-  # read ready status
-  deadmancounter = 20 * MEAS_INTERVAL
-  while True:
-    if deadmancounter == 0:
-      print("20 attempts to get data unsuccessful, exiting")
-      exit(1)
-    ret = i2cWrite([0x02, 0x02])
-    if ret == -1:
-      exit(1)
-
-    data = read_n_bytes(3)
-    if data == False:
-      print("read data ready unsuccessful")
-      time.sleep(0.1)
-      deadmancounter -= 1
-      continue
-
-    if data[1] == 1:
-      #print "data ready"
-      break
-    else:
-      #eprint(".")
-      time.sleep(0.1)
-      deadmancounter -= 1
-
-  #read measurement
-  i2cWrite([0x03, 0x00])
-  data = read_n_bytes(18)
-    
-  #print "CO2: "  + str(data[0]) +" "+ str(data[1]) +" "+ str(data[3]) +" "+ str(data[4])
-
-  if data == False:
-    print("read data unsuccessful")
-    time.sleep(MEAS_INTERVAL)
+  DEBUG and print(answer)
+  waited = time.time() - start
+  if 'retry' in answer and waited + answer['retry'] < args.timeout:
+    if 'co2_sd' in answer and int(waited) // 30 != int(waited + answer['retry']) // 30:
+      print("waiting for stable readings, " + residuals(answer))
+    time.sleep(answer['retry'])
     continue
-  #  exit(1)
+  break
 
-  float_co2 = calcFloat(data[0:5])
-  float_T = calcFloat(data[6:11])
-  float_rH = calcFloat(data[12:17])
-
-  if float_co2 <= 0.0 or float_rH <= 0.0:
-    print("read wrong, co2: " + str(float_co2) + ", rH: " + str(float_rH))
-    continue
-
-  output_string =  'gas_ppm{{sensor="SCD30",gas="CO2"}} {0:.8f}\n'.format( float_co2 )
-  output_string += 'temperature_degC{{sensor="SCD30"}} {0:.8f}\n'.format( float_T )
-  output_string += 'humidity_rel_percent{{sensor="SCD30"}} {0:.8f}\n'.format( float_rH )
-
-  logfilehandle = open(LOGFILE, "w",1)
-  logfilehandle.write(output_string)
-  logfilehandle.close()
-
-  time.sleep(-0.1 + MEAS_INTERVAL)
-
-set_forced_cal()
-
-pi.i2c_close(h)
+if 'error' in answer:
+  eprint("setting cal to " + str(args.calvalue) + " unsuccessful after {0:.0f} s: ".format(waited) + answer['error'] +
+         (" (" + residuals(answer) + ")" if 'co2_sd' in answer else ""))
+  exit(1)
+print("setting cal to " + str(answer['frc']) + " successful after {0:.0f} s of warm-up, ".format(waited) + residuals(answer))
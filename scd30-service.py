@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # coding=utf-8
 #
 # Copyright © 2018 UnravelTEC
@@ -23,16 +23,29 @@
 
 from __future__ import print_function
 
-# This module uses the services of the C pigpio library. pigpio must be running on the Pi(s) whose GPIO are to be manipulated. 
-# cmd ref: http://abyz.me.uk/rpi/pigpio/python.html#i2c_write_byte_data
-import pigpio # aptitude install python-pigpio
 import time
-import struct
+START_TIME = time.time() # to log how long it took to the first sample
 import sys
 import math
-import crcmod # aptitude install python-crcmod
-import os, signal
-from subprocess import call
+import json
+import os, signal, socket
+from argparse import ArgumentParser
+
+from scd30 import codec
+from scd30.aggregate import WindowAggregate
+from scd30.control import ControlServer
+from scd30.driver import SCD30, READ_INTERVAL
+from scd30.exporter import write_atomic
+from scd30.history import RingBuffer, HistoryServer
+from scd30.instrument import InstrumentedTransport, Metrics, TIMER
+from scd30.pressure import PressureFilter, PressureInput
+from scd30.recovery import LEVELS, Recovery, SensorFault
+from scd30.schedule import PhaseLock
+from scd30.shm import SamplePublisher
+from scd30.storage import MAX_SAMPLES, SegmentWriter, read as read_storage
+from scd30.trace import CONFIG, PRESSURE, ReplayTransport, TraceRecorder
+from scd30.warmup import Warmup
+from scd30.transport import open_transport, TRANSPORTS
 
 
 def eprint(*args, **kwargs):
@@ -46,23 +59,98 @@ def flprint(*args, **kwargs):
 SENSOR_FOLDER = '/run/sensors/'
 SENSOR_NAME = 'scd30'
 LOGFILE = SENSOR_FOLDER + SENSOR_NAME + '/last'
-PRESSURE_SENSORS = ['bme280', 'bme680']
+CONFIG_CACHE = SENSOR_FOLDER + SENSOR_NAME + '/config.json' # last known sensor configuration, so restarts skip reading it, None: off
+CONTROL_SOCKET = SENSOR_FOLDER + SENSOR_NAME + '/control.sock' # commands for the running service (calibration, ASC, interval), see scd30/control.py, None: off
+FRC_WINDOW = 60 # samples the readings have to be stable over before a forced recalibration, see scd30/warmup.py
+FRC_SHORT_WINDOW = 20 # samples enough instead once the readings have levelled off, e.g. after the start
+FRC_MAX_CO2_SD = 10 # ppm, standard deviation over FRC_WINDOW
+FRC_MAX_CO2_SLOPE = 2 # ppm/min
+FRC_MAX_TEMPERATURE_SLOPE = 0.1 # degC/min
+SAMPLE_FILE = SENSOR_FOLDER + SENSOR_NAME + '/sample' # latest sample in a fixed binary layout for local readers (scd30-once.py -l), see scd30/shm.py, None: off
+PRESSURE_SENSORS = ['bme280', 'bme680'] # their SENSOR_FOLDER/<name>/last files are watched for pressure_hPa
+PRESSURE_SOCKET = None # also take pressure datagrams here, e.g. SENSOR_FOLDER + SENSOR_NAME + '/pressure.sock', see scd30/pressure.py
+PRESSURE_HYSTERESIS = 5 # hPa the compensation has to be off before the measurement is restarted (5 hPa: 0.5 % of the CO2 reading)
+PRESSURE_MIN_RESTART = 600 # s between restarts for a new pressure
+PRESSURE_SMOOTHING = 60 # s time constant of the moving average of the pressure readings, 0: off
 MEAS_INTERVAL = 2 # integer between 1 and 255 (if longer needed, change code below)
-
+AGGREGATE_WINDOW = 60 # s, also export min/max/mean/count of all samples of the last window, 0: off
+HISTORY_SIZE = 43200 # samples kept in memory (24 h at 2 s), 0: off
+HISTORY_SOCKET = SENSOR_FOLDER + SENSOR_NAME + '/history.sock' # query interface, see scd30/history.py
+STORAGE_DIR = '/var/lib/scd30' # compressed history that survives reboots, see scd30/storage.py, None: off
+STORAGE_FLUSH = 900 # s between writes to the SD card, at most 65535 samples (MAX_SAMPLES)
+STORAGE_KEEP_DAYS = 90 # delete files older than that (about 260 kB per day at 2 s), 0: keep all
+HTTP_PORT = None # serve the values on http://HTTP_ADDRESS:HTTP_PORT/metrics too
+HTTP_ADDRESS = ''
+MQTT_HOST = None # publish the samples to this broker too (needs paho-mqtt), see scd30/mqtt.py
+MQTT_PORT = 1883
+MQTT_TOPIC = 'sensors/' + socket.gethostname() + '/' + SENSOR_NAME
+MQTT_BATCH = 30 # samples per message, at most MQTT_BATCH * MEAS_INTERVAL s old
+MQTT_SPOOL = '/var/lib/scd30/mqtt-spool' # samples not yet delivered while the broker is unreachable, None: drop them
+
+TRANSPORT = 'pigpio' # 'i2cdev' for /dev/i2c-N without pigpiod, 'emulator' for a software SCD30
 PIGPIO_HOST = '127.0.0.1'
 I2C_SLAVE = 0x61
 I2C_BUS = 1
+RDY_GPIO = None # BCM number of the GPIO wired to the SCD30 RDY pin, None: poll data ready
+SENSORS = [] # several sensors in one process, NAME[:TRANSPORT[:HOST[:BUS[:SLAVE]]]] each, see scd30/multi.py
+ASYNCIO = False # run the SENSORS as coroutines over asyncio pigpiod connections (pigpio only), see scd30/aiopigpio.py
+PHASE_LOCK = True # poll just after the sensor's next sample instead of sleeping MEAS_INTERVAL - 0.1 s, see scd30/schedule.py
+RECOVERY = True # recover from I2C faults in the service (retry, reopen, soft reset, reconnect), see scd30/recovery.py; False: exit and let systemd restart it
+SELF_METRICS = False # also export I2C call times and errors, polls, restarts and sample age, see scd30/instrument.py
+CRC_RETRIES = 3 # immediate re-reads of a measurement with a crc error, 0: drop it and wait an interval
+TRACE_FILE = None # record every I2C call (and the pressure readings) to this file for --replay, see scd30/trace.py
+
+clock = time # anything with time() and sleep(), e.g. scd30.emulator.VirtualClock
+bus = None
+sensor = None # scd30.driver.SCD30 over bus, see driver()
+exporter = None
+history = None
+history_server = None
+storage = None
+mqtt = None
+sample_file = None # scd30.shm.SamplePublisher with SAMPLE_FILE
+control = None # scd30.control.ControlServer with CONTROL_SOCKET
+measuring_since = None # monotonic time the measurement was last (re)started, None: before this service started
+warmup = Warmup(FRC_WINDOW, FRC_MAX_CO2_SD, FRC_MAX_CO2_SLOPE, FRC_MAX_TEMPERATURE_SLOPE, FRC_SHORT_WINDOW)
+pressure_input = None
+pressure_filter = None
+daemon = None # scd30.multi.MultiSensorDaemon if SENSORS are set
+SERIES = [('gas_ppm', '{sensor="SCD30",gas="CO2"}'), ('temperature_degC', '{sensor="SCD30"}'), ('humidity_rel_percent', '{sensor="SCD30"}')]
+phase = None # scd30.schedule.PhaseLock when polling with PHASE_LOCK
+ready = None # RDY pin of the transport with RDY_GPIO
+recovery = None # scd30.recovery.Recovery with RECOVERY
+crc_stats = codec.CRCStats()
+metrics = None # scd30.instrument.Metrics with SELF_METRICS
+recorder = None # scd30.trace.TraceRecorder with TRACE_FILE
+replay = None # scd30.trace.ReplayTransport with --replay, instead of a sensor
+ready_at = None # monotonic time the sensor had the sample being read ready
+sensor_config = {} # as cached in CONFIG_CACHE: firmware, interval, asc, pressure, measuring
 
 DEBUG = True
 DEBUG = False
 
+def close_outputs():
+  exporter and exporter.close()
+  history_server and history_server.close()
+  control and control.close()
+  storage and storage.close()
+  mqtt and mqtt.close()
+  sample_file and sample_file.close()
+  pressure_input and pressure_input.close()
+
 def exit_gracefully(a,b):
   flprint("exiting gracefully...")
+  if daemon:
+    daemon.close()
+    close_outputs()
+    flprint("measurements stopped, files cleared, exit 0")
+    exit(0)
   stop_measurement()
   flprint("measurement stopped")
-  os.path.isfile(LOGFILE) and os.access(LOGFILE, os.W_OK) and os.remove(LOGFILE)
+  close_outputs()
+  LOGFILE and os.path.isfile(LOGFILE) and os.access(LOGFILE, os.W_OK) and os.remove(LOGFILE)
   flprint("sensor value files cleared")
-  pi.i2c_close(h)
+  bus.close()
   flprint("i2c handle closed, exit 0")
   exit(0)
 
@@ -70,272 +158,668 @@ def exit_hard():
   flprint("exiting hard...")
   reset()
   flprint("resetted")
-  os.path.isfile(LOGFILE) and os.access(LOGFILE, os.W_OK) and os.remove(LOGFILE)
+  close_outputs()
+  LOGFILE and os.path.isfile(LOGFILE) and os.access(LOGFILE, os.W_OK) and os.remove(LOGFILE)
   flprint("sensor value files cleared")
-  pi.i2c_close(h)
+  bus.close()
   flprint("i2c handle closed, exit 1")
   exit(1)
 
-signal.signal(signal.SIGINT, exit_gracefully)
-signal.signal(signal.SIGTERM, exit_gracefully)
-
-
-deviceOnI2C = call("i2cdetect -y 1 0x61 0x61|grep '\--' -q", shell=True) # grep exits 0 if match found
-if deviceOnI2C:
-  flprint("I2Cdetect found " + SENSOR_NAME)
-else:
-  flprint(SENSOR_NAME + " (0x61) not found on I2C bus")
-  exit(1)
-
-pi = pigpio.pi(PIGPIO_HOST)
-if not pi.connected:
-  flprint("no connection to pigpio daemon at " + PIGPIO_HOST + ".")
-  exit(1)
-
-try:
-  pi.i2c_close(0)
-except:
-  if sys.exc_value and str(sys.exc_value) != "'unknown handle'":
-    eprint("Unknown error: ", sys.exc_type, ":", sys.exc_value)
-
-try:
-  h = pi.i2c_open(I2C_BUS, I2C_SLAVE)
-except:
-  eprint("i2c open failed") and sys.stdout.flush()
-  exit(1)
-
-flprint("connected to pigpio daemon at " + PIGPIO_HOST + ".")
-
-f_crc8 = crcmod.mkCrcFun(0x131, 0xFF, False, 0x00)
-def calcCRC(TwoBdataArray):
-  byteData = ''.join(chr(x) for x in TwoBdataArray)
-  return f_crc8(byteData)
-
-def calcFloat(sixBArray):
-  struct_float = struct.pack('>BBBB', sixBArray[0], sixBArray[1], sixBArray[3], sixBArray[4])
-  float_values = struct.unpack('>f', struct_float)
-  first = float_values[0]
-  return first
-
-def read_n_bytes(n):
-  try:
-    (count, data) = pi.i2c_read_device(h, n)
-  except:
-    eprint("error: i2c_read failed")
-    exit(1)
-
-  if count == n:
-    DEBUG and flprint("read_n_bytes(" + str(n) + ") successful")
-    if n % 3 == 0:
-      DEBUG and flprint("multiple of 3 bytes read, calc checksum")
-      for i in range(int(n / 3)):
-        offset = i * 3
-        sent_crc = data[offset + 2]
-        calc_crc = calcCRC([data[offset + 0], data[offset + 1]])
-        if sent_crc == calc_crc:
-          DEBUG and flprint(str(i) + ": crc " + hex(sent_crc) + " of " + hex(data[offset + 0]) + hex(data[offset + 1]) + " OK")
-        else:
-          eprint(str(i) + ": crc " + hex(sent_crc) + " of " + hex(data[offset + 0]) + hex(data[offset + 1]) + " NOK, should be " + hex(calc_crc))
-          return False
-    return data
+# opens the bus and probes the sensor with one transaction (instead of
+# i2cdetect), returns the measurement interval it reads, None if its crc is bad
+def connect():
+  global bus, recorder
+  if replay:
+    bus = replay
   else:
-    eprint("error: read bytes didnt return " + str(n) + " B, but " + str(count) + " B")
-    return False
+    try:
+      # pigpiod hands out handle 0 first, so a crashed service left that one open
+      stale = {'stale_handle': 0} if TRANSPORT == 'pigpio' else {}
+      bus = open_transport(TRANSPORT, PIGPIO_HOST, I2C_BUS, I2C_SLAVE, **stale)
+    except IOError as e:
+      flprint(str(e))
+      exit(1)
+    except:
+      eprint("i2c open failed") and sys.stdout.flush()
+      exit(1)
+  if TRACE_FILE:
+    bus = recorder = TraceRecorder(bus, TRACE_FILE, clock)
+    flprint("recording i2c trace to " + TRACE_FILE)
 
-# takes an array of bytes (integer-array)
-def i2cWrite(data):
   try:
-    pi.i2c_write_device(h, data)
-  except:
-    eprint("error: i2c_write failed")
-    return -1
-  return True
+    (interval_data,) = driver().transfer(READ_INTERVAL)
+  except SensorFault:
+    flprint(SENSOR_NAME + " (" + hex(I2C_SLAVE) + ") not found on I2C bus")
+    bus.close()
+    exit(1)
+  flprint("connected via " + ("replay" if replay else TRANSPORT) + " to " + SENSOR_NAME + ".")
+  return codec.decode_word(interval_data)
+
+def sensor_id():
+  return [TRANSPORT, PIGPIO_HOST, I2C_BUS, I2C_SLAVE]
+
+def load_cached_config():
+  # -> configuration cached by an earlier start with this sensor, {} if none
+  if replay:
+    return json.loads((replay.input(CONFIG) or b'{}').decode('utf-8'))
+  config = {}
+  if CONFIG_CACHE:
+    try:
+      with open(CONFIG_CACHE) as f:
+        config = json.load(f)
+    except (IOError, OSError, ValueError):
+      pass
+  if not isinstance(config, dict) or config.get('sensor') != sensor_id():
+    config = {}
+  recorder and recorder.input(CONFIG, json.dumps(config, sort_keys=True).encode('utf-8'))
+  return config
+
+def cache_config(**changes):
+  sensor_config.update(changes)
+  if CONFIG_CACHE:
+    sensor_config['sensor'] = sensor_id()
+    try:
+      write_atomic(CONFIG_CACHE, json.dumps(sensor_config, sort_keys=True).encode('utf-8'))
+    except (IOError, OSError) as e:
+      DEBUG and flprint("config cache not written: " + str(e))
+
+def driver():
+  # the SCD30 driver over the current bus, which connect() and run() wrap
+  global sensor
+  if sensor is None or sensor.bus is not bus or sensor.clock is not clock:
+    sensor = SCD30(bus, clock, crc_error)
+  return sensor
+
+def crc_error(data, i):
+  # a word with a wrong crc, as found by the driver
+  crc_stats.count(data)
+  offset = i * 3
+  eprint(str(i) + ": crc " + hex(data[offset + 2]) + " of " + hex(data[offset + 0]) + hex(data[offset + 1]) + " NOK, should be " + hex(codec.crc8(data[offset + 0], data[offset + 1])))
 
 def read_firmware_version():
-  ret = i2cWrite([0xD1,0x00])
-  if ret == True:
-    firmware_version = read_n_bytes(3)
-    if firmware_version != False:
-      flprint("firmware version: " + hex(firmware_version[0]) + hex(firmware_version[1]))
-      return True
-  eprint("firmware version could not be read")
-  return False
+  try:
+    (major, minor) = driver().firmware()
+  except SensorFault as e:
+    eprint("firmware version could not be read: " + str(e))
+    return False
+  flprint("firmware version: " + hex(major) + hex(minor))
+  return str(major) + '.' + str(minor)
 
 def read_meas_interval():
-  ret = i2cWrite([0x46, 0x00])
-  if ret == -1:
-    eprint("error: read measurement interval unsuccessful")
+  try:
+    interval = driver().interval()
+  except SensorFault as e:
+    eprint("error: read measurement interval unsuccessful: " + str(e))
     return -1
-
-  ret = read_n_bytes(3)
-  if ret != False:
-    interval = ret[0] * 256 + ret[1]
-    flprint("current measurement interval: " + str(interval))
-    return interval
-  eprint("error: read measurement interval didnt return 3B")
-  return -1
+  flprint("current measurement interval: " + str(interval))
+  return interval
 
 def read_asc_status():
-  ret = i2cWrite([0x53,0x06])
-  if ret == -1:
-    return -1
-
-  data = read_n_bytes(3)
-  if data == False:
-    flprint("read asc unsuccessful")
+  try:
+    asc = driver().asc()
+  except SensorFault as e:
+    flprint("read asc unsuccessful: " + str(e))
     return -1
+  flprint("asc enabled" if asc else "asc disabled")
+  return 1 if asc else 0
 
-  DEBUG and flprint("answer: " + hex(data[0]) + " " + hex(data[1]) + " " + hex(data[2]) + ".")
-
-  if data[1] == 1:
-    flprint("asc enabled")
-    return 1
-
-  if data[1] == 0:
-    flprint("asc disabled")
-    return 0
-
-  flprint("asc status unknown")
-  return -1
+def read_config():
+  # measurement interval and asc status in one transfer
+  try:
+    (interval, asc) = driver().config()
+  except SensorFault as e:
+    eprint("error: config read failed: " + str(e))
+    return (read_meas_interval(), read_asc_status())
+  flprint("current measurement interval: " + str(interval))
+  flprint("asc enabled" if asc else "asc disabled")
+  return (interval, 1 if asc else 0)
 
 def stop_measurement():
-  ret = i2cWrite([0x01, 0x04])
-  if ret == -1:
+  try:
+    driver().stop()
+  except SensorFault:
     eprint("error: sending stop measurement command unsuccessful")
+  cache_config(measuring=False)
 
 def reset():
   flprint("reset")
-  ret = i2cWrite([0xD3,0x04])
-  if ret == -1:
+  cache_config(measuring=False) # unknown afterwards
+  try:
+    driver().reset()
+  except SensorFault:
     flprint("reset unsuccessful")
-    return
-  time.sleep(0.5)
+
+def open_pressure_filter():
+  global pressure_filter
+  if pressure_filter is None:
+    pressure_filter = PressureFilter(PRESSURE_HYSTERESIS, PRESSURE_MIN_RESTART, PRESSURE_SMOOTHING, clock)
+  return pressure_filter
 
 def get_pressure(last_pressure):
-  for sensor in PRESSURE_SENSORS:
-    pressure_mbar = last_pressure
-    pressure_filename = SENSOR_FOLDER + sensor + '/last'
-    current_pressure = 0
-    if os.path.isfile(pressure_filename):
-      pressure_file = open(pressure_filename,'r')
-      DEBUG and flprint("read from " + pressure_filename)
-      for line in pressure_file:
-        if line.startswith('pressure_hPa'):
-          line_array = line.split()
-          # print(line_array)
-          if len(line_array) > 1:
-            float_val = float(line_array[1])
-            if(isinstance(float_val,float)):
-              current_pressure = int(float_val)
-              if current_pressure > 300:
-                DEBUG and flprint("got pressure from " + pressure_filename)
-                break
-      if current_pressure > 300:
-        if last_pressure != current_pressure:
-          flprint('pressure compensation changed from', last_pressure, 'to', current_pressure)
-          pressure_mbar = current_pressure
-        break
+  global pressure_input
+  open_pressure_filter()
+  if replay:
+    reading = replay.input(PRESSURE)
+    reading = int(reading) if reading else None
+  else:
+    if pressure_input is None:
+      pressure_input = PressureInput([SENSOR_FOLDER + sensor + '/last' for sensor in PRESSURE_SENSORS], PRESSURE_SOCKET).start()
+    reading = pressure_input.get(None)
+  recorder and recorder.input(PRESSURE, b'' if reading is None else str(reading).encode('utf-8'))
+  pressure_mbar = pressure_filter.update(reading, last_pressure)
+  if pressure_mbar != last_pressure:
+    flprint('pressure compensation changed from', last_pressure, 'to', pressure_mbar, '(' + str(pressure_filter.restarts_avoided) + ' restarts avoided, ' + str(pressure_filter.samples_lost) + ' samples lost to restarts so far)')
   return pressure_mbar
 
 def start_cont_measurement(pressure_mbar):
-  LSB = 0xFF & pressure_mbar
-  MSB = 0xFF & (pressure_mbar >> 8)
-  ret = i2cWrite([0x00, 0x10, MSB, LSB, calcCRC([MSB,LSB])])
-  if ret == -1:
+  global measuring_since
+  try:
+    driver().start(pressure_mbar)
+  except SensorFault:
     print("start_cont_measurement unsuccessful")
-    exit_hard()
+    raise SensorFault("start continuous measurement failed", stalled=True)
   print('started cont measurement with ' + str(pressure_mbar) + 'mbar')
-
-read_meas_result = read_meas_interval()
-if read_meas_result != MEAS_INTERVAL:
-# if not every default, set it
-  flprint("setting interval to " + str(MEAS_INTERVAL))
-  ret = i2cWrite([0x46, 0x00, 0x00, MEAS_INTERVAL, calcCRC([0x00, MEAS_INTERVAL])])
-  if ret == -1:
-    exit_hard()
-  read_meas_result = read_meas_interval()
-  if read_meas_result != MEAS_INTERVAL:
-    eprint("setting measurement interval unsuccessful, returned " + str(read_meas_result))
-    exit_hard()
-
-asc_status = read_asc_status()
-if asc_status == 0:
-  #activating ASC
-  flprint("enabling asc...")
-  i2cWrite([0x53, 0x06, 0x00, 0x01, calcCRC([0x00,0x01])])
-  time.sleep(MEAS_INTERVAL+1)
-  asc_status = read_asc_status()
-
-call(["mkdir", "-p", SENSOR_FOLDER + SENSOR_NAME])
-
-pressure_mbar = 972 # 300 metres above sea level
-last_pressure = pressure_mbar
-start_cont_measurement(last_pressure)
-log_once = True
-while True:
-  new_pressure = get_pressure(last_pressure)
-  if new_pressure != last_pressure:
-    start_cont_measurement(new_pressure)
-    last_pressure = new_pressure
-
-  # read ready status
+  measuring_since = clock.monotonic()
+  warmup.reset()
+  metrics and metrics.inc('scd30_measurement_starts_total')
+  phase and phase.reset()
+  cache_config(measuring=True, pressure=pressure_mbar)
+
+def poll_later():
+  # after a poll that found no new data
+  if phase:
+    phase.missed()
+    phase.wait()
+  else:
+    clock.sleep(0.1)
+
+def mark_ready():
+  # a poll found a new sample: it became ready at the edge the phase lock
+  # estimates, or (without) just now
+  global ready_at
+  ready_at = phase.edge if phase and phase.edge is not None else clock.monotonic()
+
+def reread_measurement(data):
+  # the sensor keeps the measurement until the next one, so a frame with crc
+  # errors (data, False if there is none) is read again at once, up to
+  # CRC_RETRIES times; words that were good in one read and bad in another
+  # are combined if the reads agree on the rest -> values, None if it stays broken
+  frame = data or None # its crc errors are counted by crc_error()
+  crc_stats.frames += 1
+  for attempt in range(CRC_RETRIES):
+    try:
+      again = driver().read_measurement()
+    except SensorFault:
+      continue
+    crc_stats.rereads += 1
+    values = codec.decode_measurement(again)
+    if values:
+      crc_stats.recovered += 1
+      return values
+    crc_stats.count(again)
+    merged = frame and codec.merge_frames(frame, again)
+    values = merged and codec.decode_measurement(merged)
+    if values:
+      crc_stats.merged += 1
+      return values
+    frame = again
+  crc_stats.lost += 1
+  flprint(crc_stats.summary())
+  return None
+
+def poll_measurement():
+  # polls data ready until there is a new measurement -> its frame
   deadmancounter = 20 * MEAS_INTERVAL
   attempts = deadmancounter
+  silent = 0 # polls in a row the sensor did not answer at all
 
   while True:
     if deadmancounter == 0:
-      flprint(str(attempts) + " attempts to get data unsuccessful, exiting")
-      exit_hard()
-    ret = i2cWrite([0x02, 0x02])
-    if ret == -1:
-      exit_hard()
-
-    data = read_n_bytes(3)
-    if data == False:
-      flprint("read data ready unsuccessful")
-      time.sleep(0.1)
+      flprint(str(attempts) + " attempts to get data unsuccessful")
+      try:
+        stalled = probe() # answers, but does not measure
+      except Exception:
+        stalled = False
+      raise SensorFault("no data after " + str(attempts) + " attempts", stalled)
+    metrics and metrics.inc('scd30_data_ready_polls_total')
+    try:
+      data = driver().poll()
+    except SensorFault as e:
+      # before the first measurement the sensor NACKs the read, but
+      # not data ready
+      DEBUG and flprint("read data ready unsuccessful")
+      try:
+        probe()
+        silent = 0
+      except Exception:
+        silent += 1
+        if silent == 3 and recovery: # without, only the deadman counter ends the service, as before
+          raise SensorFault("sensor does not answer: " + str(e))
+      poll_later()
       deadmancounter -= 1
       continue
 
-    if data[1] == 1:
-      #print "data ready"
-      break
-    else:
-      #eprint(".")
-      time.sleep(0.1)
-      deadmancounter -= 1
+    if data is not None:
+      phase and phase.ready()
+      mark_ready()
+      return data
+
+    poll_later()
+    deadmancounter -= 1
+
+def probe():
+  # -> True if the sensor answers data ready with a good CRC
+  return driver().probe()
+
+def open_recovery():
+  return Recovery({
+    'retry': lambda: None,
+    'reopen': lambda: bus.reopen(),
+    'reset': reset,
+    'reconnect': lambda: bus.reconnect(),
+  }, probe, clock=clock, log=flprint)
+
+# returns once the sensor delivers again (or exits)
+def recover(fault, pressure_mbar):
+  flprint("sensor fault: " + str(fault))
+  if replay and replay.ended:
+    return # run() stops
+  if recovery is None:
+    exit_hard()
+  while True:
+    level = recovery.recover(fault)
+    if level is None:
+      flprint("sensor does not recover (" + recovery.summary() + "), exiting")
+      exit_hard()
+    flprint("sensor answers again after " + level)
+    if level == 'reconnect':
+      reopen_ready_pin()
+    if not fault.stalled:
+      if level in ('reset', 'reconnect'):
+        phase and phase.reset()
+      return
+    try:
+      start_cont_measurement(pressure_mbar)
+      return
+    except SensorFault as e:
+      fault = e
+
+def open_ready_pin():
+  if RDY_GPIO is None:
+    return None
+  try:
+    ready = bus.ready_pin(RDY_GPIO)
+  except Exception as e:
+    flprint("RDY pin on GPIO " + str(RDY_GPIO) + " not usable (" + str(e) + "), polling data ready")
+    return None
+  flprint("waiting for RDY on GPIO " + str(RDY_GPIO))
+  return ready
+
+# the edges of the RDY pin came over the connection a reconnect replaced
+def reopen_ready_pin():
+  global ready
+  if ready is None:
+    return
+  try:
+    ready.close()
+  except Exception:
+    pass # e.g. the callback of a stopped pigpio connection
+  ready = open_ready_pin()
+
+# interval: as read by connect(), None: read it here
+def configure(interval=None):
+  global sensor_config
+  cached = load_cached_config()
+  if interval == MEAS_INTERVAL and cached.get('interval') == MEAS_INTERVAL and cached.get('asc') == 1:
+    flprint("configuration as cached: interval " + str(interval) + ", asc enabled, firmware " + str(cached.get('firmware')))
+    sensor_config = cached
+    return
+  sensor_config = {'measuring': cached.get('measuring'), 'pressure': cached.get('pressure')}
+  asc_status = None
+  if interval is not None:
+    read_meas_result = interval
+    flprint("current measurement interval: " + str(interval))
+  else:
+    (read_meas_result, asc_status) = read_config()
+  if read_meas_result != MEAS_INTERVAL:
+  # if not every default, set it
+    flprint("setting interval to " + str(MEAS_INTERVAL))
+    try:
+      driver().set_interval(MEAS_INTERVAL)
+    except SensorFault as e:
+      eprint("error: " + str(e))
+      exit_hard()
+    read_meas_result = read_meas_interval()
+    if read_meas_result != MEAS_INTERVAL:
+      eprint("setting measurement interval unsuccessful, returned " + str(read_meas_result))
+      exit_hard()
 
-  #read measurement
-  i2cWrite([0x03, 0x00])
-  data = read_n_bytes(18)
-    
+  if asc_status is None:
+    asc_status = read_asc_status()
+  if asc_status == 0:
+    #activating ASC
+    flprint("enabling asc...")
+    try:
+      driver().set_asc(True)
+    except SensorFault as e:
+      eprint("error: " + str(e))
+    clock.sleep(0.01)
+    asc_status = read_asc_status()
+  cache_config(interval=MEAS_INTERVAL, asc=asc_status, firmware=cached.get('firmware') or read_firmware_version() or None)
+
+
+# a request from CONTROL_SOCKET -> answer, run between two samples
+def control_command(parts):
+  global MEAS_INTERVAL, measuring_since
+  (command, argument) = (parts + [None, None])[:2]
+  if command == 'frc':
+    if argument is None:
+      return {'frc': driver().frc()}
+    ppm = int(argument)
+    if not 400 <= ppm <= 2000:
+      raise ValueError("the reference has to be 400-2000 ppm")
+    answer = warmup.residuals()
+    if not warmup.stable():
+      # the client asks again, and gives up after its timeout
+      answer.update(error='readings not stable yet', retry=MEAS_INTERVAL)
+      return answer
+    driver().set_frc(ppm)
+    flprint("forced recalibration to {0} ppm, co2 sd {co2_sd:.1f} ppm, slope {co2_slope:.2f} ppm/min".format(ppm, **answer))
+    answer['frc'] = ppm
+    return answer
+  if command == 'asc':
+    if argument not in (None, 'on', 'off'):
+      raise ValueError("asc on or off")
+    if argument:
+      driver().set_asc(argument == 'on')
+    asc = driver().asc()
+    flprint("asc " + ("enabled" if asc else "disabled"))
+    cache_config(asc=1 if asc else 0)
+    return {'asc': asc}
+  if command == 'interval':
+    if argument is not None:
+      interval = int(argument)
+      driver().set_interval(interval)
+      flprint("measurement interval set to " + str(interval) + " s")
+      MEAS_INTERVAL = interval
+      measuring_since = clock.monotonic() # the sensor restarts its cycle
+      warmup.reset()
+      if phase:
+        phase.interval = float(interval)
+        phase.reset()
+      sample_file and sample_file.set_interval(interval)
+      cache_config(interval=interval)
+    return {'interval': driver().interval()}
+  if command == 'reset':
+    reset()
+    measuring_since = clock.monotonic()
+    warmup.reset()
+    phase and phase.reset()
+    return {'reset': True}
+  if command == 'firmware':
+    return {'firmware': read_firmware_version()}
+  if command == 'status':
+    status = dict((key, sensor_config.get(key)) for key in ('firmware', 'interval', 'asc', 'pressure', 'measuring'))
+    status['measuring_for'] = None if measuring_since is None else clock.monotonic() - measuring_since
+    return status
+  raise ValueError("unknown command, use frc, asc, interval, reset, firmware or status")
+
+def self_metrics():
+  # -> the prometheus lines of metrics, with the counts kept by the crc
+  # statistics, recovery and the pressure filter brought up to date
+  for (i, n) in enumerate(crc_stats.words):
+    metrics.set('scd30_crc_errors_total', 'word="' + str(i) + '"', n)
+  metrics.set('scd30_crc_errors_total', 'word="other"', crc_stats.other)
+  for result in ('recovered', 'merged', 'lost'):
+    metrics.set('scd30_crc_frames_total', 'result="' + result + '"', getattr(crc_stats, result))
+  if recovery:
+    for level in LEVELS:
+      metrics.set('scd30_recovery_attempts_total', 'level="' + level + '"', recovery.stats[level].attempts)
+      metrics.set('scd30_recovery_recoveries_total', 'level="' + level + '"', recovery.stats[level].recoveries)
+  if pressure_filter:
+    metrics.set('scd30_pressure_restarts_total', '', pressure_filter.restarts)
+    metrics.set('scd30_pressure_restarts_avoided_total', '', pressure_filter.restarts_avoided)
+    metrics.set('scd30_samples_lost_total', '', pressure_filter.samples_lost)
+  return metrics.text()
+
+# runs the measurement loop, calls on_sample(co2, T, rH) after every published sample
+def run(max_samples=None, on_sample=None):
+  global phase, recovery, metrics, bus, ready, ready_at, sample_file
+  pressure_mbar = sensor_config.get('pressure') or 972 # 300 metres above sea level
+  last_pressure = pressure_mbar
+  ready = open_ready_pin()
+  phase = PhaseLock(MEAS_INTERVAL, clock) if PHASE_LOCK and ready is None else None
+  recovery = open_recovery() if RECOVERY else None
+  if SELF_METRICS and metrics is None:
+    metrics = Metrics()
+    bus = InstrumentedTransport(bus, metrics)
+  if SAMPLE_FILE and sample_file is None:
+    sample_file = SamplePublisher(SAMPLE_FILE, MEAS_INTERVAL)
+  pressure_seconds = metrics and metrics.histogram('scd30_pressure_read_seconds')
+  output_seconds = metrics and metrics.histogram('scd30_output_seconds')
+  sample_age = metrics and metrics.histogram('scd30_sample_age_seconds', buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0))
+  if sensor_config.get('measuring'):
+    # left measuring by a service that did not stop it, with last_pressure
+    flprint("sensor still measuring with " + str(last_pressure) + " mbar")
+    open_pressure_filter().seed(last_pressure) # a reading from before, not the 972 mbar guess
+    phase and phase.reset(clock.monotonic() - MEAS_INTERVAL) # its phase is unknown, poll at once
+  else:
+    try:
+      start_cont_measurement(last_pressure)
+    except SensorFault as e:
+      recover(e, last_pressure)
+  log_once = True
+  samples = 0
+  aggregate = WindowAggregate(SERIES, AGGREGATE_WINDOW) if AGGREGATE_WINDOW else None
+  sample_time = last_sample = None # time of the last sample, and of the one before a restart to count the samples it cost
+  while (max_samples is None or samples < max_samples) and not (replay and replay.ended):
+    control and control.handle(control_command)
+    start = TIMER()
+    new_pressure = get_pressure(last_pressure)
+    metrics and pressure_seconds.observe(TIMER() - start)
+    try:
+      if new_pressure != last_pressure:
+        last_pressure = new_pressure
+        last_sample = last_sample or sample_time
+        start_cont_measurement(new_pressure)
+
+      phase and phase.wait()
+      if ready is not None and ready.wait(2 * MEAS_INTERVAL):
+        ready_at = clock.monotonic()
+        data = driver().read_measurement() # a fault goes to recover(), as when polling
+      else:
+        data = poll_measurement()
+        # an edge that came while polling was for this sample, it must
+        # not make the next wait() read the same frame again
+        ready and ready.clear()
+    except SensorFault as e:
+      recover(e, last_pressure)
+      continue
 
-  if data == False:
-    flprint("read data unsuccessful")
-    time.sleep(MEAS_INTERVAL)
-    continue
+    values = data and codec.decode_measurement(data)
+    if not values:
+      data and driver().check(data)
+      values = reread_measurement(data) if CRC_RETRIES else None
+    if not values:
+      flprint("read data unsuccessful")
+      clock.sleep(MEAS_INTERVAL)
+      continue
 
-  float_co2 = calcFloat(data[0:5])
-  float_T = calcFloat(data[6:11])
-  float_rH = calcFloat(data[12:17])
+    (float_co2, float_T, float_rH) = values
 
-  if log_once:
-    flprint("CO₂: " + str(float_co2) + ", rH: " + str(float_rH) + ", T: " + str(float_T))
-    log_once = False
+    if log_once:
+      flprint("CO₂: " + str(float_co2) + ", rH: " + str(float_rH) + ", T: " + str(float_T))
+      log_once = False
 
-  if math.isnan(float_co2) or math.isnan(float_rH) or math.isnan(float_T) or float_co2 <= 0.0 or float_rH <= 0.0:
-    flprint("read wrong, co2: " + str(float_co2) + ", rH: " + str(float_rH) + ", T: " + str(float_T))
-    log_once = True
-    continue
+    if math.isnan(float_co2) or math.isnan(float_rH) or math.isnan(float_T) or float_co2 <= 0.0 or float_rH <= 0.0:
+      flprint("read wrong, co2: " + str(float_co2) + ", rH: " + str(float_rH) + ", T: " + str(float_T))
+      log_once = True
+      continue
 
-  output_string =  'gas_ppm{{sensor="SCD30",gas="CO2"}} {0:.8f}\n'.format( float_co2 )
-  output_string += 'temperature_degC{{sensor="SCD30"}} {0:.8f}\n'.format( float_T )
-  output_string += 'humidity_rel_percent{{sensor="SCD30"}} {0:.8f}\n'.format( float_rH )
+    warmup.add(clock.monotonic(), float_co2, float_T)
+    start = TIMER()
+    output_string =  'gas_ppm{{sensor="SCD30",gas="CO2"}} {0:.8f}\n'.format( float_co2 )
+    output_string += 'temperature_degC{{sensor="SCD30"}} {0:.8f}\n'.format( float_T )
+    output_string += 'humidity_rel_percent{{sensor="SCD30"}} {0:.8f}\n'.format( float_rH )
+    now = clock.time()
+    if last_sample and pressure_filter:
+      pressure_filter.samples_lost += max(0, int(round((now - last_sample) / MEAS_INTERVAL)) - 1)
+    sample_time = now
+    last_sample = None
+    if aggregate:
+      aggregate.add(now, values)
+      output_string += aggregate.text
+    history and history.append(clock.monotonic(), values)
+    storage and storage.append(now, values)
+    mqtt and mqtt.put(now, values)
+    if metrics:
+      metrics.inc('scd30_samples_total')
+      output_string += self_metrics()
+
+    output = output_string.encode('utf-8')
+    LOGFILE and write_atomic(LOGFILE, output)
+    exporter and exporter.update(output)
+    sample_file and sample_file.publish(now, values, last_pressure)
+    if metrics:
+      output_seconds.observe(TIMER() - start)
+      ready_at is not None and sample_age.observe(clock.monotonic() - ready_at)
+    samples += 1
+    if samples == 1:
+      flprint("first sample published {0:.2f} s after start".format(time.time() - START_TIME))
+    on_sample and on_sample(float_co2, float_T, float_rH)
+    recovered = recovery and recovery.sample()
+    if recovered is not None:
+      flprint("recovered in {0:.1f} s ({1})".format(recovered, recovery.summary()))
+
+    if ready is None and phase is None:
+      clock.sleep(-0.1 + MEAS_INTERVAL)
+  ready and ready.close()
+  ready = None
+  return samples
+
+# runs all SENSORS from one loop instead of the single sensor
+def run_sensors(max_samples=None, **kwargs):
+  global daemon
+  from scd30.multi import MultiSensorDaemon, open_sensors, parse_sensor
+  specs = [parse_sensor(spec, TRANSPORT, PIGPIO_HOST, I2C_BUS, I2C_SLAVE) for spec in SENSORS]
+  if ASYNCIO:
+    from scd30.aiopigpio import AsyncSensors
+    try:
+      daemon = AsyncSensors(specs, SENSOR_FOLDER, MEAS_INTERVAL, AGGREGATE_WINDOW, get_pressure, exporter, log=flprint)
+    except ValueError as e:
+      flprint(str(e))
+      exit(1)
+    flprint("running " + str(len(specs)) + " sensors with asyncio: " + ", ".join(spec[0] for spec in specs))
+    try:
+      samples = daemon.run(max_samples) # returns on SIGINT/SIGTERM too
+    except IOError as e:
+      flprint(str(e))
+      exit(1)
+    daemon.close()
+    flprint("measurements stopped, files cleared")
+    return samples
+  try:
+    (sensors, connections) = open_sensors(specs, SENSOR_FOLDER, MEAS_INTERVAL, AGGREGATE_WINDOW, **kwargs)
+  except IOError as e:
+    flprint(str(e))
+    exit(1)
+  flprint("running " + str(len(sensors)) + " sensors: " + ", ".join(sensor.name for sensor in sensors))
+  daemon = MultiSensorDaemon(sensors, connections, clock, get_pressure, exporter, log=flprint)
+  return daemon.run(max_samples)
+
+def main():
+  global TRANSPORT, RDY_GPIO, HTTP_PORT, MQTT_HOST, SENSORS, ASYNCIO, DEBUG, TRACE_FILE, CONFIG_CACHE, STORAGE_DIR, HISTORY_SOCKET, LOGFILE
+  global SAMPLE_FILE, CONTROL_SOCKET, exporter, history, history_server, storage, mqtt, replay, clock, control
+  parser = ArgumentParser(description='read out an SCD30 continuously and write the values to ' + LOGFILE + ' in prometheus format.')
+  parser.add_argument("-t", "--transport", dest="transport", choices=TRANSPORTS, default=TRANSPORT,
+      help="how to reach the sensor (default: " + TRANSPORT + ")")
+  parser.add_argument("-r", "--rdy-gpio", dest="rdy_gpio", type=int, default=RDY_GPIO,
+      help="GPIO (BCM) wired to the SCD30 RDY pin, wait for its edge instead of polling", metavar="n")
+  parser.add_argument("-p", "--port", dest="port", type=int, default=HTTP_PORT,
+      help="serve the values on http://host:port/metrics", metavar="port")
+  parser.add_argument("-m", "--mqtt", dest="mqtt", default=MQTT_HOST,
+      help="publish the values to this MQTT broker", metavar="host")
+  parser.add_argument("-s", "--sensor", dest="sensors", action='append', default=SENSORS,
+      help="run several sensors, repeat for each: NAME[:TRANSPORT[:HOST[:BUS[:SLAVE]]]]", metavar="spec")
+  parser.add_argument("-a", "--asyncio", dest="asyncio", action='store_true', default=ASYNCIO,
+      help="with -s: read the sensors as coroutines over asyncio pigpiod connections")
+  parser.add_argument("-D", "--debug", dest="debug", action='store_true',
+      help="print debug messages")
+  parser.add_argument("--trace", dest="trace", default=TRACE_FILE,
+      help="record every I2C call to this file", metavar="file")
+  parser.add_argument("--replay", dest="replay",
+      help="play a recorded trace back instead of reading a sensor (run with the options it was recorded with)", metavar="file")
+  parser.add_argument("--realtime", dest="realtime", action='store_true',
+      help="with --replay: at the recorded pace instead of as fast as possible")
+  args = parser.parse_args()
+  TRANSPORT = args.transport
+  RDY_GPIO = args.rdy_gpio
+  HTTP_PORT = args.port
+  MQTT_HOST = args.mqtt
+  SENSORS = args.sensors
+  ASYNCIO = args.asyncio
+  DEBUG = DEBUG or args.debug
+  TRACE_FILE = args.trace
+  if args.replay:
+    replay = ReplayTransport(args.replay, args.realtime)
+    clock = replay.clock
+    LOGFILE = SAMPLE_FILE = CONFIG_CACHE = STORAGE_DIR = HISTORY_SOCKET = CONTROL_SOCKET = None # leave those of a service on this host alone
+    flprint("replaying " + args.replay + ("" if args.realtime else " as fast as possible"))
+
+  signal.signal(signal.SIGINT, exit_gracefully)
+  signal.signal(signal.SIGTERM, exit_gracefully)
+
+  if SENSORS:
+    # history, storage and mqtt are single sensor only for now
+    if HTTP_PORT:
+      from scd30.exporter import MetricsServer
+      exporter = MetricsServer(HTTP_PORT, HTTP_ADDRESS).start()
+      flprint("serving metrics on port " + str(HTTP_PORT))
+    run_sensors()
+    return
 
-  logfilehandle = open(LOGFILE, "w",1)
-  logfilehandle.write(output_string)
-  logfilehandle.close()
+  # a replay leaves /run alone, unless given one of the files there to write
+  if (not replay or LOGFILE or SAMPLE_FILE or CONFIG_CACHE) and not os.path.isdir(SENSOR_FOLDER + SENSOR_NAME):
+    os.makedirs(SENSOR_FOLDER + SENSOR_NAME)
+  interval = connect()
+  try:
+    configure(interval)
+  except SensorFault as e:
+    flprint("configuration failed: " + str(e))
+    exit_hard()
+  if HTTP_PORT:
+    from scd30.exporter import MetricsServer
+    exporter = MetricsServer(HTTP_PORT, HTTP_ADDRESS).start()
+    flprint("serving metrics on port " + str(HTTP_PORT))
+  if MQTT_HOST:
+    if MQTT_SPOOL and not os.path.isdir(os.path.dirname(MQTT_SPOOL)):
+      os.makedirs(os.path.dirname(MQTT_SPOOL))
+    from scd30.mqtt import MQTTSink, PahoConnection
+    mqtt = MQTTSink(PahoConnection(MQTT_HOST, MQTT_PORT, SENSOR_NAME + '-' + socket.gethostname()), MQTT_TOPIC,
+                    batch_size=MQTT_BATCH, batch_interval=MQTT_BATCH * MEAS_INTERVAL, spool=MQTT_SPOOL, log=flprint).start()
+    flprint("publishing to mqtt://" + MQTT_HOST + "/" + MQTT_TOPIC)
+  if STORAGE_DIR:
+    if not 0 < STORAGE_FLUSH <= MAX_SAMPLES * MEAS_INTERVAL:
+      flprint("STORAGE_FLUSH has to be 1-" + str(MAX_SAMPLES * MEAS_INTERVAL) + " s, a segment holds at most " + str(MAX_SAMPLES) + " samples")
+      exit(1)
+    storage = SegmentWriter(STORAGE_DIR, STORAGE_FLUSH, STORAGE_KEEP_DAYS, clock)
+  if HISTORY_SIZE:
+    history = RingBuffer(HISTORY_SIZE)
+    if storage:
+      # samples from before the restart
+      offset = clock.time() - clock.monotonic()
+      for (t, co2, T, rH) in read_storage(STORAGE_DIR, clock.time() - HISTORY_SIZE * MEAS_INTERVAL):
+        history.append(t - offset, (co2, T, rH))
+    if HISTORY_SOCKET:
+      history_server = HistoryServer(history, HISTORY_SOCKET, clock).start()
+  if CONTROL_SOCKET:
+    control = ControlServer(CONTROL_SOCKET).start()
+  run()
+  replay and flprint(replay.summary())
+  close_outputs()
+  bus.close()
+
+if __name__ == '__main__':
+  main()
 
-  time.sleep(-0.1 + MEAS_INTERVAL)
 
-pi.i2c_close(h)
@@ -0,0 +1,26 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Support code for the scd30-*.py scripts: the SCD30 driver (also for
+# other programs that read the sensor themselves), I2C transports and a
+# software SCD30 emulator to develop and benchmark against. Importing the
+# package opens nothing and imports no I2C library.
+
+from scd30.driver import SCD30
@@ -0,0 +1,71 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Running min/max/mean/count of every sample in fixed time windows, so a
+# scrape every 15-60 s still sees short CO2 spikes between scrapes.
+#
+# add() is O(1) per sample. The statistics of the last complete window are
+# rendered to prometheus text once, when the window rolls over, and exported
+# as <name>_min, <name>_max, <name>_mean and <name>_count.
+
+INF = float('inf')
+
+
+class WindowAggregate(object):
+
+  def __init__(self, series, window=60):
+    # series: [(name, labels), ...] in the order of the values passed to add(),
+    # e.g. [('gas_ppm', '{sensor="SCD30",gas="CO2"}'), ...]
+    self.series = series
+    self.window = window
+    self.index = None
+    self.current = self._empty()
+    self.last = None
+    self.text = ''
+
+  def _empty(self):
+    return [[INF, -INF, 0.0, 0] for _ in self.series]
+
+  def add(self, t, values):
+    index = int(t // self.window)
+    if index != self.index:
+      if self.index is not None:
+        self.last = self.current
+        self.text = self.render(self.last)
+        self.current = self._empty()
+      self.index = index
+    for stats, value in zip(self.current, values):
+      if value < stats[0]:
+        stats[0] = value
+      if value > stats[1]:
+        stats[1] = value
+      stats[2] += value
+      stats[3] += 1
+
+  def render(self, window_stats):
+    lines = []
+    for (name, labels), (low, high, total, count) in zip(self.series, window_stats):
+      if not count:
+        continue
+      lines.append('{0}_min{1} {2:.8f}\n'.format(name, labels, low))
+      lines.append('{0}_max{1} {2:.8f}\n'.format(name, labels, high))
+      lines.append('{0}_mean{1} {2:.8f}\n'.format(name, labels, total / count))
+      lines.append('{0}_count{1} {2}\n'.format(name, labels, count))
+    return ''.join(lines)
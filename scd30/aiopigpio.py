@@ -0,0 +1,338 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# asyncio client for pigpiod's socket interface and the SCD30 read loop on
+# top of it, so one process waits on any number of sensors and pigpio hosts
+# at once instead of blocking in socket calls and sleeps. Needs python 3.5+.
+#
+# pigpiod answers the requests of a connection strictly in order, so
+# requests are pipelined: they are written at once and the answers are
+# matched to them in order by one reader task; a slow network costs one
+# round trip per await, not per request in flight.
+#
+# AsyncPigpioTransport has the transfer(ops) of scd30.transport as a
+# coroutine. AsyncSensors runs scd30.multi.Sensor objects as one coroutine
+# each, with the same steps as MultiSensorDaemon. When a connection is lost
+# (e.g. pigpiod restarted), the sensors on it wait for a new one, reopen
+# their handles and start measuring again.
+
+import asyncio
+import collections
+import errno
+import os
+import signal
+import socket
+import struct
+import time
+
+from scd30.driver import READ_INTERVAL, READ_MEASUREMENT, READ_READY, SCD30, STOP
+from scd30.multi import RETRY, Sensor, output_path
+
+REQUEST = struct.Struct('<IIII') # command, p1, p2, p3 = extension size
+ANSWER = struct.Struct('<IIIi') # command, p1, p2, result
+I2CO = 54
+I2CC = 55
+I2CRD = 56
+I2CWD = 57
+PORT = 8888
+
+
+class AsyncPigpio(object):
+
+  def __init__(self, reader, writer):
+    self.reader = reader
+    self.writer = writer
+    self.pending = collections.deque() # (future, answer carries data)
+    self.requests = 0
+    self.receiver = asyncio.ensure_future(self.receive())
+
+  @classmethod
+  async def connect(cls, host='127.0.0.1', port=PORT):
+    (reader, writer) = await asyncio.open_connection(host, port)
+    writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return cls(reader, writer)
+
+  @property
+  def connected(self):
+    # False once the connection is lost, e.g. pigpiod restarted
+    return not self.receiver.done()
+
+  def command(self, command, p1=0, p2=0, extension=b'', with_data=False):
+    # sends the request at once -> future of (result, data)
+    if self.receiver.done():
+      raise IOError(errno.EPIPE, "connection to pigpiod closed")
+    future = asyncio.get_event_loop().create_future()
+    self.pending.append((future, with_data))
+    self.writer.write(REQUEST.pack(command, p1, p2, len(extension)) + bytes(extension))
+    self.requests += 1
+    return future
+
+  async def receive(self):
+    try:
+      while True:
+        (_, _, _, result) = ANSWER.unpack(await self.reader.readexactly(ANSWER.size))
+        (future, with_data) = self.pending.popleft()
+        data = await self.reader.readexactly(result) if with_data and result > 0 else b''
+        if not future.done():
+          future.set_result((result, data))
+    except (asyncio.IncompleteReadError, ConnectionError):
+      pass
+    finally:
+      while self.pending:
+        (future, _) = self.pending.popleft()
+        if not future.done():
+          future.set_exception(IOError(errno.EPIPE, "connection to pigpiod lost"))
+
+  async def call(self, name, command, p1=0, p2=0, extension=b'', with_data=False):
+    (result, data) = await self.command(command, p1, p2, extension, with_data)
+    if result < 0:
+      raise IOError(errno.EIO, name + " failed, pigpio error " + str(result))
+    return (result, data)
+
+  async def i2c_open(self, bus, address, flags=0):
+    return (await self.call('i2c_open', I2CO, bus, address, struct.pack('<I', flags)))[0]
+
+  async def i2c_close(self, handle):
+    await self.call('i2c_close', I2CC, handle)
+
+  async def i2c_read_device(self, handle, count):
+    (count, data) = await self.call('i2c_read_device', I2CRD, handle, count, with_data=True)
+    return (count, bytearray(data))
+
+  async def i2c_write_device(self, handle, data):
+    await self.call('i2c_write_device', I2CWD, handle, 0, bytes(bytearray(data)))
+
+  async def close(self):
+    self.writer.close()
+    await asyncio.sleep(0)
+    self.receiver.cancel()
+
+
+class AsyncPigpioTransport(object):
+  # the calls of scd30.transport.PigpioTransport as coroutines
+
+  def __init__(self, pi, handle, bus=1, slave=0x61):
+    self.pi = pi
+    self.handle = handle
+    self.bus = bus
+    self.slave = slave
+
+  @classmethod
+  async def open(cls, pi, bus=1, slave=0x61):
+    return cls(pi, await pi.i2c_open(bus, slave), bus, slave)
+
+  async def attach(self, pi):
+    # carries on over pi, a new connection replacing a lost one
+    self.pi = pi
+    self.handle = None # until the open succeeds
+    self.handle = await pi.i2c_open(self.bus, self.slave)
+
+  async def write_device(self, data):
+    await self.pi.i2c_write_device(self.handle, data)
+
+  async def read_device(self, n):
+    return await self.pi.i2c_read_device(self.handle, n)
+
+  async def transfer(self, ops):
+    # as scd30.transport.transfer_each()
+    results = []
+    for op, arg in ops:
+      if op == 'w':
+        await self.write_device(arg)
+      elif op == 'r':
+        (count, data) = await self.read_device(arg)
+        if count != arg:
+          raise IOError(errno.EIO, "read " + str(count) + " B instead of " + str(arg) + " B")
+        results.append(data)
+      else:
+        await asyncio.sleep(arg)
+    return results
+
+  async def close(self):
+    await self.pi.i2c_close(self.handle)
+
+
+class AsyncSensors(object):
+  # specs: scd30.multi.parse_sensor() tuples, pigpio transports only.
+  # Arguments as for MultiSensorDaemon; run() returns after max_samples
+  # or on SIGINT/SIGTERM, close() stops the sensors.
+
+  def __init__(self, specs, folder, interval=2, aggregate_window=60, pressure=None, exporter=None,
+               on_sample=None, log=None, port=PORT):
+    for spec in specs:
+      if spec[1] != 'pigpio':
+        raise ValueError(spec[0] + ": asyncio needs the pigpio transport, not " + spec[1])
+    self.specs = specs
+    self.folder = folder
+    self.interval = interval
+    self.aggregate_window = aggregate_window
+    self.port = port
+    self.get_pressure = pressure
+    self.pressure = 972 # 300 metres above sea level
+    self.exporter = exporter
+    self.on_sample = on_sample # on_sample(sensor, values)
+    self.log = log or (lambda *args: None)
+    self.loop = asyncio.new_event_loop()
+    self.connections = {} # host -> AsyncPigpio
+    self.locks = {} # host -> asyncio.Lock, one reconnect at a time
+    self.sensors = []
+    self.samples = 0
+    self.done = None
+
+  async def open(self):
+    for (name, _, host, bus, slave) in self.specs:
+      if host not in self.connections:
+        self.connections[host] = await AsyncPigpio.connect(host, self.port)
+      transport = await AsyncPigpioTransport.open(self.connections[host], bus, slave)
+      self.sensors.append(Sensor(name, transport, output_path(self.folder, name), self.interval, self.aggregate_window))
+
+  def run(self, max_samples=None):
+    asyncio.set_event_loop(self.loop)
+    self.done = self.loop.create_future()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+      try:
+        self.loop.add_signal_handler(signum, self.finish)
+      except (RuntimeError, ValueError): # not in the main thread
+        pass
+    try:
+      self.loop.run_until_complete(self.main(max_samples))
+    finally:
+      for signum in (signal.SIGINT, signal.SIGTERM):
+        self.loop.remove_signal_handler(signum)
+    return self.samples
+
+  def finish(self):
+    if not self.done.done():
+      self.done.set_result(None)
+
+  async def main(self, max_samples):
+    await self.open()
+    tasks = [asyncio.ensure_future(self.measure(sensor, spec[2], max_samples, i * self.interval / float(len(self.sensors))))
+             for i, (spec, sensor) in enumerate(zip(self.specs, self.sensors))]
+    if self.get_pressure:
+      tasks.append(asyncio.ensure_future(self.watch_pressure()))
+    await self.done
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+  async def watch_pressure(self):
+    while True:
+      self.pressure = self.get_pressure(self.pressure)
+      await asyncio.sleep(self.interval)
+
+  async def measure(self, sensor, host, max_samples, offset):
+    # the steps of MultiSensorDaemon.step() as one coroutine per sensor
+    await asyncio.sleep(offset)
+    bus = sensor.bus
+    while True:
+      try:
+        if sensor.pressure != self.pressure:
+          restart = sensor.pressure is not None
+          pressure = self.pressure
+          (data,) = await bus.transfer(READ_INTERVAL)
+          await bus.transfer(sensor.start_ops(data, pressure))
+          sensor.started(pressure)
+          self.log(sensor.name + (": pressure compensation changed to " if restart else ": started with ") + str(pressure) + " mbar")
+          await self.sleep_until(sensor.phase.due())
+          continue
+        (ready_data,) = await bus.transfer(READ_READY)
+        values = None
+        if SCD30.accept_ready(ready_data):
+          (data,) = await bus.transfer(READ_MEASUREMENT)
+          values = sensor.accept(data)
+      except IOError as e:
+        sensor.errors += 1
+        if not bus.pi.connected or bus.handle is None:
+          await self.reconnect(host, sensor)
+          if not bus.pi.connected or bus.handle is None:
+            await asyncio.sleep(RETRY)
+          continue # started again, as the measurement may have been lost too
+        if sensor.pressure is None:
+          self.log(sensor.name + ": start failed (" + str(e) + "), retrying in " + str(RETRY) + " s")
+          await asyncio.sleep(RETRY)
+          continue
+        values = None # e.g. NACK before the first sample
+      if values is None:
+        if sensor.missed():
+          self.log(sensor.name + ": " + str(sensor.misses) + " polls without data, restarting")
+          await asyncio.sleep(RETRY)
+        else:
+          await self.sleep_until(sensor.phase.due())
+        continue
+      sensor.misses = 0
+      sensor.publish(time.time(), values)
+      if self.exporter:
+        self.exporter.update(b''.join(s.page for s in self.sensors))
+      self.samples += 1
+      self.on_sample and self.on_sample(sensor, values)
+      if max_samples is not None and self.samples >= max_samples:
+        self.finish()
+      await self.sleep_until(sensor.phase.due())
+
+  async def reconnect(self, host, sensor):
+    # after the connection to pigpiod on host was lost (e.g. pigpiod
+    # restarted), all sensors on it carry on over a new one
+    lock = self.locks.get(host)
+    if lock is None:
+      lock = self.locks[host] = asyncio.Lock()
+    async with lock:
+      old = self.connections[host]
+      if old.connected:
+        if sensor.bus.handle is None: # its open failed at the last reconnect
+          try:
+            await sensor.bus.attach(old)
+          except IOError:
+            pass
+        return # or done by the coroutine of another sensor meanwhile
+      try:
+        pi = await AsyncPigpio.connect(host, self.port)
+      except OSError as e:
+        self.log("no connection to pigpio daemon at " + host + " (" + str(e) + "), retrying in " + str(RETRY) + " s")
+        return
+      self.connections[host] = pi
+      await old.close()
+      for (spec, other) in zip(self.specs, self.sensors):
+        if spec[2] == host:
+          other.pressure = None
+          try:
+            await other.bus.attach(pi)
+          except IOError as e:
+            self.log(other.name + ": open failed after reconnect (" + str(e) + ")")
+      self.log("reconnected to pigpio daemon at " + host)
+
+  async def sleep_until(self, due):
+    # due: time.monotonic(), as used by the sensors' PhaseLock
+    await asyncio.sleep(max(0, due - time.monotonic()))
+
+  async def stop(self):
+    for sensor in self.sensors:
+      try:
+        await sensor.bus.transfer(STOP)
+        await sensor.bus.close()
+      except IOError:
+        pass
+      sensor.path and os.path.isfile(sensor.path) and os.remove(sensor.path)
+    for pi in self.connections.values():
+      await pi.close()
+
+  def close(self):
+    self.loop.run_until_complete(self.stop())
+    self.loop.close()
@@ -0,0 +1,1113 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Benchmarks for the scd30-*.py scripts, run against scd30.emulator.
+# Entry point: scd30-bench.py
+
+from __future__ import print_function, division
+
+import contextlib
+import importlib.util
+import json
+import os
+import shutil
+import struct
+import tempfile
+import time
+import timeit
+
+from scd30 import codec
+
+from scd30.emulator import SCD30Emulator, EmulatorTransport, EmulatedI2CDev, VirtualClock
+from scd30.trace import ReplayTransport, TraceRecorder
+from scd30.transport import open_transport
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_script(filename):
+  # the scripts have dashes in their names, so they can't be imported normally
+  path = os.path.join(SCRIPT_DIR, filename)
+  name = filename.replace('-', '_').replace('.py', '')
+  spec = importlib.util.spec_from_file_location(name, path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+@contextlib.contextmanager
+def quiet(verbose=False):
+  if verbose:
+    yield
+    return
+  with open(os.devnull, 'w') as devnull:
+    with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+      yield
+
+
+@contextlib.contextmanager
+def service_sandbox(device, clock, call_latency=0.0):
+  # the service script wired to an emulated device, writing into a temp dir
+  service = load_script('scd30-service.py')
+  folder = tempfile.mkdtemp(prefix='scd30-bench-')
+  service.SENSOR_FOLDER = folder + '/'
+  service.LOGFILE = os.path.join(folder, service.SENSOR_NAME, 'last')
+  service.CONFIG_CACHE = os.path.join(folder, service.SENSOR_NAME, 'config.json')
+  service.SAMPLE_FILE = os.path.join(folder, service.SENSOR_NAME, 'sample')
+  os.mkdir(os.path.join(folder, service.SENSOR_NAME))
+  service.MEAS_INTERVAL = device.interval
+  service.clock = clock
+  service.bus = EmulatorTransport(device, call_latency)
+  try:
+    yield service
+  finally:
+    service.close_outputs()
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+def bench_service(samples=100, interval=2, stretch=0.0, nack_rate=0.0, crc_error_rate=0.0,
+                  realtime=False, rdy=False, call_latency=0.0, seed=1, verbose=False,
+                  phase_lock=True, drift=0.0, io_jitter=0.0, crc_retries=None, co2=415.0, self_metrics=None):
+  # runs configure() and run() of scd30-service.py; with realtime=False the
+  # sleeps are virtual, so samples/s is the pure software throughput.
+  # rdy=True waits for the emulated RDY pin instead of polling data ready,
+  # call_latency is the round trip time to pigpiod, drift the error of the
+  # sensor's clock and io_jitter the most time spent per loop on other I/O
+  # (e.g. a slow pressure file). crc_retries and self_metrics override
+  # CRC_RETRIES and SELF_METRICS, co2 is passed to the emulator.
+  import random
+  clock = time if realtime else VirtualClock()
+  device = SCD30Emulator(co2=co2, interval=interval, stretch=stretch, nack_rate=nack_rate,
+                         crc_error_rate=crc_error_rate, seed=seed, clock=clock, drift=drift)
+  rnd = random.Random(seed)
+  first_sample = []
+  latencies = []
+
+  def on_sample(co2, T, rH):
+    now = clock.time()
+    if not first_sample:
+      first_sample.append(now - start)
+    latencies.append(now - device.sample_time(device.samples_read))
+
+  with service_sandbox(device, clock, call_latency) as service, quiet(verbose):
+    bus = service.bus
+    service.RDY_GPIO = 4 if rdy else None
+    service.PHASE_LOCK = phase_lock
+    if crc_retries is not None:
+      service.CRC_RETRIES = crc_retries
+    if self_metrics is not None:
+      service.SELF_METRICS = self_metrics
+    if io_jitter:
+      get_pressure = service.get_pressure
+
+      def slow_get_pressure(last_pressure):
+        clock.sleep(rnd.uniform(0, io_jitter))
+        return get_pressure(last_pressure)
+
+      service.get_pressure = slow_get_pressure
+    start = clock.time()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    try:
+      service.configure()
+      configure_transactions = device.transactions
+      configure_calls = bus.calls
+      configure_busy = bus.busy
+      configure_polls = device.commands.get(codec.CMD_DATA_READY, 0)
+      done = service.run(samples, on_sample)
+    except SystemExit:
+      done = 0
+      configure_transactions = configure_calls = configure_busy = configure_polls = 0
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    elapsed = clock.time() - start
+    crc_stats = service.crc_stats
+    output_bytes = os.path.getsize(service.LOGFILE) if os.path.exists(service.LOGFILE) else 0
+    metrics = service.metrics
+
+  per = max(done, 1)
+  return [
+    ('samples', done),
+    ('samples/s (wall)', done / wall),
+    ('samples/s (sensor clock)', done / elapsed if elapsed else 0.0),
+    ('i2c transactions/sample', (device.transactions - configure_transactions) / per),
+    ('transport calls/sample', (bus.calls - configure_calls) / per),
+    ('bus time/sample [ms]', 1000 * (bus.busy - configure_busy) / per),
+    ('cpu ms/sample', cpu * 1000 / per),
+    ('time to first sample [s]', first_sample[0] if first_sample else float('nan')),
+    ('data ready polls/sample', (device.commands.get(codec.CMD_DATA_READY, 0) - configure_polls) / per),
+    ('sample latency [ms]', 1000 * sum(latencies) / len(latencies) if latencies else float('nan')),
+    ('sample latency p99 [ms]', 1000 * percentile(latencies, 99) if latencies else float('nan')),
+    ('sample latency jitter [ms]', 1000 * stdev(latencies) if len(latencies) > 1 else float('nan')),
+    ('nacks injected', device.nacks),
+    ('crc errors injected', device.crc_errors),
+    ('samples lost', max(0, int((elapsed - (first_sample[0] if first_sample else 0)) / device.period) + 1 - done)),
+    ('crc: frames re-read/merged/lost', '{0}/{1}/{2}'.format(crc_stats.recovered, crc_stats.merged, crc_stats.lost)),
+    ('output bytes/sample', output_bytes),
+  ] + ([('self-metrics: data ready polls/sample', metrics.counters.get(('scd30_data_ready_polls_total', ''), 0) / per)]
+       if metrics else [])
+
+
+def legacy_get_pressure(folder, sensors, last_pressure):
+  # get_pressure() of scd30-service.py before scd30.pressure, file leak included
+  for sensor in sensors:
+    pressure_mbar = last_pressure
+    pressure_filename = folder + sensor + '/last'
+    current_pressure = 0
+    if os.path.isfile(pressure_filename):
+      pressure_file = open(pressure_filename, 'r')
+      for line in pressure_file:
+        if line.startswith('pressure_hPa'):
+          line_array = line.split()
+          if len(line_array) > 1:
+            current_pressure = int(float(line_array[1]))
+            if current_pressure > 300:
+              break
+      if current_pressure > 300:
+        if last_pressure != current_pressure:
+          pressure_mbar = current_pressure
+        break
+  return pressure_mbar
+
+
+def read_syscalls():
+  # read-type syscalls of this process so far, from /proc/self/io (linux)
+  with open('/proc/self/io') as f:
+    for line in f:
+      if line.startswith('syscr:'):
+        return int(line.split()[1])
+
+
+def bench_pressure(calls=10000, updates=100):
+  # cost per get_pressure() call, the former code against scd30.pressure,
+  # with a bme680 file (bme280 missing) rewritten every calls/updates calls
+  import gc
+  import warnings
+  from scd30.exporter import write_atomic
+  from scd30.pressure import PressureInput
+  folder = tempfile.mkdtemp(prefix='scd30-bench-') + '/'
+  os.mkdir(folder + 'bme680')
+  page = b'temperature_degC{sensor="BME680"} 21.50000000\nhumidity_rel_percent{sensor="BME680"} 45.00000000\npressure_hPa{sensor="BME680"} %d.25000000\n'
+  write_atomic(folder + 'bme680/last', page % 1000)
+  results = []
+  try:
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore', ResourceWarning) # the leak
+      cases = [('former', lambda last: legacy_get_pressure(folder, ['bme280', 'bme680'], last))]
+      source = PressureInput([folder + 'bme280/last', folder + 'bme680/last']).start()
+      cases.append(('scd30.pressure', source.get))
+      for name, get in cases:
+        last = 972
+        seen = 0
+        syscalls = read_syscalls()
+        start = time.perf_counter()
+        for i in range(calls):
+          if i % (calls // updates) == 0:
+            write_atomic(folder + 'bme680/last', page % (1000 + i % 2))
+            time.sleep(0.001) # the watcher thread picks it up meanwhile
+          value = get(last)
+          seen += value != last
+          last = value
+        elapsed = time.perf_counter() - start - updates * 0.001
+        syscalls = read_syscalls() - syscalls - updates - 1 # minus the writes' and our own
+        gc.collect()
+        results += [
+          (name + ': us/call', 1e6 * elapsed / calls),
+          (name + ': read syscalls/call', syscalls / float(calls)),
+          (name + ': changes seen', seen),
+        ]
+      results.append(('scd30.pressure: file parses', sum(f.loads for f in source.files)))
+      source.close()
+  finally:
+    shutil.rmtree(folder, ignore_errors=True)
+  return results
+
+
+def parse_last(path):
+  # what a local reader of the prometheus file does for the three values
+  values = {}
+  with open(path, 'rb') as f:
+    for line in f:
+      if not line.startswith(b'#'):
+        (name, value) = line.rsplit(None, 1)
+        values[name] = float(value)
+  return (values[b'gas_ppm{sensor="SCD30",gas="CO2"}'], values[b'temperature_degC{sensor="SCD30"}'],
+          values[b'humidity_rel_percent{sensor="SCD30"}'])
+
+
+def shm_writer(path, stop):
+  # publishes samples whose values depend on each other, as fast as it can
+  # while giving up the cpu after each (a writer that never pauses starves
+  # seqlock readers; the service publishes every MEAS_INTERVAL s)
+  from scd30.shm import SamplePublisher
+  publisher = SamplePublisher(path, 2)
+  i = 0
+  while not stop.is_set():
+    i += 1
+    publisher.publish(i, (i, i + 1, i + 2), 1000)
+    time.sleep(0)
+  publisher.map.close()
+
+
+def bench_shm(calls=20000, seed=1):
+  # the latest sample for a local reader: parsing the service's prometheus
+  # file against the shared sample file (a SampleReader kept open, and a
+  # one-off read_latest() as scd30-once.py -l does), both written by the
+  # service against the emulator; then torn reads while another process
+  # publishes all the time
+  import multiprocessing
+  from scd30.shm import SampleReader, read_latest
+  clock = VirtualClock()
+  device = SCD30Emulator(seed=seed, clock=clock)
+  results = []
+  with service_sandbox(device, clock) as service, quiet():
+    service.configure()
+    service.run(10)
+    publisher = service.sample_file
+    start = time.perf_counter()
+    for i in range(calls):
+      publisher.publish(i, (415.0, 22.0, 45.0), 972)
+    results.append(('service: publish [us]', 1e6 * (time.perf_counter() - start) / calls))
+    reader = SampleReader(service.SAMPLE_FILE)
+    cases = [
+      ('prometheus file: parse [us]', lambda: parse_last(service.LOGFILE)),
+      ('sample file: SampleReader.read() [us]', reader.read),
+      ('sample file: read_latest() [us]', lambda: read_latest(service.SAMPLE_FILE)),
+    ]
+    for name, read in cases:
+      start = time.perf_counter()
+      for i in range(calls):
+        read()
+      results.append((name, 1e6 * (time.perf_counter() - start) / calls))
+    reader.close()
+
+    stop = multiprocessing.Event()
+    path = service.SAMPLE_FILE + '.race'
+    writer = multiprocessing.Process(target=shm_writer, args=(path, stop))
+    writer.start()
+    while not os.path.exists(path):
+      time.sleep(0.001)
+    torn = 0
+    samples = set()
+    try:
+      reader = SampleReader(path)
+      for i in range(calls):
+        sample = reader.read()
+        if sample:
+          samples.add(sample[0])
+          torn += sample[3] != sample[2] + 1 or sample[4] != sample[2] + 2 or sample[1] != sample[2]
+    finally:
+      stop.set()
+      writer.join()
+    results += [
+      ('concurrent writer: reads', calls),
+      ('concurrent writer: different samples seen', len(samples)),
+      ('concurrent writer: retries', reader.retries),
+      ('concurrent writer: torn samples', torn),
+    ]
+    reader.close()
+  return results
+
+
+class PressureFeed(object):
+  # stands in for scd30.pressure.PressureInput: a barometer reading of
+  # 1000.5 hPa with noise and a weather trend, truncated to hPa as parsed
+
+  def __init__(self, clock, noise=0.3, trend=1.0, seed=1):
+    import random
+    self.clock = clock
+    self.random = random.Random(seed)
+    self.noise = noise # hPa standard deviation
+    self.trend = trend # hPa/h
+    self.start = clock.time()
+
+  def get(self, last=None):
+    return int(1000.5 + self.trend * (self.clock.time() - self.start) / 3600 + self.random.gauss(0, self.noise))
+
+  def close(self):
+    pass
+
+
+def bench_hysteresis(samples=3600, noise=0.3, trend=1.0, restart_delay=None, seed=1):
+  # measurement restarts for pressure compensation and the samples they
+  # cost in scd30-service.py, restarting on every change of the reading
+  # (former behaviour) against the PRESSURE_* defaults; restart_delay is
+  # the time from a (re)start to the sensor's first sample, default: interval
+  from scd30.pressure import PressureFilter
+  results = []
+  for name in ('former', 'filtered'):
+    clock = VirtualClock()
+    device = SCD30Emulator(seed=seed, clock=clock, first_sample=restart_delay)
+    with service_sandbox(device, clock) as service, quiet():
+      service.pressure_input = PressureFeed(clock, noise, trend, seed)
+      if name == 'former':
+        service.pressure_filter = PressureFilter(0, 0, 0, clock)
+      else:
+        service.pressure_filter = PressureFilter(service.PRESSURE_HYSTERESIS, service.PRESSURE_MIN_RESTART,
+                                                 service.PRESSURE_SMOOTHING, clock)
+      start = clock.time()
+      service.configure()
+      polls = device.commands.get(codec.CMD_DATA_READY, 0)
+      done = service.run(samples)
+      elapsed = clock.time() - start
+      polls = device.commands.get(codec.CMD_DATA_READY, 0) - polls
+      pressure_filter = service.pressure_filter
+      results += [
+        (name + ': restarts', pressure_filter.restarts),
+        (name + ': restarts avoided', pressure_filter.restarts_avoided),
+        (name + ': samples lost to restarts', pressure_filter.samples_lost),
+        (name + ': samples/h (sensor clock)', 3600 * done / elapsed),
+        (name + ': data ready polls/sample', polls / float(done)),
+        (name + ': compensation off by [hPa]', abs(device.pressure - service.pressure_input.get())),
+      ]
+  return results
+
+
+FAULTS = ('nacks', 'handle', 'connection', 'stall', 'hang')
+
+
+def inject(device, bus, kind):
+  if kind == 'nacks':
+    device.inject_nacks(8) # a short bus outage
+  elif kind == 'stall':
+    device.inject_stall()
+  elif kind == 'hang':
+    device.inject_hang()
+  else:
+    bus.inject_fault(kind)
+
+
+def bench_recovery(samples=1000, every=50, faults=FAULTS, restart_time=2.0, seed=1, rdy=False):
+  # injects one fault every `every` samples into the emulator, in turn of
+  # kind, and runs scd30-service.py with RECOVERY against the former exit
+  # and restart by systemd; restart_time is what that costs on a Pi from
+  # the exit to configure() (RestartSec=100ms, interpreter start, imports,
+  # i2cdetect, pigpiod connection). rdy as for bench_service.
+  from scd30.recovery import LEVELS
+  results = []
+  for recovery in (False, True):
+    clock = VirtualClock()
+    device = SCD30Emulator(seed=seed, clock=clock)
+    done = [0]
+    faults_injected = [0]
+    buses = []
+
+    def on_sample(co2, T, rH):
+      done[0] += 1
+      if done[0] % every == 0:
+        inject(device, buses[-1], faults[faults_injected[0] % len(faults)])
+        faults_injected[0] += 1
+
+    start = clock.time()
+    restarts = 0
+    service = None
+    while done[0] < samples:
+      with service_sandbox(device, clock) as service, quiet():
+        service.RECOVERY = recovery
+        service.RDY_GPIO = 4 if rdy else None
+        buses.append(service.bus)
+        try:
+          service.configure()
+          service.run(samples - done[0], on_sample)
+        except SystemExit:
+          restarts += 1
+          clock.sleep(restart_time)
+    elapsed = clock.time() - start
+    name = 'recovery' if recovery else 'exit and restart'
+    results += [
+      (name + ': faults injected', faults_injected[0]),
+      (name + ': process restarts', restarts),
+      (name + ': samples lost', max(0, int(elapsed / device.period) - samples)),
+      (name + ': downtime per fault [s]', (elapsed - samples * device.period) / max(faults_injected[0], 1)),
+    ]
+    if recovery:
+      for level in LEVELS:
+        stats = service.recovery.stats[level]
+        results += [
+          (name + ': ' + level + ' attempts', stats.attempts),
+          (name + ': ' + level + ' recoveries', stats.recoveries),
+          (name + ': ' + level + ' mttr [s]', stats.mttr),
+        ]
+  return results
+
+
+def bench_crc(samples=1000, rates=(0.001, 0.01, 0.05), seed=1):
+  # samples lost to crc errors (bit errors per word, e.g. a long cable) with
+  # the former wait for the next sample and with immediate re-reads; the
+  # co2 varies, so that consecutive frames differ as with a real sensor
+  import math
+  results = []
+  for rate in rates:
+    for crc_retries in (0, 3):
+      rows = dict(bench_service(samples, crc_error_rate=rate, seed=seed, crc_retries=crc_retries,
+                                co2=lambda t: 600 + 200 * math.sin(t / 600.0)))
+      name = 'bit errors {0:g}/word, {1}: '.format(rate, 're-read' if crc_retries else 'wait')
+      for key in ('samples lost', 'crc: frames re-read/merged/lost', 'i2c transactions/sample'):
+        results.append((name + key, rows[key]))
+  return results
+
+
+def bench_metrics(samples=2000, call_latency=0.0, seed=1):
+  # cpu time per sample of scd30-service.py without and with SELF_METRICS,
+  # and the size of the page it writes; the polls it counts itself are
+  # checked against those the emulator saw
+  results = []
+  for self_metrics in (False, True):
+    rows = dict(bench_service(samples, call_latency=call_latency, seed=seed, self_metrics=self_metrics))
+    name = 'self-metrics ' + ('on' if self_metrics else 'off') + ': '
+    for key in ('cpu ms/sample', 'output bytes/sample', 'data ready polls/sample'):
+      results.append((name + key, rows[key]))
+    if self_metrics:
+      results.append((name + 'data ready polls/sample counted', rows['self-metrics: data ready polls/sample']))
+  return results
+
+
+def bench_trace(samples=2000, crc_error_rate=0.01, nack_rate=0.01, seed=1, rdy=False):
+  # scd30-service.py against the emulator (crc errors and NACKs included)
+  # without and with recording a trace, then the trace replayed through it
+  # as fast as possible: size of the trace, cpu time of recording and of
+  # the replay, and whether the replay publishes the same values. rdy as
+  # for bench_service.
+  import math
+  folder = tempfile.mkdtemp(prefix='scd30-bench-')
+  path = os.path.join(folder, 'trace')
+  results = []
+  published = {}
+  try:
+    for case in ('live', 'recording', 'replay'):
+      clock = VirtualClock()
+      device = SCD30Emulator(co2=lambda t: 600 + 200 * math.sin(t / 600.0), crc_error_rate=crc_error_rate,
+                             nack_rate=nack_rate, seed=seed, clock=clock)
+      values = published[case] = []
+      with service_sandbox(device, clock) as service, quiet():
+        service.RDY_GPIO = 4 if rdy else None
+        if case == 'recording':
+          service.recorder = service.bus = TraceRecorder(service.bus, path, clock)
+        elif case == 'replay':
+          service.replay = service.bus = ReplayTransport(path)
+          service.clock = service.replay.clock
+        cpu_start = time.process_time()
+        service.configure()
+        service.run(None if case == 'replay' else samples, lambda *sample: values.append(sample))
+        cpu = time.process_time() - cpu_start
+        service.bus.close()
+      results.append((case + ': cpu ms/sample', 1000 * cpu / max(len(values), 1)))
+      if case == 'recording':
+        results.append(('trace bytes/sample', os.path.getsize(path) / samples))
+      elif case == 'replay':
+        results.append(('replay: records replayed', '{0}/{1}'.format(service.replay.position, len(service.replay.records))))
+        results.append(('replay: diverged', service.replay.error or 'no'))
+  finally:
+    shutil.rmtree(folder, ignore_errors=True)
+  results.append(('replay: samples published', len(published['replay'])))
+  results.append(('replay: same values as recorded', published['replay'] == published['recording']))
+  return results
+
+
+def bench_control(samples=1000, seed=1):
+  # requests on the control socket while scd30-service.py samples the
+  # emulator (co2 600 ppm, recalibrated to 415 ppm): answers, samples lost
+  # and the co2 published before and after. The former scd30-reset-cal.py
+  # needed the service stopped for its 60 sample warm-up, all of them lost.
+  import threading
+  from scd30.control import ControlServer, command
+  clock = VirtualClock()
+  device = SCD30Emulator(co2=600.0, seed=seed, clock=clock)
+  requests = ('status', 'firmware', 'asc off', 'asc on', 'interval 5', 'interval 2', 'frc 415', 'frc')
+  answers = []
+  published = []
+  with service_sandbox(device, clock) as service, quiet():
+    path = os.path.join(os.path.dirname(service.LOGFILE), 'control.sock')
+    service.control = ControlServer(path, timeout=5).start()
+
+    def client():
+      for request in requests:
+        while True:
+          answer = command(path, request)
+          if 'retry' not in answer:
+            break
+          time.sleep(0.01) # the virtual clock runs much faster
+        answers.append((request, answer, len(published)))
+
+    def on_sample(co2, T, rH):
+      published.append(co2)
+      time.sleep(0.0002) # gives the client a chance
+
+    service.configure()
+    thread = threading.Thread(target=client)
+    thread.start()
+    done = service.run(samples, on_sample)
+    thread.join(10)
+    elapsed = clock.time()
+  frc_at = [at for (request, answer, at) in answers if request == 'frc 415']
+  results = [(request + ' -> ' + json.dumps(answer), 'at sample ' + str(at)) for (request, answer, at) in answers]
+  results += [
+    ('samples', done),
+    ('samples lost', max(0, int(elapsed / device.interval) - done)),
+    ('co2 before/after frc [ppm]', '{0:.1f}/{1:.1f}'.format(published[0], published[-1]) if frc_at else 'no frc'),
+    ('former: samples lost with the service stopped', 60),
+  ]
+  return results
+
+
+def bench_warmup(seed=1, timeout=900):
+  # time from a recalibration request to the FRC, and the calibration error
+  # it leaves (how far the settled readings are off), former fixed warm-up
+  # (restart the measurement, 60 samples, FRC) against the service's
+  # convergence check. The emulated readings settle after the start of the
+  # measurement (co2 +150 ppm, temperature -0.5 degC, time constants as
+  # given) with noise; 'room filling' rises 5 ppm/min for good.
+  import math
+  import random
+  scenarios = [
+    ('running for 10 min', 30, 600, 0),
+    ('just started, settles in 20 s', 20, 0, 0),
+    ('just started, settles in 90 s', 90, 0, 0),
+    ('room filling', 30, 600, 5),
+  ]
+  results = []
+  for (name, tau, running, drift) in scenarios:
+    def co2(t, tau=tau, drift=drift):
+      return 415 + 150 * math.exp(-t / tau) + drift * t / 60 + random.Random(int(t * 10) + seed).gauss(0, 3)
+
+    def temperature(t):
+      return 22 - 0.5 * math.exp(-t / 60.0)
+
+    for former in (True, False):
+      clock = VirtualClock()
+      device = SCD30Emulator(co2=co2, temperature=temperature, seed=seed, clock=clock)
+      state = {}
+      with service_sandbox(device, clock) as service, quiet():
+        def on_sample(*values):
+          now = clock.monotonic()
+          if 'requested' not in state:
+            if now >= running:
+              state['requested'] = now
+              former and service.start_cont_measurement(972)
+            return
+          if 'done' in state:
+            return
+          if former:
+            state['samples'] = state.get('samples', 0) + 1
+            if state['samples'] == 60:
+              service.driver().set_frc(415)
+              state['done'] = now
+          else:
+            answer = service.control_command(['frc', '415'])
+            if 'retry' not in answer or now - state['requested'] > timeout:
+              state['done'] = now
+              state['answer'] = answer
+
+        service.configure()
+        service.run(int((running + timeout) / device.interval) + 70, on_sample)
+      label = name + (': former' if former else ': convergence') + ': '
+      calibrated = former or 'frc' in state.get('answer', {})
+      results.append((label + 'time to frc [s]', state['done'] - state['requested'] if calibrated else 'refused'))
+      results.append((label + 'calibration error [ppm]', abs(device.frc_offset) if calibrated else 0.0))
+  return results
+
+
+def bench_fleet(counts=(1, 8, 32), interval=2, call_latency=0.0005, running=600, seed=1):
+  # scd30.fleet against n emulated sensors on one virtual clock, each with
+  # an offset of its own (-80..+80 ppm), its own settling after the start
+  # (time constant 10-90 s) and a clock drift of up to 2 %. Time until all
+  # are recalibrated at once, against one after another (the sum of the
+  # single sensor times), and the offsets left after the FRC. Then the same
+  # for sensors that have been measuring for running s already, which are
+  # only sent the pressure and do not settle again.
+  import math
+  import random
+  from scd30.fleet import CALIBRATED, FleetCalibration
+  from scd30.multi import Sensor
+  results = []
+  for count in counts:
+    rnd = random.Random(seed)
+    devices = []
+    for i in range(count):
+      (offset, tau, drift) = (rnd.uniform(-80, 80), rnd.uniform(10, 90), rnd.uniform(-0.02, 0.02))
+
+      def co2(t, offset=offset, tau=tau, i=i):
+        return 415 + offset + 100 * math.exp(-t / tau) + random.Random(int(t * 10) * 1000 + i + seed).gauss(0, 3)
+
+      devices.append(dict(co2=co2, temperature=lambda t, tau=tau: 22 - 0.5 * math.exp(-t / tau), drift=drift, seed=seed + i))
+
+    def calibrate(kwargs_list, running=0):
+      clock = VirtualClock(1.5e9)
+      sensors = [Sensor('room' + str(i), EmulatorTransport(SCD30Emulator(clock=clock, interval=interval, **kwargs), call_latency), None,
+                        interval, 0, clock) for i, kwargs in enumerate(kwargs_list)]
+      if running:
+        for sensor in sensors:
+          sensor.bus.write_device(codec.command(codec.CMD_START_CONT))
+        clock.sleep(running)
+      fleet = FleetCalibration(sensors, 415, clock=clock)
+      cpu_start = time.process_time()
+      calibrations = fleet.run()
+      cpu = time.process_time() - cpu_start
+      elapsed = clock.monotonic() - fleet.start
+      fleet.close()
+      return (calibrations, elapsed, cpu)
+
+    for (state, since) in (('just started', 0), ('measuring', running)):
+      (calibrations, elapsed, cpu) = calibrate(devices, since)
+      sequential = sum(calibrate([kwargs], since)[1] for kwargs in devices)
+      done = [c for c in calibrations if c.status == CALIBRATED]
+      label = str(count) + ' sensors, ' + state + ': '
+      results += [
+        (label + 'calibrated', len(done)),
+        (label + 'one after another [s]', sequential),
+        (label + 'all at once [s]', elapsed),
+        (label + 'slowest sensor to frc [s]', max(c.seconds for c in done) if done else float('nan')),
+        (label + 'max |offset| before [ppm]', max(abs(c.before) for c in done) if done else float('nan')),
+        (label + 'max |offset| after [ppm]', max(abs(c.after) for c in done) if done else float('nan')),
+        (label + 'cpu ms', 1000 * cpu),
+      ]
+  return results
+
+
+def bench_startup(interval=2, restart_time=1.0, seed=1):
+  # time from start to the first sample of scd30-service.py against the
+  # emulator: a cold start (no cached configuration, ASC off, sensor idle),
+  # a restart after a graceful exit and one after a crash (sensor still
+  # measuring), each with the cache the previous one left. The former
+  # startup also ran i2cdetect and mkdir as subprocesses (measured here)
+  # and slept MEAS_INTERVAL + 1 s after enabling ASC. restart_time passes
+  # between the runs.
+  from subprocess import call
+  clock = VirtualClock()
+  device = SCD30Emulator(interval=interval, seed=seed, clock=clock, asc=0)
+  results = []
+  cache = None
+  for name, graceful in (('cold start', True), ('restart', False), ('restart after crash', True)): # graceful: how it ends
+    with service_sandbox(device, clock) as service, quiet():
+      bus = service.bus
+      service.open_transport = lambda *args, **kwargs: bus
+      if cache:
+        with open(service.CONFIG_CACHE, 'wb') as f:
+          f.write(cache)
+      clock.sleep(restart_time if cache else 0)
+      transactions = device.transactions
+      start = clock.time()
+      wall_start = time.perf_counter()
+      service.configure(service.connect())
+      wall = time.perf_counter() - wall_start
+      service.run(1)
+      elapsed = clock.time() - start
+      transactions = device.transactions - transactions
+      if graceful:
+        service.stop_measurement()
+      with open(service.CONFIG_CACHE, 'rb') as f:
+        cache = f.read()
+    results += [
+      (name + ': time to first sample [s]', elapsed),
+      (name + ': i2c transactions', transactions),
+      (name + ': startup cpu [ms]', 1000 * wall),
+    ]
+  folder = tempfile.mkdtemp(prefix='scd30-bench-')
+  try:
+    wall_start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+      call("i2cdetect -y 1 0x61 0x61|grep '\\--' -q", shell=True, stderr=devnull)
+    call(["mkdir", "-p", os.path.join(folder, 'scd30')])
+    results.append(('former: i2cdetect + mkdir subprocesses [ms]', 1000 * (time.perf_counter() - wall_start)))
+  finally:
+    shutil.rmtree(folder, ignore_errors=True)
+  results.append(('former: sleep after enabling ASC [s]', interval + 1))
+  return results
+
+
+def bench_schedule(samples=1000, drifts=(-0.03, 0.0, 0.03), io_jitter=0.05, seed=1):
+  # data ready polls and sample latency of scd30-service.py with the former
+  # fixed sleep and with PHASE_LOCK, for sensor clocks running fast or slow
+  results = []
+  for drift in drifts:
+    for phase_lock in (False, True):
+      rows = dict(bench_service(samples, seed=seed, phase_lock=phase_lock, drift=drift, io_jitter=io_jitter))
+      name = 'drift {0:+.0%}, {1}: '.format(drift, 'phase lock' if phase_lock else 'fixed sleep')
+      for key in ('data ready polls/sample', 'sample latency [ms]', 'sample latency p99 [ms]', 'sample latency jitter [ms]'):
+        results.append((name + key, rows[key]))
+  return results
+
+
+def open_bench_transport(kind, host='127.0.0.1', bus=1, slave=0x61):
+  # like open_transport, plus 'i2cdev-emulated': the i2c-dev code path down
+  # to the ioctl, answered by the emulator instead of the kernel
+  if kind == 'i2cdev-emulated':
+    from scd30.i2cdev import I2CDevTransport
+    return I2CDevTransport(bus, slave, path=os.devnull, ioctl=EmulatedI2CDev(address=slave).ioctl)
+  return open_transport(kind, host, bus, slave)
+
+
+def stdev(values):
+  mean = sum(values) / len(values)
+  return (sum((value - mean) ** 2 for value in values) / (len(values) - 1)) ** 0.5
+
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def bench_transport(kind, transactions=1000, host='127.0.0.1', bus=1, slave=0x61):
+  # per transaction latency: firmware version queries, each a write + a read
+  try:
+    transport = open_bench_transport(kind, host, bus, slave)
+  except Exception as e:
+    return [('unavailable', str(e))]
+  times = []
+  errors = 0
+  try:
+    for _ in range(transactions // 2):
+      start = time.perf_counter()
+      try:
+        transport.write_device([0xD1, 0x00])
+        transport.read_device(3)
+      except (IOError, OSError):
+        errors += 1
+      times.append((time.perf_counter() - start) / 2)
+  finally:
+    transport.close()
+  return [
+    ('transactions', 2 * len(times)),
+    ('errors', errors),
+    ('mean [us]', 1e6 * sum(times) / len(times)),
+    ('p50 [us]', 1e6 * percentile(times, 50)),
+    ('p99 [us]', 1e6 * percentile(times, 99)),
+  ]
+
+
+def legacy_codec():
+  # the crcmod based functions the scripts used before scd30.codec
+  import crcmod
+  f_crc8 = crcmod.mkCrcFun(0x131, 0xFF, False, 0x00)
+
+  def calcCRC(TwoBdataArray):
+    return f_crc8(bytes(bytearray(TwoBdataArray)))
+
+  def calcFloat(sixBArray):
+    return struct.unpack('>f', struct.pack('>BBBB', sixBArray[0], sixBArray[1], sixBArray[3], sixBArray[4]))[0]
+
+  def decode(data):
+    for i in range(int(len(data) / 3)):
+      offset = i * 3
+      if data[offset + 2] != calcCRC([data[offset + 0], data[offset + 1]]):
+        return None
+    return (calcFloat(data[0:5]), calcFloat(data[6:11]), calcFloat(data[12:17]))
+
+  def command(pressure_mbar):
+    LSB = 0xFF & pressure_mbar
+    MSB = 0xFF & (pressure_mbar >> 8)
+    return [0x00, 0x10, MSB, LSB, calcCRC([MSB,LSB])]
+
+  return calcCRC, decode, command
+
+
+def bench_codec(number=100000):
+  frame = codec.encode_measurement(415.5, 22.25, 45.0)
+  cases = [
+    ('crc of a word', lambda: codec.crc8(0xBE, 0xEF)),
+    ('decode 18 B measurement', lambda: codec.decode_measurement(frame)),
+    ('build start command', lambda: codec.command(codec.CMD_START_CONT, 972)),
+  ]
+  try:
+    (calcCRC, decode, command) = legacy_codec()
+    legacy = [lambda: calcCRC([0xBE, 0xEF]), lambda: decode(frame), lambda: command(972)]
+    assert decode(frame) == codec.decode_measurement(frame)
+  except ImportError:
+    legacy = [None] * len(cases)
+  results = []
+  for (name, new), old in zip(cases, legacy):
+    new_us = 1e6 * min(timeit.repeat(new, number=number, repeat=3)) / number
+    results.append((name + ' [us]', new_us))
+    if old is not None:
+      old_us = 1e6 * min(timeit.repeat(old, number=number, repeat=3)) / number
+      results.append(('  crcmod version [us]', old_us))
+      results.append(('  speedup', old_us / new_us))
+  return results
+
+
+def timed(function, repeat=5):
+  # best wall time of repeat calls in ms
+  best = float('inf')
+  for _ in range(repeat):
+    start = time.perf_counter()
+    function()
+    best = min(best, time.perf_counter() - start)
+  return 1000 * best
+
+
+def bench_history(capacity=43200, interval=2):
+  from scd30.history import RingBuffer, HistoryServer, query
+  clock = VirtualClock()
+  history = RingBuffer(capacity)
+  for i in range(capacity + capacity // 3): # wrapped around
+    history.append(i * interval, (400.0 + i % 500, 20.0 + i % 7, 40.0 + i % 11))
+  clock.now = (capacity + capacity // 3) * interval
+  end = clock.now
+  start = end - capacity * interval
+  folder = tempfile.mkdtemp(prefix='scd30-bench-')
+  server = HistoryServer(history, os.path.join(folder, 'history.sock'), clock).start()
+  try:
+    return [
+      ('samples', history.size),
+      ('memory [kB]', history.nbytes / 1024),
+      ('range last hour [ms]', timed(lambda: history.range(end - 3600, end))),
+      ('range all [ms]', timed(lambda: history.range(start, end))),
+      ('downsample all to 5 min [ms]', timed(lambda: history.downsample(start, end, 300))),
+      ('socket: info [ms]', timed(lambda: query(server.path, 'info'))),
+      ('socket: range last hour [ms]', timed(lambda: query(server.path, 'range -3600 0'))),
+      ('socket: downsample all to 5 min [ms]', timed(lambda: query(server.path, 'downsample ' + str(start - end) + ' 0 300'))),
+    ]
+  finally:
+    server.close()
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+def bench_storage(samples=43200, interval=2, flush_interval=900, seed=1):
+  # one day of noisy samples through SegmentWriter, then read back
+  import random
+  from scd30 import storage
+  folder = tempfile.mkdtemp(prefix='scd30-bench-')
+  clock = VirtualClock(1.5e9 - 1.5e9 % 86400) # midnight, one file
+  rnd = random.Random(seed)
+  try:
+    writer = storage.SegmentWriter(folder, flush_interval, clock=clock)
+    text_bytes = 0
+    cpu_start = time.process_time()
+    for i in range(samples):
+      values = (415 + 50 * (i % 1800 < 300) + rnd.gauss(0, 3), 21.5 + (i % 43200) / 10000.0, 45 + rnd.gauss(0, 0.2))
+      writer.append(clock.time(), values)
+      text_bytes += len('gas_ppm{{sensor="SCD30",gas="CO2"}} {0:.8f}\n'.format(values[0]) +
+        'temperature_degC{{sensor="SCD30"}} {0:.8f}\n'.format(values[1]) +
+        'humidity_rel_percent{{sensor="SCD30"}} {0:.8f}\n'.format(values[2]))
+      clock.sleep(interval)
+    writer.close()
+    write_cpu = time.process_time() - cpu_start
+    files = [os.path.join(folder, name) for name in os.listdir(folder)]
+    stored = sum(os.path.getsize(path) for path in files)
+
+    start = time.perf_counter()
+    count = sum(1 for _ in storage.read(folder))
+    read_all = time.perf_counter() - start
+    end = clock.time()
+    last_hour = timed(lambda: list(storage.read(folder, end - 3600, end)))
+    return [
+      ('samples', writer.samples_written),
+      ('segments (= fsyncs)', writer.segments_written),
+      ('bytes/sample stored', stored / samples),
+      ('bytes/sample as text file', text_bytes / samples),
+      ('write cpu us/sample', 1e6 * write_cpu / samples),
+      ('read all [samples/s]', count / read_all),
+      ('read last hour [ms]', last_hour),
+    ]
+  finally:
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+def bench_mqtt(samples=20000, batch=30, outage=0.5, payload='json', queue_size=1000):
+  # samples through MQTTSink into a MemoryBroker that is offline for the
+  # middle outage fraction of the run, then drained from the spool
+  import tracemalloc
+  from scd30 import mqtt
+  folder = tempfile.mkdtemp(prefix='scd30-bench-')
+  broker = mqtt.MemoryBroker()
+  sink = mqtt.MQTTSink(broker, 'bench', payload=payload, batch_size=batch, batch_interval=3600,
+                       queue_size=queue_size, spool=os.path.join(folder, 'spool')).start()
+  down = int(samples * (1 - outage) / 2)
+  up = min(down + int(samples * outage), samples - 1)
+  spool_peak = 0
+  try:
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(samples):
+      if i == down:
+        sink.flush()
+        broker.online = False
+      if i == up:
+        sink.flush()
+        spool_peak = os.path.getsize(sink.spool) if os.path.exists(sink.spool) else 0
+        broker.online = True
+      while sink.queue.full():
+        time.sleep(0.0001) # the bench is faster than any sensor, don't count this as loss
+      sink.put(1.5e9 + 2 * i, (415.0 + i % 100, 21.5, 45.0))
+    sink.flush()
+    elapsed = time.perf_counter() - start
+    (_, memory_peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    delivered = 0
+    for (_, body) in broker.messages:
+      delivered += len(body) // mqtt.RECORD.size if payload == 'binary' else body.count(b'[') - 1
+    return [
+      ('samples', samples),
+      ('delivered', delivered),
+      ('dropped', sink.dropped),
+      ('messages', sink.messages),
+      ('samples/s', samples / elapsed),
+      ('bytes/message', sum(len(body) for (_, body) in broker.messages) / max(sink.messages, 1)),
+      ('spooled samples', sink.spooled),
+      ('spool peak [kB]', spool_peak / 1024.0),
+      ('python memory peak [kB]', memory_peak / 1024.0),
+    ]
+  finally:
+    sink.close()
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+def bench_multi(counts=(1, 8, 32, 64), seconds=600, interval=2, call_latency=0.0005, seed=1):
+  # MultiSensorDaemon with n emulated sensors on one virtual clock for
+  # seconds of sensor time: cost per sensor and per sample as n grows
+  import resource
+  import tracemalloc
+  from scd30.multi import MultiSensorDaemon, open_sensors
+  results = [('process rss before [kB]', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)]
+  for count in counts:
+    clock = VirtualClock(1.5e9)
+    folder = tempfile.mkdtemp(prefix='scd30-bench-')
+    try:
+      tracemalloc.start()
+      (sensors, _) = open_sensors([('room' + str(i), 'emulator', None, 1, 0x61) for i in range(count)], folder, interval,
+                                  clock=clock, seed=seed, call_latency=call_latency)
+      latencies = []
+
+      def on_sample(sensor, values):
+        device = sensor.bus.device
+        latencies.append(clock.time() - device.sample_time(device.samples_read))
+
+      daemon = MultiSensorDaemon(sensors, clock=clock, on_sample=on_sample)
+      memory = tracemalloc.get_traced_memory()[0]
+      cpu_start = time.process_time()
+      done = daemon.run(count * seconds // interval)
+      cpu = time.process_time() - cpu_start
+      (current, peak) = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+      calls = sum(sensor.bus.calls for sensor in sensors)
+      results += [
+        (str(count) + ' sensors: samples', done),
+        (str(count) + ' sensors: memory/sensor [kB]', max(current, memory) / 1024.0 / count),
+        (str(count) + ' sensors: cpu ms/sample', 1000 * cpu / max(done, 1)),
+        (str(count) + ' sensors: cpu % of one core', 100 * cpu / (clock.time() - 1.5e9)),
+        (str(count) + ' sensors: transport calls/sample', calls / float(max(done, 1))),
+        (str(count) + ' sensors: max sample latency [ms]', 1000 * max(latencies) if latencies else float('nan')),
+      ]
+      daemon.close()
+    finally:
+      shutil.rmtree(folder, ignore_errors=True)
+  results.append(('process rss after [kB]', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+  return results
+
+
+def bench_aio(latency=0.001, transactions=500, concurrency=(1, 8, 32), sensors=32, seconds=6):
+  # scd30.aiopigpio against a FakePigpiod with latency s per answer:
+  # transactions (READ_MEASUREMENT) with the blocking pigpio module, one at
+  # a time and pipelined with asyncio, then sensors read as coroutines
+  import asyncio
+  from scd30.aiopigpio import AsyncPigpio, AsyncPigpioTransport, AsyncSensors
+  from scd30.fakepigpiod import FakePigpiod
+  from scd30.driver import READ_MEASUREMENT
+  from scd30.transport import PigpioTransport
+
+  def measuring(bus, address):
+    # a sample ready at once, so every READ_MEASUREMENT succeeds
+    device = SCD30Emulator(first_sample=0)
+    device.write(codec.command(codec.CMD_START_CONT, 0))
+    return device
+
+  server = FakePigpiod(measuring, latency=latency).start_thread()
+  results = []
+  try:
+    try:
+      import pigpio
+      pi = pigpio.pi('127.0.0.1', server.port)
+      bus = PigpioTransport(pi=pi)
+      times = []
+      for _ in range(transactions):
+        start = time.perf_counter()
+        bus.transfer(READ_MEASUREMENT)
+        times.append(time.perf_counter() - start)
+      bus.close()
+      pi.stop()
+      results += [
+        ('pigpio module: transfers/s', len(times) / sum(times)),
+        ('pigpio module: p50 [ms]', 1000 * percentile(times, 50)),
+      ]
+    except ImportError:
+      results.append(('pigpio module', 'not installed'))
+
+    async def transfers():
+      pi = await AsyncPigpio.connect('127.0.0.1', server.port)
+      bus = await AsyncPigpioTransport.open(pi, 1, 0x61)
+      rows = []
+      times = []
+      for _ in range(transactions):
+        start = time.perf_counter()
+        await bus.transfer(READ_MEASUREMENT)
+        times.append(time.perf_counter() - start)
+      rows += [
+        ('asyncio: transfers/s', len(times) / sum(times)),
+        ('asyncio: p50 [ms]', 1000 * percentile(times, 50)),
+        ('asyncio: p99 [ms]', 1000 * percentile(times, 99)),
+      ]
+      for count in concurrency:
+        async def worker():
+          for _ in range(transactions // count):
+            await bus.transfer(READ_MEASUREMENT)
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(count)])
+        rows.append(('asyncio, ' + str(count) + ' in flight: transfers/s', count * (transactions // count) / (time.perf_counter() - start)))
+      await bus.close()
+      await pi.close()
+      return rows
+
+    loop = asyncio.new_event_loop()
+    try:
+      results += loop.run_until_complete(transfers())
+    finally:
+      loop.close()
+
+    if sensors:
+      folder = tempfile.mkdtemp(prefix='scd30-bench-')
+      try:
+        specs = [('room' + str(i), 'pigpio', '127.0.0.1', i, 0x61) for i in range(sensors)]
+        daemon = AsyncSensors(specs, folder, port=server.port)
+        requests = server.requests
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        done = daemon.run(sensors * (seconds // 2))
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        daemon.close()
+        results += [
+          (str(sensors) + ' sensors: samples', done),
+          (str(sensors) + ' sensors: cpu % of one core', 100 * cpu / wall),
+          (str(sensors) + ' sensors: pigpiod requests/sample', (server.requests - requests) / float(max(done, 1))),
+        ]
+      finally:
+        shutil.rmtree(folder, ignore_errors=True)
+  finally:
+    server.stop_thread()
+  return results
+
+
+def report(title, results):
+  print(title)
+  width = max(len(key) for key, _ in results)
+  for key, value in results:
+    if isinstance(value, float):
+      value = '{0:.4f}'.format(value)
+    print('  ' + key.ljust(width) + '  ' + str(value))
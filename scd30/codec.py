@@ -0,0 +1,169 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# SCD30 frame encoding and decoding.
+#
+# The sensor sends and expects 16 bit big endian words, each followed by a
+# CRC8 (polynomial 0x31, init 0xFF). A measurement is 6 words = 18 bytes:
+# CO2, temperature and humidity as big endian float32, split in two words.
+
+import struct
+
+CMD_START_CONT = 0x0010
+CMD_STOP = 0x0104
+CMD_DATA_READY = 0x0202
+CMD_READ_MEASUREMENT = 0x0300
+CMD_INTERVAL = 0x4600
+CMD_FRC = 0x5204
+CMD_ASC = 0x5306
+CMD_FIRMWARE = 0xD100
+CMD_SOFT_RESET = 0xD304
+
+
+def _crc_table():
+  table = []
+  for byte in range(256):
+    crc = byte
+    for _ in range(8):
+      crc = ((crc << 1) ^ 0x31) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    table.append(crc)
+  return tuple(table)
+
+# CRC of a word (msb, lsb) is CRC_TABLE[CRC_TABLE[0xFF ^ msb] ^ lsb]
+CRC_TABLE = _crc_table()
+
+MEASUREMENT = struct.Struct('>fff')
+WORD = struct.Struct('>H')
+
+_COMMANDS = dict((command, WORD.pack(command)) for command in (
+  CMD_START_CONT, CMD_STOP, CMD_DATA_READY, CMD_READ_MEASUREMENT, CMD_INTERVAL,
+  CMD_FRC, CMD_ASC, CMD_FIRMWARE, CMD_SOFT_RESET))
+
+
+def crc8(msb, lsb):
+  return CRC_TABLE[CRC_TABLE[0xFF ^ msb] ^ lsb]
+
+
+def bad_word(data):
+  # index of the first word with a wrong crc, -1 if all are fine
+  table = CRC_TABLE
+  view = memoryview(data)
+  for offset in range(0, len(view) - 2, 3):
+    if table[table[0xFF ^ view[offset]] ^ view[offset + 1]] != view[offset + 2]:
+      return offset // 3
+  return -1
+
+
+def bad_words(data):
+  # indices of all words with a wrong crc
+  table = CRC_TABLE
+  view = memoryview(data)
+  return [offset // 3 for offset in range(0, len(view) - 2, 3)
+          if table[table[0xFF ^ view[offset]] ^ view[offset + 1]] != view[offset + 2]]
+
+
+def merge_frames(a, b):
+  # two reads of the same buffer with crc errors in different words -> a
+  # frame of the good words of both, None if a word is bad in both or the
+  # reads may be of different data (no word good in both, or one differs)
+  if len(a) != len(b):
+    return None
+  bad_a = set(bad_words(a))
+  bad_b = set(bad_words(b))
+  words = len(a) // 3
+  common = [i for i in range(words) if i not in bad_a and i not in bad_b]
+  if bad_a & bad_b or not common or any(a[i * 3:i * 3 + 3] != b[i * 3:i * 3 + 3] for i in common):
+    return None
+  merged = bytearray(a)
+  for i in bad_a:
+    merged[i * 3:i * 3 + 3] = b[i * 3:i * 3 + 3]
+  return merged
+
+
+class CRCStats(object):
+  # crc errors per word position of the frames read, and what became of them
+  __slots__ = ('words', 'other', 'frames', 'rereads', 'recovered', 'merged', 'lost')
+
+  def __init__(self, words=6):
+    self.words = [0] * words
+    self.other = 0 # in other reads (data ready, configuration)
+    self.frames = 0 # measurements read with crc errors (or not at all)
+    self.rereads = 0
+    self.recovered = 0 # by a clean re-read
+    self.merged = 0 # from the good words of several reads
+    self.lost = 0
+
+  def count(self, data):
+    bad = bad_words(data)
+    if len(data) != 3 * len(self.words):
+      self.other += len(bad)
+      return bad
+    for i in bad:
+      self.words[i] += 1
+    return bad
+
+  def summary(self):
+    return ("crc errors per word " + "/".join(str(n) for n in self.words) + ", " + str(self.frames) + " frames: " +
+            str(self.recovered) + " re-read, " + str(self.merged) + " merged, " + str(self.lost) + " lost")
+
+
+def decode_word(data):
+  # first word of data, None if its crc is wrong
+  if CRC_TABLE[CRC_TABLE[0xFF ^ data[0]] ^ data[1]] != data[2]:
+    return None
+  return (data[0] << 8) | data[1]
+
+
+def decode_measurement(frame):
+  # 18 byte frame -> (co2, temperature, humidity), None if a crc is wrong
+  table = CRC_TABLE
+  v = memoryview(frame)
+  if (table[table[0xFF ^ v[0]] ^ v[1]] != v[2] or table[table[0xFF ^ v[3]] ^ v[4]] != v[5] or
+      table[table[0xFF ^ v[6]] ^ v[7]] != v[8] or table[table[0xFF ^ v[9]] ^ v[10]] != v[11] or
+      table[table[0xFF ^ v[12]] ^ v[13]] != v[14] or table[table[0xFF ^ v[15]] ^ v[16]] != v[17]):
+    return None
+  raw = bytearray(v[:18])
+  del raw[2::3]
+  return MEASUREMENT.unpack(raw)
+
+
+def encode_words(*values):
+  # 16 bit values -> bytes as the sensor sends them, crc after every word
+  out = bytearray()
+  for value in values:
+    msb = (value >> 8) & 0xFF
+    lsb = value & 0xFF
+    out += bytearray((msb, lsb, CRC_TABLE[CRC_TABLE[0xFF ^ msb] ^ lsb]))
+  return out
+
+
+def encode_measurement(co2, temperature, humidity):
+  raw = MEASUREMENT.pack(co2, temperature, humidity)
+  return encode_words(*struct.unpack('>6H', raw))
+
+
+def command(cmd, argument=None):
+  # frame to write for cmd, with its argument word and crc if given
+  template = _COMMANDS.get(cmd) or WORD.pack(cmd)
+  if argument is None:
+    return template
+  msb = (argument >> 8) & 0xFF
+  lsb = argument & 0xFF
+  return template + bytes(bytearray((msb, lsb, CRC_TABLE[CRC_TABLE[0xFF ^ msb] ^ lsb])))
@@ -0,0 +1,132 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Commands for the running service on a unix socket, so that the service
+# stays the only user of the bus: scd30-reset-cal.py and
+# scd30-enable-asc.py send them instead of opening an I2C handle of their
+# own (and closing the service's). One request line per connection, one
+# JSON line back:
+#   frc [ppm]        forced recalibration to ppm (400-2000), without: the last reference
+#   asc [on|off]     automatic self-calibration
+#   interval [s]     measurement interval (2-1800 s), until the service restarts
+#   reset            soft reset
+#   firmware         firmware version
+#   status           configuration as known to the service
+# e.g.
+#   echo "frc 415" | socat - UNIX-CONNECT:/run/sensors/scd30/control.sock
+#
+# The server thread only queues the requests; the measurement loop runs
+# them between two samples (handle()), so sampling goes on meanwhile. An
+# answer can therefore take up to an interval. Failures are answered as
+# {"error": message}, with "retry": s if the request can succeed later.
+
+import json
+import os
+import socket
+import threading
+
+import queue
+
+
+class Request(object):
+  __slots__ = ('parts', 'answer', 'done', 'cancelled')
+
+  def __init__(self, parts):
+    self.parts = parts
+    self.answer = None
+    self.done = threading.Event()
+    self.cancelled = False # the client gave up waiting
+
+
+class ControlServer(object):
+
+  def __init__(self, path, timeout=60):
+    self.path = path
+    self.timeout = timeout # s to wait for the measurement loop
+    self.requests = queue.Queue()
+    if os.path.exists(path):
+      os.remove(path)
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.bind(path)
+    os.chmod(path, 0o660) # recalibration is not for everyone
+    self.sock.listen(4)
+    self.thread = threading.Thread(target=self.serve, name='control')
+    self.thread.daemon = True
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def serve(self):
+    while True:
+      try:
+        (conn, _) = self.sock.accept()
+      except (IOError, OSError):
+        return
+      try:
+        conn.settimeout(5)
+        line = conn.makefile('rb').readline(256).decode('ascii', 'replace')
+        request = Request(line.split())
+        self.requests.put(request)
+        if not request.done.wait(self.timeout):
+          request.cancelled = True
+          request.answer = {'error': 'no answer from the measurement loop within ' + str(self.timeout) + ' s'}
+        conn.sendall(json.dumps(request.answer).encode('ascii') + b'\n')
+      except (IOError, OSError):
+        pass
+      finally:
+        conn.close()
+
+  def handle(self, handler):
+    # runs the queued requests with handler(parts) -> answer (a dict); call
+    # from the measurement loop
+    while True:
+      try:
+        request = self.requests.get_nowait()
+      except queue.Empty:
+        return
+      if request.cancelled:
+        continue
+      try:
+        request.answer = handler(request.parts)
+      except (IOError, ValueError) as e:
+        request.answer = {'error': str(e)}
+      request.done.set()
+
+  def close(self):
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR) # wakes up accept()
+    except (IOError, OSError):
+      pass
+    self.sock.close()
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+
+def command(path, request, timeout=70):
+  # client side: sends request, returns the decoded answer
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.settimeout(timeout)
+  try:
+    sock.connect(path)
+    sock.sendall(request.encode('ascii') + b'\n')
+    return json.loads(sock.makefile('rb').readline().decode('ascii'))
+  finally:
+    sock.close()
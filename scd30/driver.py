@@ -0,0 +1,229 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# The SCD30 commands over a transport (see scd30.transport), for the
+# scripts and for other programs that want to read the sensor without
+# running one of them. Importing does nothing; the transport is passed in
+# or opened by SCD30.open() (which imports pigpio only then), so the same
+# driver runs over pigpio, /dev/i2c-N, the emulator, a trace replay or an
+# instrumented transport:
+#
+#   sensor = SCD30.open('pigpio', '127.0.0.1', 1, 0x61)
+#   sensor.start(972)
+#   (co2, temperature, humidity) = sensor.measure()
+#   sensor.close()
+#
+# Every call is one transfer (a sequence of transport ops, see
+# scd30.transport), poll() up to two. A transfer makes one transport call
+# per write and read and sleeps through the delays. Failures raise
+# SensorFault (an IOError, see scd30.recovery), as does a word with a
+# wrong crc. read_measurement() returns the raw frame instead, for callers
+# that count and repair crc errors (scd30-service.py), and poll() returns
+# None for data ready with a wrong crc. on_crc_error(data, word), if set, is
+# told of every word with a wrong crc the driver finds.
+#
+# The sensor needs at least 3 ms between a command and the read of its
+# answer (interface description, section 1.1); clock stretching does not
+# cover this gap. So every read comes COMMAND_DELAY after its command, and
+# a command with an answer is a write, a sleep and a read.
+#
+# poll() reads the measurement only once data ready says so: reading both
+# in one go would read the 18 byte frame on every poll, and a sample
+# finished between the two reads would look like the last one and be lost.
+
+import math
+import time
+
+from scd30 import codec
+from scd30.recovery import SensorFault
+
+COMMAND_DELAY = 0.003 # s from a command to the read of its answer
+READ_INTERVAL = (('w', codec.command(codec.CMD_INTERVAL)), ('d', COMMAND_DELAY), ('r', 3))
+READ_READY = (('w', codec.command(codec.CMD_DATA_READY)), ('d', COMMAND_DELAY), ('r', 3))
+READ_MEASUREMENT = (('w', codec.command(codec.CMD_READ_MEASUREMENT)), ('d', COMMAND_DELAY), ('r', 18))
+READ_CONFIG = (('w', codec.command(codec.CMD_INTERVAL)), ('d', COMMAND_DELAY), ('r', 3),
+               ('w', codec.command(codec.CMD_ASC)), ('d', COMMAND_DELAY), ('r', 3))
+STOP = (('w', codec.command(codec.CMD_STOP)),)
+RESET_TIME = 0.5 # s the sensor needs after a soft reset
+
+
+class SCD30(object):
+  __slots__ = ('bus', 'clock', 'on_crc_error')
+
+  def __init__(self, bus, clock=time, on_crc_error=None):
+    self.bus = bus
+    self.clock = clock # anything with monotonic() and sleep(), e.g. scd30.emulator.VirtualClock
+    self.on_crc_error = on_crc_error
+
+  @classmethod
+  def open(cls, kind='pigpio', host='127.0.0.1', bus=1, slave=0x61, clock=time, **kwargs):
+    # kwargs go to open_transport(), e.g. pi to pigpio; an emulated sensor
+    # runs on clock too
+    from scd30.transport import open_transport
+    if kind == 'emulator':
+      kwargs['clock'] = clock
+    return cls(open_transport(kind, host, bus, slave, **kwargs), clock)
+
+  # The sequences and what to make of their results, for callers that run
+  # them over a transport of their own (scd30.multi, scd30.aiopigpio as
+  # coroutines): READ_INTERVAL -> accept_interval(), start_ops(), READ_READY
+  # -> accept_ready(), then READ_MEASUREMENT -> accept_measurement(), STOP.
+
+  @staticmethod
+  def start_ops(pressure=0, interval=None):
+    # continuous measurement, compensated for pressure in mbar (0: none);
+    # with interval, that measurement interval in s is set first
+    ops = ()
+    if interval is not None:
+      ops += (('w', codec.command(codec.CMD_INTERVAL, interval)),)
+    return ops + (('w', codec.command(codec.CMD_START_CONT, pressure)),)
+
+  @staticmethod
+  def accept_interval(data):
+    # result of READ_INTERVAL -> s, None if its crc is wrong
+    return codec.decode_word(data)
+
+  @staticmethod
+  def accept_ready(data):
+    # result of READ_READY -> True if there is a new measurement to read
+    return codec.bad_word(data) == -1 and data[1] == 1
+
+  @staticmethod
+  def accept_measurement(data):
+    # result of READ_MEASUREMENT -> (co2, temperature, humidity), None if a
+    # crc is wrong or the values cannot be (NaN, no CO2 or no humidity)
+    values = codec.decode_measurement(data)
+    if values is None or any(math.isnan(value) for value in values) or values[0] <= 0.0 or values[2] <= 0.0:
+      return None
+    return values
+
+  def transfer(self, ops):
+    try:
+      return self.bus.transfer(ops)
+    except SensorFault:
+      raise
+    except Exception as e:
+      raise SensorFault("i2c transfer failed: " + str(e))
+
+  def check(self, data):
+    # -> True if all words of data have a good crc
+    word = codec.bad_word(data)
+    if word == -1:
+      return True
+    self.on_crc_error and self.on_crc_error(data, word)
+    return False
+
+  def read_word(self, cmd):
+    (data,) = self.transfer((('w', codec.command(cmd)), ('d', COMMAND_DELAY), ('r', 3)))
+    if not self.check(data):
+      raise SensorFault("crc error reading " + hex(cmd))
+    return codec.decode_word(data)
+
+  def write_command(self, cmd, argument=None):
+    try:
+      self.bus.write_device(codec.command(cmd, argument))
+    except Exception as e:
+      raise SensorFault("command " + hex(cmd) + ("" if argument is None else " " + str(argument)) + " failed: " + str(e))
+
+  def firmware(self):
+    # -> (major, minor)
+    version = self.read_word(codec.CMD_FIRMWARE)
+    return (version >> 8, version & 0xFF)
+
+  def interval(self):
+    return self.read_word(codec.CMD_INTERVAL)
+
+  def set_interval(self, seconds):
+    if not 2 <= seconds <= 1800:
+      raise ValueError("the interval has to be 2-1800 s")
+    self.write_command(codec.CMD_INTERVAL, seconds)
+
+  def asc(self):
+    return self.read_word(codec.CMD_ASC) == 1
+
+  def set_asc(self, on):
+    self.write_command(codec.CMD_ASC, 1 if on else 0)
+
+  def config(self):
+    # -> (interval, asc) in one transfer
+    (interval_data, asc_data) = self.transfer(READ_CONFIG)
+    if not (self.check(interval_data) and self.check(asc_data)):
+      raise SensorFault("crc error reading the configuration")
+    return (codec.decode_word(interval_data), codec.decode_word(asc_data) == 1)
+
+  def frc(self):
+    # -> the reference of the last forced recalibration, ppm
+    return self.read_word(codec.CMD_FRC)
+
+  def set_frc(self, ppm):
+    if not 400 <= ppm <= 2000:
+      raise ValueError("the reference has to be 400-2000 ppm")
+    self.write_command(codec.CMD_FRC, ppm)
+
+  def start(self, pressure=0, interval=None):
+    # see start_ops()
+    self.transfer(self.start_ops(pressure, interval))
+
+  def stop(self):
+    self.transfer(STOP)
+
+  def reset(self):
+    self.write_command(codec.CMD_SOFT_RESET)
+    self.clock.sleep(RESET_TIME)
+
+  def probe(self):
+    # -> True if the sensor answers data ready with a good crc
+    (data,) = self.transfer(READ_READY)
+    return codec.bad_word(data) == -1
+
+  def data_ready(self):
+    (data,) = self.transfer(READ_READY)
+    if not self.check(data):
+      raise SensorFault("crc error reading data ready")
+    return data[1] == 1
+
+  def read_measurement(self):
+    # -> the 18 byte frame of the last measurement
+    return self.transfer(READ_MEASUREMENT)[0]
+
+  def poll(self):
+    # -> the measurement frame if data ready says there is a new one, else
+    # None; before the first measurement the sensor NACKs the read, so
+    # this raises
+    (ready_data,) = self.transfer(READ_READY)
+    if not self.accept_ready(ready_data):
+      self.check(ready_data) # tell on_crc_error
+      return None
+    return self.read_measurement()
+
+  def measure(self, timeout=10, poll_interval=0.1):
+    # -> (co2 ppm, temperature degC, humidity %) of the next sample
+    deadline = self.clock.monotonic() + timeout
+    while not self.data_ready():
+      if self.clock.monotonic() > deadline:
+        raise SensorFault("no data within " + str(timeout) + " s", stalled=True)
+      self.clock.sleep(poll_interval)
+    values = codec.decode_measurement(self.read_measurement())
+    if values is None:
+      raise SensorFault("crc error reading the measurement")
+    return values
+
+  def close(self):
+    self.bus.close()
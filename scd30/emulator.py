@@ -0,0 +1,380 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Software model of a Sensirion SCD30 on the I2C bus.
+#
+# Answers the commands the scripts use (0x0010, 0x0104, 0x0202, 0x0300,
+# 0x4600, 0x5306, 0x5204, 0xD100, 0xD304) with correctly CRC'd words, so
+# the service loop can be run and measured without a Pi. Timing (interval,
+# drift of the sensor clock, delay of the first sample, clock stretching)
+# is configurable, and NACKs and CRC errors can be injected either randomly
+# or deterministically, as well as faults that take scd30.recovery to
+# clear: a stalled measurement (restart), a hung sensor (soft reset), a
+# broken I2C handle (reopen) and a lost pigpiod connection (reconnect).
+
+from __future__ import division
+
+import ctypes
+import errno
+import random
+import time
+
+from scd30.codec import crc8, encode_words, encode_measurement
+from scd30.transport import Transport
+
+
+class VirtualClock(object):
+  # drop-in for the time module: sleep() returns at once and advances time
+
+  def __init__(self, start=0.0):
+    self.now = start
+
+  def time(self):
+    return self.now
+
+  monotonic = time
+
+  def sleep(self, seconds):
+    if seconds > 0:
+      self.now += seconds
+
+
+def _value(source, t):
+  return source(t) if callable(source) else source
+
+
+class SCD30Emulator(object):
+  # co2, temperature and humidity may be numbers or callables taking the
+  # seconds since the sensor started measuring (from idle or a soft reset;
+  # a start while measuring, e.g. for a new pressure, only restarts the
+  # sample cycle, the readings do not settle again)
+
+  BOOT_TIME = 0.02 # seconds the device NACKs after a soft reset
+
+  def __init__(self, co2=415.0, temperature=22.0, humidity=45.0, interval=2,
+               first_sample=None, stretch=0.0, crc_error_rate=0.0, nack_rate=0.0,
+               firmware=(3, 66), asc=0, seed=None, clock=None, drift=0.0):
+    self.clock = clock or time
+    self.co2 = co2
+    self.temperature = temperature
+    self.humidity = humidity
+    self.interval = interval
+    self.first_sample = first_sample # delay of the first sample, default: interval
+    self.drift = drift # error of the sensor's own clock, e.g. 0.01: a 2 s interval takes 2.02 s
+    self.stretch = stretch # seconds every read is clock-stretched
+    self.crc_error_rate = crc_error_rate # probability a read word has a bit flipped
+    self.nack_rate = nack_rate # probability a transaction is not acknowledged
+    self.firmware = firmware
+    self.asc = asc
+    self.frc_reference = 400
+    self.frc_offset = 0.0
+    self.pressure = 0
+    self.random = random.Random(seed)
+
+    self.measuring = False
+    self.measuring_since = 0.0
+    self.start_time = 0.0 # of the sample cycle
+    self.samples_read = 0
+    self.booted_at = None # time of the last soft reset, None: powered up long ago
+    self.pending = None
+    self.last_measurement = None
+
+    self.inject_nacks_left = 0
+    self.inject_crc_left = 0
+    self.hung = False # no new samples until a soft reset
+
+    self.writes = 0
+    self.reads = 0
+    self.nacks = 0
+    self.crc_errors = 0
+    self.commands = {}
+
+  @property
+  def period(self):
+    # actual time between samples
+    return self.interval * (1.0 + self.drift)
+
+  @property
+  def transactions(self):
+    return self.writes + self.reads
+
+  def inject_nacks(self, count=1):
+    # the next count transactions fail
+    self.inject_nacks_left += count
+
+  def inject_crc_errors(self, count=1):
+    # the next count words read get a flipped bit
+    self.inject_crc_left += count
+
+  def inject_stall(self):
+    # the sensor stops measuring, e.g. after a brown-out, until started again
+    self.measuring = False
+
+  def inject_hang(self):
+    # the sensor answers, but finishes no more samples until a soft reset
+    self.hung = True
+
+  def samples_done(self, now=None):
+    if not self.measuring:
+      return 0
+    if self.hung:
+      return self.samples_read
+    now = self.clock.time() if now is None else now
+    first = self.period if self.first_sample is None else self.first_sample
+    elapsed = now - self.start_time - first
+    if elapsed < 0:
+      return 0
+    return int(elapsed // self.period) + 1
+
+  def sample_time(self, index):
+    first = self.period if self.first_sample is None else self.first_sample
+    return self.start_time + first + (index - 1) * self.period
+
+  def data_ready(self):
+    return self.samples_done() > self.samples_read
+
+  def _nack(self):
+    self.nacks += 1
+    raise IOError(errno.EREMOTEIO, "scd30 emulator: NACK")
+
+  def _check_ack(self):
+    if self.booted_at is not None and self.clock.time() < self.booted_at + self.BOOT_TIME:
+      self._nack()
+    if self.inject_nacks_left:
+      self.inject_nacks_left -= 1
+      self._nack()
+    if self.nack_rate and self.random.random() < self.nack_rate:
+      self._nack()
+
+  def _restart_cycle(self):
+    self.start_time = self.clock.time()
+    self.samples_read = 0
+    self.last_measurement = None
+
+  def measurement(self, index):
+    t = self.sample_time(index) - self.measuring_since
+    co2 = _value(self.co2, t) + self.frc_offset
+    return (co2, _value(self.temperature, t), _value(self.humidity, t))
+
+  def write(self, data):
+    self.writes += 1
+    self._check_ack()
+    data = bytearray(data)
+    if len(data) < 2:
+      self._nack()
+    command = (data[0] << 8) | data[1]
+    self.commands[command] = self.commands.get(command, 0) + 1
+    argument = None
+    if len(data) >= 5:
+      if crc8(data[2], data[3]) != data[4]:
+        self._nack()
+      argument = (data[2] << 8) | data[3]
+    self.pending = None
+
+    if command == 0x0010:
+      self.pressure = argument or 0
+      if not self.measuring:
+        self.measuring_since = self.clock.time()
+      self.measuring = True
+      self._restart_cycle()
+    elif command == 0x0104:
+      self.measuring = False
+    elif command == 0x0202:
+      self.pending = encode_words(1 if self.data_ready() else 0)
+    elif command == 0x0300:
+      done = self.samples_done()
+      if done == 0:
+        self._nack()
+      if done != self.samples_read or self.last_measurement is None:
+        self.samples_read = done
+        self.last_measurement = self.measurement(done)
+      self.pending = encode_measurement(*self.last_measurement)
+    elif command == 0x4600:
+      if argument is None:
+        self.pending = encode_words(self.interval)
+      elif 2 <= argument <= 1800:
+        self.interval = argument
+        self._restart_cycle()
+      else:
+        self._nack()
+    elif command == 0x5306:
+      if argument is None:
+        self.pending = encode_words(self.asc)
+      else:
+        self.asc = 1 if argument else 0
+    elif command == 0x5204:
+      if argument is None:
+        self.pending = encode_words(self.frc_reference)
+      else:
+        self.frc_reference = argument
+        done = max(self.samples_done(), 1)
+        t = self.sample_time(done) - self.measuring_since
+        self.frc_offset = argument - _value(self.co2, t)
+    elif command == 0xD100:
+      self.pending = encode_words((self.firmware[0] << 8) | self.firmware[1])
+    elif command == 0xD304:
+      self.booted_at = self.clock.time()
+      self.hung = False
+      if self.measuring:
+        self.measuring_since = self.clock.time()
+        self._restart_cycle()
+    else:
+      self._nack()
+
+  def read(self, n):
+    self.reads += 1
+    if self.stretch:
+      self.clock.sleep(self.stretch)
+    self._check_ack()
+    if self.pending is None:
+      self._nack()
+    data = bytearray(self.pending[:n])
+    data += bytearray([0xFF] * (n - len(data)))
+    for word in range(len(data) // 3):
+      corrupt = False
+      if self.inject_crc_left:
+        self.inject_crc_left -= 1
+        corrupt = True
+      elif self.crc_error_rate and self.random.random() < self.crc_error_rate:
+        corrupt = True
+      if corrupt:
+        self.crc_errors += 1
+        data[word * 3 + self.random.randrange(2)] ^= 1 << self.random.randrange(8)
+    return (n, data)
+
+
+class EmulatorTransport(Transport):
+  # transport (see scd30.transport) backed by an SCD30Emulator; several
+  # transports may share one emulated device. call_latency is the round
+  # trip time of a call, e.g. to pigpiod.
+
+  def __init__(self, device=None, call_latency=0.0, **kwargs):
+    self.device = device or SCD30Emulator(**kwargs)
+    self.clock = self.device.clock
+    self.call_latency = call_latency
+    self.calls = 0
+    self.busy = 0.0 # clock time spent in calls
+    self.broken = None # 'handle': calls fail until reopen(), 'connection': until reconnect()
+    self.reopens = 0
+    self.reconnects = 0
+
+  def inject_fault(self, kind):
+    self.broken = kind
+
+  def _call(self):
+    self.calls += 1
+    if self.broken:
+      raise IOError(errno.EBADF if self.broken == 'handle' else errno.ECONNRESET, "scd30 emulator: broken " + self.broken)
+    if self.call_latency:
+      self.clock.sleep(self.call_latency)
+
+  def write_device(self, data):
+    start = self.clock.time()
+    try:
+      self._call()
+      self.device.write(data)
+    finally:
+      self.busy += self.clock.time() - start
+
+  def read_device(self, n):
+    start = self.clock.time()
+    try:
+      self._call()
+      return self.device.read(n)
+    finally:
+      self.busy += self.clock.time() - start
+
+  def ready_pin(self, gpio):
+    return EmulatedReadyPin(self.device, transport=self)
+
+  def reopen(self):
+    self.reopens += 1
+    if self.broken == 'connection':
+      raise IOError(errno.ECONNRESET, "scd30 emulator: broken connection")
+    self.broken = None
+
+  def reconnect(self):
+    self.reconnects += 1
+    self.broken = None
+
+  def close(self):
+    pass
+
+
+class EmulatedReadyPin(object):
+  # simulated RDY edge source: wait() sleeps on the device clock until the
+  # emulator finishes its next measurement. stuck=True never fires, to test
+  # the fallback to polling. Like a pigpio callback, the pin stops firing
+  # once its transport has reconnected.
+
+  def __init__(self, device, stuck=False, transport=None):
+    self.device = device
+    self.stuck = stuck
+    self.transport = transport
+    self.reconnects = transport and transport.reconnects
+    self.edges = 0
+
+  def wait(self, timeout):
+    device = self.device
+    clock = device.clock
+    dead = self.transport is not None and self.transport.reconnects != self.reconnects
+    if not self.stuck and not dead and device.measuring:
+      if device.data_ready():
+        self.edges += 1
+        return True
+      due = device.sample_time(device.samples_done() + 1) - clock.time()
+      if due <= timeout:
+        clock.sleep(due + 0.001) # edge + callback latency
+        self.edges += 1
+        return True
+    clock.sleep(timeout)
+    return False
+
+  def clear(self):
+    pass # no edges are kept, wait() looks at the device
+
+  def close(self):
+    pass
+
+
+class EmulatedI2CDev(object):
+  # stands in for the kernel behind /dev/i2c-N: pass its ioctl to
+  # scd30.i2cdev.I2CDevTransport (path can be any file, e.g. os.devnull)
+
+  def __init__(self, device=None, address=0x61, **kwargs):
+    self.device = device or SCD30Emulator(**kwargs)
+    self.address = address
+    self.calls = 0
+
+  def ioctl(self, fd, request, arg):
+    from scd30.i2cdev import I2C_RDWR, I2C_M_RD
+    self.calls += 1
+    if request != I2C_RDWR:
+      raise IOError(errno.ENOTTY, "unsupported ioctl " + hex(request))
+    for i in range(arg.nmsgs):
+      msg = arg.msgs[i]
+      if msg.addr != self.address:
+        raise IOError(errno.ENXIO, "no device at " + hex(msg.addr))
+      if msg.flags & I2C_M_RD:
+        (count, data) = self.device.read(msg.len)
+        ctypes.memmove(msg.buf, bytes(data), count)
+      else:
+        self.device.write(bytearray(ctypes.string_at(msg.buf, msg.len)))
+    return 0
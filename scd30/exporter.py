@@ -0,0 +1,125 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Outputs of the service: the prometheus text file, written atomically, and
+# an optional embedded HTTP server for /metrics.
+#
+# The server sends a byte buffer that is rendered once per sample (update()),
+# so a scrape costs no formatting. HEAD and conditional GETs (If-None-Match,
+# If-Modified-Since) are answered without a body. Every connection gets a
+# daemon thread of its own, so a scraper keeping its connection open (or a
+# client that connects and sends nothing, until TIMEOUT) neither blocks
+# other scrapes nor close(). http.server takes longer
+# to import than the rest of the service, so it is imported with the first
+# MetricsServer, not by write_atomic() users.
+
+import os
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+TIMEOUT = 10 # s a connection may be idle, e.g. between keep-alive requests
+
+
+def write_atomic(path, data):
+  # readers see either the old or the new file, never a truncated one
+  tmp = path + '.tmp'
+  with open(tmp, 'wb') as f:
+    f.write(data)
+  os.rename(tmp, path)
+
+
+class MetricsResponder(object):
+  # the request handler, without its BaseHTTPRequestHandler base
+  protocol_version = 'HTTP/1.1' # keep-alive for scrapers
+  timeout = TIMEOUT
+
+  def do_GET(self):
+    self.respond(True)
+
+  def do_HEAD(self):
+    self.respond(False)
+
+  def respond(self, with_body):
+    if self.path.split('?', 1)[0] != '/metrics':
+      self.send_response(404)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    (body, etag, modified) = self.server.page
+    if body is None:
+      self.send_response(503)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    if self.headers.get('If-None-Match') == etag or self.headers.get('If-Modified-Since') == modified:
+      self.send_response(304)
+      self.send_header('ETag', etag)
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', CONTENT_TYPE)
+    self.send_header('Content-Length', str(len(body)))
+    self.send_header('ETag', etag)
+    self.send_header('Last-Modified', modified)
+    self.end_headers()
+    if with_body:
+      self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class MetricsServer(object):
+
+  def __init__(self, port, address=''):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from email.utils import formatdate
+    self.formatdate = formatdate
+    handler = type('MetricsHandler', (MetricsResponder, BaseHTTPRequestHandler), {})
+    # close() must not wait for the connection threads
+    server = type('MetricsHTTPServer', (ThreadingMixIn, HTTPServer), {'daemon_threads': True, 'block_on_close': False})
+    self.httpd = server((address, port), handler)
+    self.httpd.page = (None, None, None)
+    self.generation = 0
+    self.thread = threading.Thread(target=self.httpd.serve_forever, name='metrics-http')
+    self.thread.daemon = True
+
+  @property
+  def port(self):
+    return self.httpd.server_address[1]
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def update(self, body):
+    # body: the complete /metrics page as bytes
+    self.generation += 1
+    # one assignment, so a scrape never sees a mix of two samples
+    self.httpd.page = (body, '"' + str(self.generation) + '"', self.formatdate(time.time(), usegmt=True))
+
+  def close(self):
+    # shutdown() only stops the accept loop (and would wait forever for one
+    # that was never started); connections still open die with the process
+    if self.thread.is_alive():
+      self.httpd.shutdown()
+    self.httpd.server_close()
@@ -0,0 +1,183 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Stand-in for pigpiod's socket interface, serving emulated SCD30s
+# (scd30.emulator) over TCP, for the asyncio client (scd30.aiopigpio) and
+# the pigpio module alike. Needs python 3.7+.
+#
+# Implements the I2C commands the scripts use: open, close, read device,
+# write device and zip. Every (bus, address) opened gets a device from
+# device_factory(bus, address). Other commands (e.g. the notification setup
+# pigpio.pi() does) are answered with 0. Like pigpiod, every connection is
+# served strictly in order; latency delays each answer, as a network round
+# trip would, without holding up the requests behind it.
+
+import asyncio
+import struct
+import threading
+
+from scd30.emulator import SCD30Emulator
+
+REQUEST = struct.Struct('<IIII')
+ANSWER = struct.Struct('<IIIi')
+I2CO = 54
+I2CC = 55
+I2CRD = 56
+I2CWD = 57
+I2CZ = 92
+PI_BAD_HANDLE = -25
+PI_I2C_WRITE_FAILED = -82
+PI_I2C_READ_FAILED = -83
+
+
+class FakePigpiod(object):
+
+  def __init__(self, device_factory=None, latency=0.0):
+    self.device_factory = device_factory or (lambda bus, address: SCD30Emulator())
+    self.latency = latency
+    self.devices = {} # (bus, address) -> device
+    self.handles = {} # handle -> device
+    self.next_handle = 0
+    self.requests = 0
+    self.connections = {} # task serving a connection -> its writer
+    self.server = None
+    self.loop = None # of start_thread()
+    self.thread = None
+
+  @property
+  def port(self):
+    return self.server.sockets[0].getsockname()[1]
+
+  async def start(self, host='127.0.0.1', port=0):
+    self.server = await asyncio.start_server(self.serve, host, port)
+    return self
+
+  def start_thread(self, host='127.0.0.1', port=0):
+    # serves from an event loop of its own, e.g. for the blocking pigpio module
+    self.loop = asyncio.new_event_loop()
+    self.loop.run_until_complete(self.start(host, port))
+    self.thread = threading.Thread(target=self.loop.run_forever, name='fake-pigpiod')
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop_thread(self):
+    asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result(5)
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.thread.join(5)
+    self.loop.close()
+
+  async def stop(self):
+    self.server.close()
+    for (task, writer) in list(self.connections.items()):
+      writer.close() # ends the task with an IncompleteReadError
+    await asyncio.gather(*self.connections, return_exceptions=True)
+
+  async def serve(self, reader, writer):
+    loop = asyncio.get_event_loop()
+    outbox = asyncio.Queue()
+    sender = asyncio.ensure_future(self.send(writer, outbox))
+    task = asyncio.current_task()
+    self.connections[task] = writer
+    try:
+      while True:
+        (command, p1, p2, p3) = REQUEST.unpack(await reader.readexactly(REQUEST.size))
+        extension = await reader.readexactly(p3) if p3 else b''
+        self.requests += 1
+        (result, data) = self.execute(command, p1, p2, extension)
+        outbox.put_nowait((loop.time() + self.latency, ANSWER.pack(command, p1, p2, result) + data))
+    except (asyncio.IncompleteReadError, ConnectionError):
+      pass
+    finally:
+      self.connections.pop(task, None)
+      sender.cancel()
+      writer.close()
+
+  async def send(self, writer, outbox):
+    loop = asyncio.get_event_loop()
+    while True:
+      (due, answer) = await outbox.get()
+      delay = due - loop.time()
+      if delay > 0:
+        await asyncio.sleep(delay)
+      writer.write(answer)
+
+  def execute(self, command, p1, p2, extension):
+    # -> (result, data returned after the answer)
+    if command == I2CO:
+      key = (p1, p2)
+      if key not in self.devices:
+        self.devices[key] = self.device_factory(p1, p2)
+      handle = self.next_handle
+      self.next_handle += 1
+      self.handles[handle] = self.devices[key]
+      return (handle, b'')
+    if command in (I2CC, I2CRD, I2CWD, I2CZ):
+      device = self.handles.get(p1)
+      if device is None:
+        return (PI_BAD_HANDLE, b'')
+      if command == I2CC:
+        del self.handles[p1]
+        return (0, b'')
+      if command == I2CRD:
+        try:
+          (count, data) = device.read(p2)
+        except IOError:
+          return (PI_I2C_READ_FAILED, b'')
+        return (count, bytes(data))
+      if command == I2CWD:
+        try:
+          device.write(extension)
+        except IOError:
+          return (PI_I2C_WRITE_FAILED, b'')
+        return (0, b'')
+      return self.zip(device, bytearray(extension))
+    return (0, b'')
+
+  def zip(self, device, ops):
+    data = bytearray()
+    i = 0
+    while i < len(ops) and ops[i] != 0:
+      op = ops[i]
+      if op == 1: # escape: two byte parameter follows
+        size = ops[i + 2] | (ops[i + 3] << 8)
+        op = ops[i + 1]
+        i += 4
+      elif op in (6, 7, 4):
+        size = ops[i + 1]
+        i += 2
+      elif op == 5: # flags; addresses (4) are ignored too, one device per handle
+        i += 3
+        continue
+      else: # combined on/off
+        i += 1
+        continue
+      if op == 6:
+        try:
+          data += device.read(size)[1]
+        except IOError:
+          return (PI_I2C_READ_FAILED, b'')
+      elif op == 7:
+        try:
+          device.write(ops[i:i + size])
+        except IOError:
+          return (PI_I2C_WRITE_FAILED, b'')
+        i += size
+    return (len(data), bytes(data))
@@ -0,0 +1,163 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Forced recalibration (FRC) of many SCD30s at once, e.g. a room of sensors
+# next to a reference instrument, or carried outside together. The sensors
+# are given as for scd30.multi (NAME[:TRANSPORT[:HOST[:BUS[:SLAVE]]]]) and
+# are all read from one MultiSensorDaemon loop. Each has a Warmup of its
+# own (see scd30.warmup) and is recalibrated as soon as its own readings
+# are stable, so the fleet takes about as long as its slowest sensor, not
+# the sum of them. The sensors must not be used by a scd30-service.py
+# meanwhile; for the sensor of a running service use its control socket.
+#
+# A sensor that is already measuring at the interval is not restarted: it
+# is only sent the pressure (scd30.multi.Sensor writes the interval only if
+# it differs), its readings do not settle again and it is stable after one
+# window of samples. A sensor that was idle has to settle first; Warmup
+# judges only its newest samples once its readings have levelled off.
+#
+# After the FRC, a sensor is read for AFTER more samples (the first one is
+# skipped, it may have been measured before) to see what it did. The
+# report has, per sensor, the offset to the reference before (mean over
+# the window the FRC was based on) and after, the seconds to stable
+# readings and the residuals, or why it was not recalibrated.
+
+import time
+
+from scd30.driver import SCD30
+from scd30.multi import MultiSensorDaemon
+from scd30.warmup import Warmup
+
+AFTER = 10 # samples read after the FRC for the offset after it
+
+WARMING = 'warming up'
+CHECKING = 'checking'
+CALIBRATED = 'calibrated'
+UNSTABLE = 'not stable'
+FAILED = 'failed'
+NO_DATA = 'no data'
+
+
+class Calibration(object):
+  __slots__ = ('sensor', 'warmup', 'status', 'seconds', 'before', 'after', 'after_sum', 'after_count',
+               'residuals', 'error')
+
+  def __init__(self, sensor, warmup):
+    self.sensor = sensor
+    self.warmup = warmup
+    self.status = WARMING
+    self.seconds = None # s from the start to the FRC
+    self.before = None # ppm, mean reading minus the reference
+    self.after = None
+    self.after_sum = 0.0
+    self.after_count = -1 # the first sample after the FRC is skipped
+    self.residuals = None
+    self.error = None
+
+  @property
+  def done(self):
+    return self.status not in (WARMING, CHECKING)
+
+
+class FleetCalibration(object):
+  # sensors: scd30.multi.Sensor objects, e.g. from open_sensors(); warmup:
+  # the arguments of Warmup; timeout: s until sensors that are not stable
+  # yet are given up
+
+  def __init__(self, sensors, ppm, timeout=900, warmup=(), connections=(), clock=time, pressure=972, log=None):
+    self.ppm = ppm
+    self.pressure = pressure # mbar the sensors measure with during the frc
+    self.timeout = timeout
+    self.clock = clock
+    self.calibrations = dict((id(sensor), Calibration(sensor, Warmup(*warmup))) for sensor in sensors)
+    self.order = [self.calibrations[id(sensor)] for sensor in sensors]
+    self.daemon = MultiSensorDaemon(sensors, connections, clock, lambda last: pressure, on_sample=self.on_sample, log=log)
+    self.log = log or (lambda *args: None)
+    self.start = None
+
+  def run(self):
+    # -> the Calibrations, in the order of the sensors
+    self.start = self.clock.monotonic()
+    self.daemon.run(until=self.start + self.timeout + (AFTER + 1) * max(c.sensor.interval for c in self.order))
+    for c in self.order:
+      if c.status == WARMING:
+        c.residuals = c.warmup.residuals()
+        c.status = UNSTABLE if c.residuals['samples'] else NO_DATA
+      elif c.status == CHECKING:
+        c.status = FAILED
+        c.error = "no samples after the frc"
+    return self.order
+
+  def on_sample(self, sensor, values):
+    c = self.calibrations[id(sensor)]
+    now = self.clock.monotonic()
+    if c.status == WARMING:
+      c.warmup.add(now, values[0], values[1])
+      if c.warmup.stable():
+        self.calibrate(c, now)
+      elif now - self.start > self.timeout:
+        c.residuals = c.warmup.residuals()
+        c.status = UNSTABLE
+        self.log(sensor.name + ": readings not stable within " + str(self.timeout) + " s")
+    elif c.status == CHECKING:
+      if c.after_count >= 0:
+        c.after_sum += values[0]
+      c.after_count += 1
+      if c.after_count == AFTER:
+        c.after = c.after_sum / AFTER - self.ppm
+        c.status = CALIBRATED
+    if all(c.done for c in self.order):
+      self.daemon.stop()
+
+  def calibrate(self, c, now):
+    c.residuals = c.warmup.residuals()
+    try:
+      SCD30(c.sensor.bus, self.clock).set_frc(self.ppm)
+    except (IOError, ValueError) as e: # ValueError: ppm out of range
+      c.status = FAILED
+      c.error = "frc failed: " + str(e)
+      self.log(c.sensor.name + ": " + c.error)
+      return
+    c.seconds = now - self.start
+    c.before = c.warmup.mean(0) - self.ppm
+    c.status = CHECKING
+    self.log(c.sensor.name + ": set to " + str(self.ppm) + " ppm at " + str(self.pressure) + " mbar after {0:.0f} s, offset was {1:+.1f} ppm".format(c.seconds, c.before))
+
+  def close(self):
+    self.daemon.close()
+
+
+def report(calibrations):
+  # -> lines of text, one per sensor
+  lines = []
+  width = max([len(c.sensor.name) for c in calibrations] + [6])
+  lines.append("sensor".ljust(width) + "  status      before    after   time  co2 sd  co2 slope  T slope")
+  for c in calibrations:
+    line = c.sensor.name.ljust(width) + "  " + c.status.ljust(10)
+    line += "  {0:>6}  {1:>7}  {2:>5}".format(
+      "{0:+.1f}".format(c.before) if c.before is not None else "-",
+      "{0:+.1f}".format(c.after) if c.after is not None else "-",
+      "{0:.0f}s".format(c.seconds) if c.seconds is not None else "-")
+    if c.residuals and c.residuals['samples'] > 1:
+      line += "  {co2_sd:6.1f}  {co2_slope:9.2f}  {temperature_slope:7.3f}".format(**c.residuals)
+    if c.error:
+      line += "  " + c.error
+    lines.append(line)
+  return lines
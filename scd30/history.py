@@ -0,0 +1,207 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Recent samples in memory, with a query interface on a unix socket.
+#
+# RingBuffer keeps a fixed number of samples in array columns (float64
+# monotonic time, float32 values), e.g. 24 h at 2 s = 43200 samples in
+# 864 kB. Queries locate their range by binary search and copy only that
+# range.
+#
+# HistoryServer answers one request line per connection with one JSON line:
+#   range <start> <end>                 all samples with start <= t < end
+#   downsample <start> <end> <step>     count, mean, min, max per step seconds
+#   info                                size and capacity
+# Times are unix timestamps, or seconds relative to now if <= 0, e.g.
+#   echo "downsample -3600 0 300" | socat - UNIX-CONNECT:/run/sensors/scd30/history.sock
+
+import bisect
+import json
+import math
+import os
+import socket
+import threading
+import time
+from array import array
+
+COLUMNS = ('co2_ppm', 'temperature_degC', 'humidity_rel_percent')
+
+
+class RingBuffer(object):
+
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.t = array('d', bytes(8 * capacity))
+    self.columns = [array('f', bytes(4 * capacity)) for _ in COLUMNS]
+    self.head = 0 # slot of the next sample
+    self.size = 0
+    self.lock = threading.Lock()
+
+  @property
+  def nbytes(self):
+    return sum(column.itemsize * len(column) for column in [self.t] + self.columns)
+
+  def append(self, t, values):
+    # t must not be smaller than the t of the previous sample
+    with self.lock:
+      i = self.head
+      self.t[i] = t
+      for column, value in zip(self.columns, values):
+        column[i] = value
+      self.head = (i + 1) % self.capacity
+      if self.size < self.capacity:
+        self.size += 1
+
+  def _physical(self, logical):
+    return (self.head - self.size + logical) % self.capacity
+
+  def _bisect(self, t):
+    # logical index of the first sample at or after t
+    lo = 0
+    hi = self.size
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.t[self._physical(mid)] < t:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def _slices(self, first, last):
+    if first >= last:
+      return []
+    a = self._physical(first)
+    b = a + last - first
+    if b <= self.capacity:
+      return [(a, b)]
+    return [(a, self.capacity), (0, b - self.capacity)]
+
+  def range(self, start, end):
+    # samples with start <= t < end as columns: [times, co2, T, rH]
+    out = [array('d')] + [array('f') for _ in COLUMNS]
+    with self.lock:
+      for a, b in self._slices(self._bisect(start), self._bisect(end)):
+        out[0].extend(self.t[a:b])
+        for target, column in zip(out[1:], self.columns):
+          target.extend(column[a:b])
+    return out
+
+  def downsample(self, start, end, step):
+    # [[window start, count, co2 mean, min, max, T mean, min, max, rH ...], ...]
+    if not 0 < step < float('inf'):
+      raise ValueError("step must be a number of seconds > 0, not " + str(step))
+    columns = self.range(start, end)
+    times = columns[0]
+    rows = []
+    i = 0
+    while i < len(times):
+      window_start = start + ((times[i] - start) // step) * step
+      j = bisect.bisect_left(times, window_start + step, i)
+      row = [window_start, j - i]
+      for column in columns[1:]:
+        part = column[i:j]
+        row += [sum(part) / (j - i), min(part), max(part)]
+      rows.append(row)
+      i = j
+    return rows
+
+
+class HistoryServer(object):
+  # clock provides time() (wall) and monotonic(), as used for the buffer
+
+  def __init__(self, buffer, path, clock=time):
+    self.buffer = buffer
+    self.path = path
+    self.clock = clock
+    if os.path.exists(path):
+      os.remove(path)
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.bind(path)
+    self.sock.listen(4)
+    self.thread = threading.Thread(target=self.serve, name='history')
+    self.thread.daemon = True
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def serve(self):
+    while True:
+      try:
+        (conn, _) = self.sock.accept()
+      except (IOError, OSError):
+        return
+      try:
+        conn.settimeout(5)
+        request = conn.makefile('rb').readline(256).decode('ascii', 'replace')
+        conn.sendall(json.dumps(self.answer(request)).encode('ascii') + b'\n')
+      except Exception:
+        pass # one bad request or client must not end the server
+      finally:
+        conn.close()
+
+  def answer(self, request):
+    parts = request.split()
+    offset = self.clock.time() - self.clock.monotonic()
+    now = self.clock.monotonic()
+
+    def buffer_time(value):
+      value = float(value)
+      if math.isnan(value) or math.isinf(value):
+        raise ValueError("times must be finite, not " + str(value))
+      return now + value if value <= 0 else value - offset
+
+    try:
+      if parts[0] == 'info':
+        return {'size': self.buffer.size, 'capacity': self.buffer.capacity, 'bytes': self.buffer.nbytes}
+      if parts[0] == 'range':
+        columns = self.buffer.range(buffer_time(parts[1]), buffer_time(parts[2]))
+        result = {'time': [t + offset for t in columns[0]]}
+        for name, column in zip(COLUMNS, columns[1:]):
+          result[name] = column.tolist()
+        return result
+      if parts[0] == 'downsample':
+        rows = self.buffer.downsample(buffer_time(parts[1]), buffer_time(parts[2]), float(parts[3]))
+        for row in rows:
+          row[0] += offset
+        return {'columns': ['time', 'count'] + [name + '_' + stat for name in COLUMNS for stat in ('mean', 'min', 'max')], 'rows': rows}
+    except (IndexError, ValueError) as e:
+      return {'error': str(e)}
+    return {'error': 'unknown request, use range, downsample or info'}
+
+  def close(self):
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR) # wakes up accept()
+    except (IOError, OSError):
+      pass
+    self.sock.close()
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+
+def query(path, request):
+  # client side: sends request, returns the decoded answer
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+    sock.sendall(request.encode('ascii') + b'\n')
+    return json.loads(sock.makefile('rb').readline().decode('ascii'))
+  finally:
+    sock.close()
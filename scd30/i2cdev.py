@@ -0,0 +1,94 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Transport (see scd30.transport) talking to /dev/i2c-N directly with
+# I2C_RDWR ioctls, without pigpiod in between.
+#
+# Every read or write is one I2C_RDWR call with a single message, so each
+# message ends with a STOP (the SCD30 does not support repeated starts).
+# The message structs and data buffers are allocated once per transport.
+# ioctl can be replaced, e.g. by scd30.emulator.EmulatedI2CDev.ioctl.
+
+import ctypes
+import errno
+import os
+
+from scd30.transport import Transport
+
+I2C_RDWR = 0x0707
+I2C_M_RD = 0x0001
+BUFFER_SIZE = 64
+
+
+class I2CMsg(ctypes.Structure):
+  _fields_ = [
+    ('addr', ctypes.c_uint16),
+    ('flags', ctypes.c_uint16),
+    ('len', ctypes.c_uint16),
+    ('buf', ctypes.POINTER(ctypes.c_uint8)),
+  ]
+
+
+class I2CRdwrData(ctypes.Structure):
+  _fields_ = [
+    ('msgs', ctypes.POINTER(I2CMsg)),
+    ('nmsgs', ctypes.c_uint32),
+  ]
+
+
+class I2CDevTransport(Transport):
+
+  def __init__(self, bus=1, slave=0x61, path=None, ioctl=None):
+    if ioctl is None:
+      import fcntl
+      ioctl = fcntl.ioctl
+    self.ioctl = ioctl
+    self.path = path or '/dev/i2c-' + str(bus)
+    self.fd = os.open(self.path, os.O_RDWR)
+    self.buffer = (ctypes.c_uint8 * BUFFER_SIZE)()
+    self.view = memoryview(self.buffer).cast('B')
+    self.msg = I2CMsg(slave, 0, 0, self.buffer)
+    self.rdwr = I2CRdwrData(ctypes.pointer(self.msg), 1)
+
+  def write_device(self, data):
+    n = len(data)
+    if n > BUFFER_SIZE:
+      raise IOError(errno.EMSGSIZE, "write of " + str(n) + " B exceeds " + str(BUFFER_SIZE) + " B")
+    self.view[:n] = bytes(bytearray(data))
+    self.msg.flags = 0
+    self.msg.len = n
+    self.ioctl(self.fd, I2C_RDWR, self.rdwr)
+
+  def read_device(self, n):
+    if n > BUFFER_SIZE:
+      raise IOError(errno.EMSGSIZE, "read of " + str(n) + " B exceeds " + str(BUFFER_SIZE) + " B")
+    self.msg.flags = I2C_M_RD
+    self.msg.len = n
+    self.ioctl(self.fd, I2C_RDWR, self.rdwr)
+    return (n, bytearray(self.view[:n]))
+
+  def reopen(self):
+    self.close()
+    self.fd = os.open(self.path, os.O_RDWR)
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
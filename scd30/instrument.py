@@ -0,0 +1,141 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Self-metrics of the service: how long I2C calls, pressure reads and
+# output writes take, how often they fail, data ready polls, measurement
+# restarts and the age of a sample when it is published (from the time the
+# sensor had it ready). They are appended to the prometheus page of the
+# values, e.g.
+#   scd30_i2c_call_seconds_bucket{sensor="SCD30",op="transfer",le="0.005"} 1234
+#
+# Recording is a perf_counter() pair, a bisect and two additions per
+# event; the page is rendered once per sample. scd30-bench.py metrics
+# measures what it costs.
+
+import bisect
+import time
+
+TIMER = time.perf_counter
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0) # s
+
+
+class Histogram(object):
+  __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+  def __init__(self, buckets=BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def lines(self, name, labels):
+    out = []
+    total = 0
+    for le, count in zip(self.buckets, self.counts):
+      total += count
+      out.append(name + '_bucket{' + labels + 'le="' + repr(le) + '"} ' + str(total) + '\n')
+    out.append(name + '_bucket{' + labels + 'le="+Inf"} ' + str(self.count) + '\n')
+    out.append(name + '_sum{' + labels.rstrip(',') + '} ' + repr(self.sum) + '\n')
+    out.append(name + '_count{' + labels.rstrip(',') + '} ' + str(self.count) + '\n')
+    return out
+
+
+class Metrics(object):
+  # labels: put on every series, e.g. 'sensor="SCD30"'
+
+  def __init__(self, labels='sensor="SCD30"'):
+    self.labels = labels
+    self.histograms = {} # (name, labels) -> Histogram
+    self.counters = {} # (name, labels) -> number
+    self.types = {} # name -> prometheus type
+
+  def histogram(self, name, labels='', buckets=BUCKETS):
+    key = (name, labels)
+    if key not in self.histograms:
+      self.histograms[key] = Histogram(buckets)
+      self.types[name] = 'histogram'
+    return self.histograms[key]
+
+  def inc(self, name, labels='', n=1):
+    key = (name, labels)
+    self.counters[key] = self.counters.get(key, 0) + n
+    if name not in self.types:
+      self.types[name] = 'counter'
+
+  def set(self, name, labels='', value=0, kind='counter'):
+    # for counts kept elsewhere, e.g. by scd30.recovery
+    self.counters[(name, labels)] = value
+    self.types.setdefault(name, kind)
+
+  def text(self):
+    out = []
+    typed = set()
+    series = [(name, labels, self.counters[(name, labels)]) for (name, labels) in self.counters]
+    series += [(name, labels, h) for ((name, labels), h) in self.histograms.items() if h.count] # unused calls left out
+    for (name, labels, value) in sorted(series, key=lambda s: (s[0], s[1])):
+      if name not in typed:
+        out.append('# TYPE ' + name + ' ' + self.types.get(name, 'counter') + '\n')
+        typed.add(name)
+      all_labels = ','.join(l for l in (self.labels, labels) if l)
+      if isinstance(value, Histogram):
+        out += value.lines(name, all_labels + ',' if all_labels else '')
+      else:
+        out.append(name + '{' + all_labels + '} ' + repr(value) + '\n')
+    return ''.join(out)
+
+
+class InstrumentedTransport(object):
+  # wraps a transport (see scd30.transport) and times each call; failed
+  # calls (NACKs, lost connections) are counted per kind of call
+
+  def __init__(self, bus, metrics, timer=TIMER):
+    self.bus = bus
+    self.metrics = metrics
+    self.timer = timer
+    self.latency = dict((op, metrics.histogram('scd30_i2c_call_seconds', 'op="' + op + '"'))
+                        for op in ('write', 'read', 'transfer'))
+
+  def call(self, op, function, *args):
+    start = self.timer()
+    try:
+      return function(*args)
+    except Exception:
+      self.metrics.inc('scd30_i2c_errors_total', 'op="' + op + '"')
+      raise
+    finally:
+      self.latency[op].observe(self.timer() - start)
+
+  def write_device(self, data):
+    return self.call('write', self.bus.write_device, data)
+
+  def read_device(self, n):
+    return self.call('read', self.bus.read_device, n)
+
+  def transfer(self, ops):
+    return self.call('transfer', self.bus.transfer, ops)
+
+  def __getattr__(self, name):
+    # close(), reopen(), ready_pin(), ... of the wrapped transport
+    return getattr(self.bus, name)
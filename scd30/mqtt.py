@@ -0,0 +1,219 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# MQTT output of the service.
+#
+# MQTTSink takes samples from the service loop through a bounded queue and
+# publishes them from its own thread, batch_size samples per message (or
+# whatever arrived within batch_interval seconds), over one persistent
+# connection. While the broker is unreachable, batches are appended to a
+# spool file as compact binary records; on reconnect the spool is sent in
+# bulk, drain_size samples per message, before new data. A batch that
+# fails with an OSError (e.g. a spool on a full or read-only SD card) is
+# logged and counted as dropped; the thread carries on with the next one.
+#
+# Payloads: 'json'   {"sensor": "SCD30", "samples": [[unix time, co2, T, rH], ...]}
+#           'binary' little endian records of RECORD (time as float64)
+#
+# A connection has connected(), publish(topic, payload) -> True if handed
+# over, and close(): PahoConnection for a real broker (needs paho-mqtt),
+# MemoryBroker as in-process stand-in.
+
+import json
+import os
+import struct
+import threading
+import time
+
+import queue
+
+RECORD = struct.Struct('<dfff')
+_FLUSH = object()
+_STOP = object()
+
+
+class PahoConnection(object):
+
+  def __init__(self, host, port=1883, client_id='', keepalive=60):
+    import paho.mqtt.client as mqtt # aptitude install python3-paho-mqtt
+    try:
+      self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id)
+    except AttributeError: # paho-mqtt < 2
+      self.client = mqtt.Client(client_id)
+    self.client.max_queued_messages_set(100)
+    self.client.reconnect_delay_set(1, 60)
+    self.client.connect_async(host, port, keepalive)
+    self.client.loop_start()
+
+  def connected(self):
+    return self.client.is_connected()
+
+  def publish(self, topic, payload):
+    return self.client.publish(topic, payload, qos=1).rc == 0
+
+  def close(self):
+    self.client.disconnect()
+    self.client.loop_stop()
+
+
+class MemoryBroker(object):
+  # set online to simulate outages; messages keeps what was published
+
+  def __init__(self):
+    self.online = True
+    self.messages = []
+
+  def connected(self):
+    return self.online
+
+  def publish(self, topic, payload):
+    if not self.online:
+      return False
+    self.messages.append((topic, payload))
+    return True
+
+  def close(self):
+    pass
+
+
+class MQTTSink(object):
+
+  def __init__(self, connection, topic, sensor='SCD30', payload='json', batch_size=30, batch_interval=60,
+               queue_size=1000, spool=None, spool_max_bytes=16 << 20, drain_size=1000, log=None):
+    self.connection = connection
+    self.topic = topic
+    self.sensor = sensor
+    self.encode = self.encode_binary if payload == 'binary' else self.encode_json
+    self.batch_size = batch_size
+    self.batch_interval = batch_interval
+    self.queue = queue.Queue(queue_size)
+    self.spool = spool # path of the spool file, None: drop batches while offline
+    self.spool_max_bytes = spool_max_bytes
+    self.drain_size = drain_size
+    self.published = 0 # samples
+    self.messages = 0
+    self.spooled = 0 # samples
+    self.dropped = 0 # samples
+    self.log = log or (lambda *args: None)
+    self.thread = threading.Thread(target=self.run, name='mqtt')
+    self.thread.daemon = True
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def put(self, t, values):
+    # called by the service loop, never blocks
+    try:
+      self.queue.put_nowait((t, values[0], values[1], values[2]))
+    except queue.Full:
+      self.dropped += 1
+
+  def flush(self):
+    # send everything queued so far and wait until done
+    self.queue.put(_FLUSH)
+    self.queue.join()
+
+  def close(self):
+    if self.thread.is_alive():
+      self.queue.put(_STOP)
+      self.thread.join(10)
+    self.connection.close()
+
+  def encode_json(self, samples):
+    rows = [[round(t, 3), round(co2, 2), round(T, 2), round(rH, 2)] for (t, co2, T, rH) in samples]
+    return json.dumps({'sensor': self.sensor, 'samples': rows}, separators=(',', ':')).encode('utf-8')
+
+  def encode_binary(self, samples):
+    return b''.join(RECORD.pack(*sample) for sample in samples)
+
+  def run(self):
+    batch = []
+    deadline = None
+    while True:
+      timeout = max(0, deadline - time.time()) if batch else None
+      try:
+        item = self.queue.get(timeout=timeout)
+      except queue.Empty:
+        item = None
+      try:
+        if item is _STOP:
+          self.send(batch)
+          return
+        if item is _FLUSH:
+          self.send(batch)
+          batch = []
+        elif item is not None:
+          if not batch:
+            deadline = time.time() + self.batch_interval
+          batch.append(item)
+        if batch and (len(batch) >= self.batch_size or time.time() >= deadline):
+          self.send(batch)
+          batch = []
+      finally:
+        # flush() must not wait forever, whatever happened to the batch
+        if item is not None:
+          self.queue.task_done()
+
+  def send(self, samples):
+    try:
+      if self.connection.connected():
+        self.drain()
+        if not samples or self.publish(samples):
+          return
+      self.spool_write(samples)
+    except OSError as e:
+      self.dropped += len(samples)
+      self.log("mqtt: " + str(len(samples)) + " samples dropped: " + str(e))
+
+  def publish(self, samples):
+    if not self.connection.publish(self.topic, self.encode(samples)):
+      return False
+    self.published += len(samples)
+    self.messages += 1
+    return True
+
+  def spool_write(self, samples):
+    if not samples:
+      return
+    if not self.spool or (os.path.exists(self.spool) and os.path.getsize(self.spool) >= self.spool_max_bytes):
+      self.dropped += len(samples)
+      return
+    with open(self.spool, 'ab') as f:
+      f.write(b''.join(RECORD.pack(*sample) for sample in samples))
+    self.spooled += len(samples)
+
+  def drain(self):
+    if not self.spool or not os.path.exists(self.spool):
+      return
+    with open(self.spool, 'rb') as f:
+      while True:
+        chunk = f.read(self.drain_size * RECORD.size)
+        if len(chunk) < RECORD.size:
+          break
+        samples = [RECORD.unpack_from(chunk, offset) for offset in range(0, len(chunk) - RECORD.size + 1, RECORD.size)]
+        if not self.publish(samples):
+          # keep what was not sent yet
+          rest = chunk + f.read()
+          with open(self.spool + '.tmp', 'wb') as tmp:
+            tmp.write(rest)
+          os.rename(self.spool + '.tmp', self.spool)
+          return
+    os.remove(self.spool)
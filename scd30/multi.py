@@ -0,0 +1,291 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Many SCD30s in one process: sensors on several buses (e.g. the channels of
+# an I2C mux, which the kernel exposes as /dev/i2c-N each) and on several
+# pigpio hosts, all driven from one single-threaded loop.
+#
+# Every sensor is a small state object; the loop keeps them in a heap by the
+# time of their next poll and sleeps until the earliest one is due, so an
+# idle daemon costs no CPU and each extra sensor costs a few kB and its own
+# I2C transfers, not an interpreter. Sensors on the same pigpio host share
+# one pigpiod connection. Start times are staggered over the interval so
+# the polls of different sensors do not bunch up.
+#
+# A sensor is given as NAME[:TRANSPORT[:HOST[:BUS[:SLAVE]]]], empty fields
+# take the defaults, e.g. kitchen:pigpio:pi2.local:1:0x61 or office:::3.
+# Its values go to <folder>/<NAME>/last with an extra name="NAME" label.
+# A failing sensor is restarted after RETRY s, the others carry on. If
+# pigpiod was restarted meanwhile, the shared connection is replaced.
+
+import heapq
+import os
+import time
+
+from scd30.aggregate import WindowAggregate
+from scd30.driver import READ_INTERVAL, READ_MEASUREMENT, READ_READY, SCD30
+from scd30.exporter import write_atomic
+from scd30.schedule import PhaseLock
+from scd30.transport import open_transport
+
+RETRY = 5 # s until a failed sensor is started again
+
+
+def parse_sensor(spec, transport='pigpio', host='127.0.0.1', bus=1, slave=0x61):
+  # -> (name, transport, host, bus, slave)
+  fields = spec.split(':') + [''] * 4
+  if not fields[0] or len(fields) > 9:
+    raise ValueError("sensor must be NAME[:TRANSPORT[:HOST[:BUS[:SLAVE]]]], not " + repr(spec))
+  return (fields[0], fields[1] or transport, fields[2] or host,
+          int(fields[3]) if fields[3] else bus, int(fields[4], 0) if fields[4] else slave)
+
+
+class Sensor(object):
+  __slots__ = ('name', 'bus', 'path', 'interval', 'template', 'aggregate', 'pressure',
+               'misses', 'samples', 'errors', 'page', 'phase')
+
+  def __init__(self, name, bus, path, interval=2, aggregate_window=60, clock=time):
+    self.name = name
+    self.bus = bus
+    self.path = path # output file, None: none
+    self.interval = interval
+    label = 'sensor="SCD30",name="' + name.replace('"', '') + '"'
+    series = [('gas_ppm', '{' + label + ',gas="CO2"}'), ('temperature_degC', '{' + label + '}'), ('humidity_rel_percent', '{' + label + '}')]
+    self.template = ''.join(metric + labels.replace('{', '{{').replace('}', '}}') + ' {' + str(i) + ':.8f}\n'
+                            for i, (metric, labels) in enumerate(series))
+    self.aggregate = WindowAggregate(series, aggregate_window) if aggregate_window else None
+    self.pressure = None # mbar the measurement runs with, None: not started
+    self.misses = 0 # polls without new data in a row
+    self.samples = 0
+    self.errors = 0
+    self.page = b''
+    self.phase = PhaseLock(interval, clock) # when to poll next
+
+  # start() and poll() are split into the transfers and what to make of
+  # their results (see scd30.driver), so scd30.aiopigpio can run the same
+  # steps as coroutines
+
+  def start(self, pressure):
+    (data,) = self.bus.transfer(READ_INTERVAL)
+    self.bus.transfer(self.start_ops(data, pressure))
+    self.started(pressure)
+
+  def start_ops(self, interval_data, pressure):
+    # the interval is only written if the sensor has another one
+    keep = SCD30.accept_interval(interval_data) == self.interval
+    return SCD30.start_ops(pressure, None if keep else self.interval)
+
+  def started(self, pressure):
+    self.pressure = pressure
+    self.misses = 0
+    self.phase.reset()
+
+  def poll(self):
+    (ready_data,) = self.bus.transfer(READ_READY)
+    if not SCD30.accept_ready(ready_data):
+      return None
+    (data,) = self.bus.transfer(READ_MEASUREMENT)
+    return self.accept(data)
+
+  def accept(self, data):
+    # result of READ_MEASUREMENT -> (co2, T, rH), None if unusable
+    self.phase.ready()
+    return SCD30.accept_measurement(data)
+
+  def missed(self):
+    # counts a poll without data -> True if the sensor should be restarted
+    self.phase.missed()
+    self.misses += 1
+    if self.misses > 20 * self.interval:
+      self.pressure = None
+      return True
+    return False
+
+  def publish(self, t, values):
+    text = self.template.format(*values)
+    if self.aggregate:
+      self.aggregate.add(t, values)
+      text += self.aggregate.text
+    self.page = text.encode('utf-8')
+    self.path and write_atomic(self.path, self.page)
+    self.samples += 1
+
+  def stop(self):
+    try:
+      SCD30(self.bus).stop()
+    except IOError:
+      pass
+    self.path and os.path.isfile(self.path) and os.remove(self.path)
+    self.bus.close()
+
+
+def output_path(folder, name):
+  if not folder:
+    return None
+  directory = os.path.join(folder, name)
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  return os.path.join(directory, 'last')
+
+
+def connected(pi):
+  # -> False if the pigpiod connection pi is dead, e.g. pigpiod restarted
+  try:
+    pi.get_current_tick()
+    return True
+  except Exception:
+    return False
+
+
+def open_sensors(specs, folder, interval=2, aggregate_window=60, clock=time, **kwargs):
+  # specs: parse_sensor() tuples; clock and kwargs go to emulator transports too
+  # -> (sensors, shared pigpio connections)
+  sensors = []
+  connections = {} # pigpio host -> shared pigpio.pi
+  for (name, transport, host, bus, slave) in specs:
+    if transport == 'pigpio':
+      if host not in connections:
+        import pigpio # aptitude install python3-pigpio
+        connections[host] = pigpio.pi(host)
+        if not connections[host].connected:
+          raise IOError("no connection to pigpio daemon at " + host + ".")
+      bus = open_transport(transport, host, bus, slave, pi=connections[host])
+    elif transport == 'emulator':
+      bus = open_transport(transport, host, bus, slave, clock=clock, **kwargs)
+    else:
+      bus = open_transport(transport, host, bus, slave)
+    sensors.append(Sensor(name, bus, output_path(folder, name), interval, aggregate_window, clock))
+  return (sensors, list(connections.values()))
+
+
+class MultiSensorDaemon(object):
+  # pressure(last mbar) -> mbar is asked once per interval, all sensors are
+  # restarted with a new value; exporter (scd30.exporter.MetricsServer)
+  # gets the pages of all sensors
+
+  def __init__(self, sensors, connections=(), clock=time, pressure=None, exporter=None, on_sample=None, log=None):
+    self.sensors = sensors
+    self.connections = list(connections)
+    self.clock = clock
+    self.get_pressure = pressure
+    self.pressure = 972 # 300 metres above sea level
+    self.pressure_checked = None
+    self.exporter = exporter
+    self.on_sample = on_sample # on_sample(sensor, values)
+    self.log = log or (lambda *args: None)
+    self.samples = 0
+    self.stopped = False
+
+  def run(self, max_samples=None, until=None):
+    # until: monotonic time to return at the latest
+    now = self.clock.monotonic()
+    count = len(self.sensors)
+    interval = max(sensor.interval for sensor in self.sensors) if count else 0
+    heap = [(now + i * interval / float(count), i, sensor) for i, sensor in enumerate(self.sensors)]
+    while heap and not self.stopped and (max_samples is None or self.samples < max_samples):
+      (due, i, sensor) = heap[0]
+      if until is not None and due > until:
+        break
+      wait = due - self.clock.monotonic()
+      if wait > 0:
+        self.clock.sleep(wait)
+      heapq.heapreplace(heap, (self.step(sensor), i, sensor))
+    return self.samples
+
+  def check_pressure(self, now):
+    if self.get_pressure and (self.pressure_checked is None or now - self.pressure_checked >= self.sensors[0].interval):
+      self.pressure_checked = now
+      self.pressure = self.get_pressure(self.pressure)
+
+  def step(self, sensor):
+    # one poll of one sensor -> monotonic time of its next poll
+    now = self.clock.monotonic()
+    self.check_pressure(now)
+    try:
+      if sensor.pressure != self.pressure:
+        restart = sensor.pressure is not None
+        sensor.start(self.pressure)
+        self.log(sensor.name + (": pressure compensation changed to " if restart else ": started with ") + str(self.pressure) + " mbar")
+        return sensor.phase.due()
+      values = sensor.poll()
+    except Exception as e:
+      sensor.errors += 1
+      if self.reconnect(sensor):
+        return now # started again with the next step
+      if sensor.pressure is None:
+        self.log(sensor.name + ": start failed (" + str(e) + "), retrying in " + str(RETRY) + " s")
+        return now + RETRY
+      values = None # e.g. NACK before the first sample
+    if values is None:
+      if sensor.missed():
+        self.log(sensor.name + ": " + str(sensor.misses) + " polls without data, restarting")
+        return now + RETRY
+      return sensor.phase.due()
+    sensor.misses = 0
+    sensor.publish(self.clock.time(), values)
+    if self.exporter:
+      self.exporter.update(b''.join(s.page for s in self.sensors))
+    self.samples += 1
+    self.on_sample and self.on_sample(sensor, values)
+    return sensor.phase.due()
+
+  def reconnect(self, sensor):
+    # after a restart of pigpiod, the connection the sensor shares with the
+    # others on its host is dead, and so are their handles: all of them
+    # carry on over a new one. -> True if the connection was replaced
+    old = getattr(sensor.bus, 'pi', None)
+    if old not in self.connections:
+      return False
+    if connected(old):
+      if sensor.bus.handle is None: # its open failed at the last reconnect
+        try:
+          sensor.bus.attach(old)
+        except Exception:
+          pass
+      return False
+    import pigpio
+    pi = pigpio.pi(sensor.bus.host)
+    if not pi.connected:
+      self.log(sensor.name + ": no connection to pigpio daemon at " + sensor.bus.host)
+      return False
+    self.connections[self.connections.index(old)] = pi
+    for other in self.sensors:
+      if getattr(other.bus, 'pi', None) is old:
+        try:
+          other.bus.attach(pi)
+        except Exception as e:
+          self.log(other.name + ": open failed after reconnect (" + str(e) + ")")
+        other.pressure = None # its measurement may have been lost too, start it again
+    try:
+      old.stop()
+    except Exception:
+      pass
+    self.log("reconnected to pigpio daemon at " + sensor.bus.host)
+    return True
+
+  def stop(self):
+    # run() returns after the current step, e.g. from on_sample
+    self.stopped = True
+
+  def close(self):
+    for sensor in self.sensors:
+      sensor.stop()
+    for pi in self.connections:
+      pi.stop()
@@ -0,0 +1,317 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Ambient pressure for the SCD30's compensation, from the prometheus files
+# of other sensor services (e.g. /run/sensors/bme280/last) and optionally
+# from a unix datagram socket, for sources that are not files.
+#
+# A background thread waits for changes - inotify on the files'
+# directories, or a stat of the files every poll_interval s where inotify is
+# not available - and parses a file only when it was written. get() just
+# returns the value kept in memory, so the measurement loop makes no
+# syscalls for the pressure at all.
+#
+# Files are listed in order of preference; a file that disappears no
+# longer counts, its last value is forgotten. Datagrams on the socket are
+# a number or a pressure_hPa line in hPa, e.g.
+#   echo "pressure_hPa 1013.2" | socat - UNIX-SENDTO:/run/sensors/scd30/pressure.sock
+# and win over the files for max_age s.
+#
+# Every new compensation value restarts the sensor's measurement cycle and
+# costs a sample, while 1 hPa changes the CO2 reading by only about 0.1 %
+# (the accuracy is +-(30 ppm + 3 %)). PressureFilter therefore smooths the
+# readings and lets a new value through only if it is off by threshold hPa
+# and the last restart is min_interval s ago.
+
+import ctypes
+import errno
+import math
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_IGNORED = 0x8000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT = struct.Struct('iIII') # wd, mask, cookie, name length
+
+
+def parse_pressure(data):
+  # bytes of a prometheus file or a datagram -> pressure in hPa (int), None if there is none
+  for line in data.splitlines():
+    fields = line.split()
+    if len(fields) > 1 and fields[0].startswith(b'pressure_hPa'):
+      value = fields[1]
+    elif len(fields) == 1:
+      value = fields[0]
+    else:
+      continue
+    try:
+      pressure = int(float(value))
+    except ValueError:
+      continue
+    if pressure > 300:
+      return pressure
+  return None
+
+
+class Inotify(object):
+
+  def __init__(self):
+    try:
+      self.libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    except OSError: # not glibc; find_library() runs ldconfig, and ctypes.util takes long to import
+      from ctypes.util import find_library
+      self.libc = ctypes.CDLL(find_library('c'), use_errno=True)
+    self.fd = self.libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+  def watch(self, path, mask=WATCH_MASK):
+    wd = self.libc.inotify_add_watch(self.fd, path.encode('utf-8'), mask)
+    if wd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_add_watch " + path + " failed")
+    return wd
+
+  def read(self):
+    # -> [(wd, mask, name), ...] of the pending events
+    events = []
+    try:
+      data = os.read(self.fd, 4096)
+    except OSError as e:
+      if e.errno == errno.EAGAIN:
+        return events
+      raise
+    offset = 0
+    while offset + EVENT.size <= len(data):
+      (wd, mask, _, length) = EVENT.unpack_from(data, offset)
+      offset += EVENT.size
+      name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+      offset += length
+      events.append((wd, mask, name))
+    return events
+
+  def close(self):
+    os.close(self.fd)
+
+
+class FileSource(object):
+
+  def __init__(self, path):
+    self.path = path
+    self.directory = os.path.dirname(path)
+    self.name = os.path.basename(path)
+    self.value = None
+    self.stat = None # (inode, size, mtime) when polling without inotify
+    self.loads = 0
+
+  def load(self):
+    self.loads += 1
+    try:
+      with open(self.path, 'rb') as f:
+        data = f.read()
+    except (IOError, OSError):
+      self.value = None
+      return
+    value = parse_pressure(data)
+    if value is not None:
+      self.value = value
+
+  def changed(self):
+    # without inotify: stat the file -> True if it was written since the last call
+    try:
+      st = os.stat(self.path)
+      current = (st.st_ino, st.st_size, st.st_mtime)
+    except OSError:
+      current = None
+    if current == self.stat:
+      return False
+    self.stat = current
+    return True
+
+
+class PressureInput(object):
+
+  def __init__(self, paths=(), socket_path=None, poll_interval=5, max_age=600, clock=time):
+    self.files = [FileSource(path) for path in paths]
+    self.poll_interval = poll_interval # s between stats without inotify, and retries of missing directories
+    self.max_age = max_age
+    self.clock = clock
+    self.socket_value = None
+    self.socket_time = None
+    self.socket_path = socket_path
+    self.socket = None
+    if socket_path:
+      if os.path.exists(socket_path):
+        os.remove(socket_path)
+      self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      self.socket.bind(socket_path)
+    try:
+      self.inotify = Inotify()
+    except (OSError, AttributeError): # no inotify: not linux, or an old libc
+      self.inotify = None
+    self.watches = {} # wd -> directory
+    for source in self.files:
+      source.changed()
+      source.load()
+    (self.wake_read, self.wake_write) = os.pipe()
+    self.stopped = False
+    self.thread = threading.Thread(target=self.serve, name='pressure')
+    self.thread.daemon = True
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def get(self, last=None):
+    # pressure in hPa (= mbar), last if no source has one
+    if self.socket_value is not None and self.clock.time() - self.socket_time < self.max_age:
+      return self.socket_value
+    for source in self.files:
+      if source.value is not None:
+        return source.value
+    return last
+
+  def watch_directories(self):
+    # -> True if all directories are watched
+    if not self.inotify:
+      return False
+    watched = set(self.watches.values())
+    complete = True
+    for directory in set(source.directory for source in self.files) - watched:
+      try:
+        self.watches[self.inotify.watch(directory)] = directory
+      except OSError:
+        complete = False
+        continue
+      for source in self.files:
+        if source.directory == directory:
+          source.load() # written before the watch
+    return complete
+
+  def serve(self):
+    poller = select.poll()
+    poller.register(self.wake_read, select.POLLIN)
+    if self.inotify:
+      poller.register(self.inotify.fd, select.POLLIN)
+    if self.socket:
+      poller.register(self.socket.fileno(), select.POLLIN)
+    complete = self.watch_directories()
+    while not self.stopped:
+      timeout = None if complete else self.poll_interval * 1000
+      for (fd, _) in poller.poll(timeout):
+        if self.inotify and fd == self.inotify.fd:
+          self.handle_events(self.inotify.read())
+        elif self.socket and fd == self.socket.fileno():
+          value = parse_pressure(self.socket.recv(256))
+          if value is not None:
+            (self.socket_value, self.socket_time) = (value, self.clock.time())
+      if self.inotify:
+        complete = self.watch_directories()
+      else:
+        for source in self.files:
+          if source.changed():
+            source.load()
+
+  def handle_events(self, events):
+    for (wd, mask, name) in events:
+      directory = self.watches.get(wd)
+      if directory is None:
+        continue
+      if mask & (IN_DELETE_SELF | IN_IGNORED):
+        del self.watches[wd] # watched again once it is back
+        for source in self.files:
+          if source.directory == directory:
+            source.value = None
+        continue
+      for source in self.files:
+        if source.directory == directory and source.name == name:
+          source.load()
+
+  def close(self):
+    if self.stopped:
+      return
+    self.stopped = True
+    os.write(self.wake_write, b'x')
+    if self.thread.is_alive():
+      self.thread.join(5)
+    os.close(self.wake_read)
+    os.close(self.wake_write)
+    self.inotify and self.inotify.close()
+    if self.socket:
+      self.socket.close()
+      if os.path.exists(self.socket_path):
+        os.remove(self.socket_path)
+
+
+class PressureFilter(object):
+  # update(reading, applied) -> mbar to run the measurement with. Counts
+  # restarts, restarts_avoided (the reading changed, but the sensor was not
+  # restarted for it) and samples_lost (to restarts, added by the caller).
+
+  def __init__(self, threshold=5, min_interval=600, smoothing=60, clock=time):
+    self.threshold = threshold # hPa
+    self.min_interval = min_interval # s between restarts
+    self.smoothing = smoothing # s, time constant of the moving average, 0: off
+    self.clock = clock
+    self.smoothed = None
+    self.reading = None
+    self.updated = None
+    self.restarted = None
+    self.restarts = 0
+    self.restarts_avoided = 0
+    self.samples_lost = 0
+
+  def seed(self, applied):
+    # the measurement already runs with applied, e.g. when the service
+    # resumes it, so the first reading is held to the threshold too
+    self.smoothed = float(applied)
+    self.reading = applied
+    self.updated = self.clock.monotonic()
+
+  def update(self, reading, applied):
+    if reading is None:
+      return applied
+    now = self.clock.monotonic()
+    first = self.updated is None
+    if first or not self.smoothing:
+      self.smoothed = float(reading)
+    else:
+      weight = 1 - math.exp(-max(0.0, now - self.updated) / self.smoothing)
+      self.smoothed += weight * (reading - self.smoothed)
+    self.updated = now
+    changed = not first and reading != self.reading
+    self.reading = reading
+    target = int(round(self.smoothed))
+    if target == applied or not first and (abs(self.smoothed - applied) < self.threshold or
+                                           self.restarted is not None and now - self.restarted < self.min_interval):
+      self.restarts_avoided += changed and reading != applied
+      return applied
+    self.restarted = now
+    self.restarts += 1
+    return target
@@ -0,0 +1,143 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Recovery from I2C faults inside the service, instead of exiting and
+# having systemd start it again (which re-runs i2cdetect, reconnects to
+# pigpiod, reconfigures the sensor and loses the phase of its samples).
+#
+# The service raises SensorFault where it used to exit. Recovery then
+# walks up a ladder of steps, each a delay (backoff), an action and a
+# probe whether the sensor answers again:
+#   retry      nothing, just wait (NACKs while the sensor is busy, noise)
+#   reopen     close and open the I2C handle again
+#   reset      soft reset (0xD304); the SCD30 keeps measuring afterwards
+#   reconnect  a new connection to pigpiod (or /dev/i2c-N)
+# The position on the ladder is kept until the next good sample, so a
+# fault that comes back at once is met with the next step. Once the
+# ladder is used up, recover() returns None and the service exits after
+# all.
+#
+# A stalled measurement (the sensor answers, but has had no data for too
+# long) is met with a soft reset right away, which also clears a hung
+# sensor, and restarted by the service; waiting for a second stall to
+# find out whether a restart alone would have done costs more. Other
+# faults leave the measurement running.
+#
+# Per level, attempts, recoveries and the mean time from the fault to the
+# next good sample (mean time to recover) are counted.
+
+import time
+
+LEVELS = ('retry', 'reopen', 'reset', 'reconnect')
+LADDER = (('retry', 0.1), ('reopen', 0.1), ('retry', 1), ('reset', 0.1),
+          ('reconnect', 0.5), ('reconnect', 5), ('reconnect', 30)) # (level, s to wait before)
+STALL_LEVELS = ('reset',) # the bus works, so only a reset (and the restart after it) can help
+
+
+class SensorFault(IOError):
+
+  def __init__(self, message, stalled=False):
+    IOError.__init__(self, message)
+    self.stalled = stalled # the sensor answers, but delivers no samples
+
+
+class LevelStats(object):
+  __slots__ = ('attempts', 'recoveries', 'recover_time')
+
+  def __init__(self):
+    self.attempts = 0
+    self.recoveries = 0 # faults resolved at this level, counted at the next good sample
+    self.recover_time = 0.0 # s from the fault to that sample, summed up
+
+  @property
+  def mttr(self):
+    return self.recover_time / self.recoveries if self.recoveries else float('nan')
+
+
+class Recovery(object):
+  # actions: level -> callable (missing levels are skipped), probe() -> True
+  # if the sensor answers; both may raise
+
+  def __init__(self, actions, probe, ladder=LADDER, clock=time, log=None):
+    self.actions = actions
+    self.probe = probe
+    self.ladder = [(level, delay) for (level, delay) in ladder if level in actions]
+    self.clock = clock
+    self.log = log or (lambda *args: None)
+    self.stats = dict((level, LevelStats()) for level in LEVELS)
+    self.faults = 0
+    self.given_up = 0
+    self.position = 0 # next step of the ladder
+    self.fault_time = None # monotonic time of the first fault not yet recovered from
+    self.level = None # level that made the sensor answer again
+
+  def recover(self, fault):
+    # -> level at which the sensor answers again, None: ladder used up
+    self.faults += 1
+    if self.fault_time is None:
+      self.fault_time = self.clock.monotonic()
+    elif fault.stalled and self.level:
+      # the sensor answered at this level, but still delivers nothing
+      while self.position < len(self.ladder) and self.ladder[self.position][0] == self.level:
+        self.position += 1
+    while self.position < len(self.ladder):
+      (level, delay) = self.ladder[self.position]
+      self.position += 1
+      if fault.stalled and level not in STALL_LEVELS:
+        continue
+      self.stats[level].attempts += 1
+      self.clock.sleep(delay)
+      try:
+        self.actions[level]()
+        answers = self.probe()
+      except Exception as e:
+        self.log(level + " failed: " + str(e))
+        answers = False
+      if answers:
+        self.level = level
+        return level
+    self.given_up += 1
+    self.reset()
+    return None
+
+  def sample(self):
+    # call on every good sample -> s it took to recover, None if there was no fault
+    if self.fault_time is None:
+      return None
+    elapsed = self.clock.monotonic() - self.fault_time
+    stats = self.stats[self.level]
+    stats.recoveries += 1
+    stats.recover_time += elapsed
+    self.reset()
+    return elapsed
+
+  def reset(self):
+    self.position = 0
+    self.fault_time = None
+    self.level = None
+
+  def summary(self):
+    parts = []
+    for level in LEVELS:
+      stats = self.stats[level]
+      if stats.attempts:
+        parts.append(level + " " + str(stats.recoveries) + "/" + str(stats.attempts) +
+                     (" mttr {0:.1f} s".format(stats.mttr) if stats.recoveries else ""))
+    return ", ".join(parts)
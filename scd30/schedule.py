@@ -0,0 +1,120 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# When to poll the sensor. The SCD30 measures on its own clock, which runs
+# a few percent off ours, so sleeping a fixed MEAS_INTERVAL after variable
+# length I/O makes the poll times drift against the samples: sometimes a
+# poll comes just after a sample was ready (latency), sometimes just before
+# (a wasted poll and a retry).
+#
+# PhaseLock learns when the sensor's samples become ready, from polls on
+# both sides of a data ready transition: the edge lies between the last
+# poll without and the first poll with new data. From those brackets it
+# tracks the phase and the actual period of the sensor (over all brackets
+# since the start) and schedules the next poll margin s after the expected
+# edge, on the monotonic clock, so the time spent on I/O does not add up.
+# Until the brackets span lock cycles, the period is still the nominal one,
+# so the polls come lead (of the interval) before the expected edge: a
+# sensor clock a few percent fast would otherwise be found with data at once
+# sample after sample, its latency growing without a bracket to learn from.
+# A poll that finds data at once only shows that the edge was earlier; the
+# estimate is then moved earlier by probe s, until a miss brackets the edge
+# again; the step doubles once that miss is overdue. That keeps the phase
+# locked when the sensor's clock is faster than ours, at the cost of an
+# extra poll every few samples.
+
+import time
+
+
+class PhaseLock(object):
+
+  def __init__(self, interval, clock=time, margin=0.02, probe=0.005, retry=0.1, lock=5, lead=0.05):
+    self.interval = float(interval)
+    self.clock = clock # anything with monotonic() and sleep()
+    self.margin = margin # s to poll after the expected edge, and after a miss there
+    self.probe = probe
+    self.retry = retry # s between polls until the phase is known
+    self.lock = lock # cycles of brackets needed before polling after the edge
+    self.lead = lead # of the interval to poll before the expected edge until then
+    self.polls = 0
+    self.misses = 0
+    self.samples = 0
+    self.reset()
+
+  def reset(self, start=None):
+    # call when the sensor (re)starts measuring, at monotonic time start
+    self.period = self.interval
+    self.start = self.clock.monotonic() if start is None else start
+    self.edge = None # estimated time the last sample became ready
+    self.anchor = None # first edge measured from a bracket
+    self.baseline = 0 # cycles from the anchor to the last bracket
+    self.last_miss = None # time of the last poll without new data since the last sample
+    self.missed_in_row = 0
+    self.streak = 0 # samples in a row found by the first poll
+
+  def due(self):
+    # monotonic time of the next poll
+    if self.last_miss is not None:
+      # one quick retry when the edge was expected, then back to retry s
+      return self.last_miss + (self.margin if self.edge is not None and self.missed_in_row == 1 else self.retry)
+    if self.edge is None:
+      return self.start + self.interval
+    if self.baseline < self.lock:
+      # the period is not known well enough yet: poll before the edge, so
+      # every sample is bracketed whichever way the sensor's clock is off
+      return self.edge + self.period - self.lead * self.interval
+    return self.edge + self.period + self.margin
+
+  def wait(self):
+    delay = self.due() - self.clock.monotonic()
+    if delay > 0:
+      self.clock.sleep(delay)
+
+  def missed(self, t=None):
+    # the poll at t found no new data
+    self.polls += 1
+    self.misses += 1
+    self.missed_in_row += 1
+    self.last_miss = self.clock.monotonic() if t is None else t
+
+  def ready(self, t=None):
+    # the poll at t found a new sample
+    t = self.clock.monotonic() if t is None else t
+    self.polls += 1
+    self.samples += 1
+    if self.last_miss is not None:
+      edge = (self.last_miss + t) / 2
+      if self.anchor is None:
+        self.anchor = edge
+      else:
+        # the longer the baseline, the smaller the error of the period
+        cycles = round((edge - self.anchor) / self.period)
+        if cycles >= 1 and abs((edge - self.anchor) / cycles - self.interval) < 0.1 * self.interval:
+          self.period = (edge - self.anchor) / cycles
+          self.baseline = cycles
+      self.streak = 0
+    else:
+      # a miss is overdue after margin / probe samples: the sensor is faster
+      probe = self.probe * 2 ** min(max(0, self.streak - self.margin / self.probe), 6)
+      self.streak += 1
+      edge = (t if self.edge is None else min(self.edge + self.period, t)) - probe
+    self.edge = edge
+    self.last_miss = None
+    self.missed_in_row = 0
@@ -0,0 +1,145 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# The latest sample of the service in a small memory-mapped file (on /run,
+# a tmpfs, so it is shared memory), for local readers that would otherwise
+# parse the prometheus text file or open an I2C session of their own.
+#
+# Layout, 64 bytes, little endian:
+#    0  4s  magic b'SCD3'
+#    4  H   version (1)
+#    6  H   measurement interval, s
+#    8  Q   sequence, odd while a sample is written
+#   16  d   time of the sample (unix s)
+#   24  d   CO2, ppm
+#   32  d   temperature, degC
+#   40  d   relative humidity, %
+#   48  I   pressure compensation, mbar
+#   52  I   samples published since the service started
+#   56  I   pid of the service
+#   60  I   crc32 of bytes 16-59
+#
+# Writing is a seqlock: the sequence is made odd, the sample written, the
+# sequence made even again. A reader copies the sample between two reads
+# of the sequence and retries if they differ or are odd, so it never waits
+# for the writer and never sees half a sample. Python has no memory
+# barriers, so the crc also has to match, in case another CPU sees the
+# stores in a different order. The file is replaced (not rewritten) when
+# the service starts, and removed when it stops.
+
+import mmap
+import os
+import struct
+import time
+import zlib
+
+MAGIC = b'SCD3'
+VERSION = 1
+HEADER = struct.Struct('<4sHH') # magic, version, interval
+SEQUENCE = struct.Struct('<Q')
+SAMPLE = struct.Struct('<ddddIII') # time, co2, temperature, humidity, pressure, count, pid
+CRC = struct.Struct('<I')
+SEQUENCE_OFFSET = 8
+SAMPLE_OFFSET = 16
+SIZE = SAMPLE_OFFSET + SAMPLE.size + CRC.size # 64
+
+
+class SamplePublisher(object):
+
+  def __init__(self, path, interval):
+    self.path = path
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+      f.write(HEADER.pack(MAGIC, VERSION, interval) + b'\0' * (SIZE - HEADER.size))
+    os.rename(tmp, path) # readers of an old file see it go stale, not change under them
+    self.file = open(path, 'r+b')
+    self.map = mmap.mmap(self.file.fileno(), SIZE)
+    self.sequence = 0
+    self.count = 0
+    self.pid = os.getpid()
+
+  def set_interval(self, interval):
+    HEADER.pack_into(self.map, 0, MAGIC, VERSION, interval)
+
+  def publish(self, t, values, pressure):
+    # values: (co2, temperature, humidity)
+    self.count += 1
+    sample = SAMPLE.pack(t, values[0], values[1], values[2], pressure, self.count, self.pid)
+    self.sequence += 1
+    SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence)
+    self.map[SAMPLE_OFFSET:SIZE] = sample + CRC.pack(zlib.crc32(sample) & 0xffffffff)
+    self.sequence += 1
+    SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence)
+
+  def close(self):
+    if self.map is None:
+      return
+    self.map.close()
+    self.map = None
+    self.file.close()
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+
+class SampleReader(object):
+  # read() -> (sequence, time, co2, temperature, humidity, pressure, count,
+  # pid) of the latest sample, None if there is none yet. A new sample has
+  # a higher sequence.
+
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      self.map = mmap.mmap(f.fileno(), SIZE, access=mmap.ACCESS_READ)
+    (magic, version, self.interval) = HEADER.unpack_from(self.map)
+    if magic != MAGIC or version != VERSION:
+      self.close()
+      raise ValueError(path + " is not an SCD30 sample file of version " + str(VERSION))
+    self.retries = 0
+
+  def read(self, attempts=1000):
+    m = self.map
+    for _ in range(attempts):
+      (before,) = SEQUENCE.unpack_from(m, SEQUENCE_OFFSET)
+      if before == 0:
+        return None
+      data = m[SAMPLE_OFFSET:SIZE]
+      (after,) = SEQUENCE.unpack_from(m, SEQUENCE_OFFSET)
+      if before == after and not before & 1 and CRC.unpack_from(data, SAMPLE.size)[0] == zlib.crc32(data[:SAMPLE.size]) & 0xffffffff:
+        return (before,) + SAMPLE.unpack_from(data)
+      self.retries += 1
+    raise IOError("no consistent sample after " + str(attempts) + " attempts")
+
+  def close(self):
+    self.map.close()
+
+
+def read_latest(path, max_age=None):
+  # -> (time, co2, temperature, humidity, pressure) of the latest sample at
+  # path, None if there is none or (with max_age, in intervals) it is older
+  try:
+    reader = SampleReader(path)
+  except (IOError, OSError, ValueError):
+    return None
+  try:
+    sample = reader.read()
+    if sample is None or max_age is not None and time.time() - sample[1] > max_age * reader.interval:
+      return None
+    return sample[1:6]
+  finally:
+    reader.close()
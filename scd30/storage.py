@@ -0,0 +1,256 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Persistent sample history for SD cards: samples are collected in RAM and
+# written as one compressed segment every flush_interval seconds, with a
+# single fsync per segment.
+#
+# Files are append-only, one per UTC day (scd30-YYYYMMDD.seg). A segment is
+# a header (see HEADER) followed by a zlib compressed payload:
+#   timestamps   unix ms, delta-of-delta, zigzag varints
+#   values       per column: float32 bits XORed with the previous sample,
+#                byte-planes shuffled so the mostly-zero high bytes compress
+# Headers carry the time range and payload size, so the memory-mapped
+# reader skips segments outside a query without decompressing them. A torn
+# last segment (power loss) fails its crc and is cut off on the next start.
+
+import mmap
+import os
+import struct
+import time
+import zlib
+from array import array
+
+MAGIC = b'SCD3'
+VERSION = 1
+# magic, version, samples, first ms, last ms, payload bytes, payload crc32
+HEADER = struct.Struct('<4sHHqqII')
+MAX_SAMPLES = 0xFFFF # per segment, the header counts them in 16 bits
+COLUMNS = 3
+
+
+def _zigzag_varints(values):
+  out = bytearray()
+  for value in values:
+    value = (value << 1) ^ (value >> 63)
+    while value > 0x7F:
+      out.append((value & 0x7F) | 0x80)
+      value >>= 7
+    out.append(value)
+  return out
+
+
+def _read_varints(data, offset, count):
+  values = []
+  for _ in range(count):
+    shift = 0
+    value = 0
+    while True:
+      byte = data[offset]
+      offset += 1
+      value |= (byte & 0x7F) << shift
+      if not byte & 0x80:
+        break
+      shift += 7
+    values.append((value >> 1) ^ -(value & 1))
+  return (values, offset)
+
+
+def encode_segment(times_ms, columns):
+  # times_ms: ints, columns: COLUMNS arrays of float32 -> header + payload
+  count = len(times_ms)
+  if count > MAX_SAMPLES:
+    raise ValueError(str(count) + " samples do not fit in one segment, at most " + str(MAX_SAMPLES))
+  deltas = [times_ms[0]]
+  previous_delta = 0
+  for i in range(1, count):
+    delta = times_ms[i] - times_ms[i - 1]
+    deltas.append(delta - previous_delta)
+    previous_delta = delta
+  body = _zigzag_varints(deltas)
+  for column in columns:
+    bits = array('I', array('f', column).tobytes())
+    xored = array('I', [bits[0]] + [bits[i] ^ bits[i - 1] for i in range(1, count)])
+    if xored.itemsize != 4:
+      raise ValueError("array('I') is not 32 bit on this platform")
+    raw = xored.tobytes()
+    body += b''.join(raw[k::4] for k in range(4))
+  payload = zlib.compress(bytes(body), 9)
+  header = HEADER.pack(MAGIC, VERSION, count, times_ms[0], times_ms[-1], len(payload), zlib.crc32(payload) & 0xFFFFFFFF)
+  return header + payload
+
+
+def decode_segment(count, payload):
+  # -> (times_ms, [column, ...])
+  body = zlib.decompress(payload)
+  (deltas, offset) = _read_varints(body, 0, count)
+  times = [deltas[0]]
+  delta = 0
+  for i in range(1, count):
+    delta += deltas[i]
+    times.append(times[-1] + delta)
+  columns = []
+  size = 4 * count
+  for _ in range(COLUMNS):
+    planes = body[offset:offset + size]
+    offset += size
+    raw = bytearray(size)
+    for k in range(4):
+      raw[k::4] = planes[k * count:(k + 1) * count]
+    xored = array('I', bytes(raw))
+    for i in range(1, count):
+      xored[i] ^= xored[i - 1]
+    columns.append(array('f', xored.tobytes()))
+  return (times, columns)
+
+
+def _scan(view, size, verify=False):
+  # -> [(offset, samples, first ms, last ms, payload offset, payload bytes, crc), ...]
+  # of all complete segments, from the headers only unless verify is set
+  found = []
+  offset = 0
+  while offset + HEADER.size <= size:
+    (magic, version, count, first, last, length, crc) = HEADER.unpack_from(view, offset)
+    start = offset + HEADER.size
+    if magic != MAGIC or version != VERSION or start + length > size:
+      break
+    if verify and zlib.crc32(view[start:start + length]) & 0xFFFFFFFF != crc:
+      break
+    found.append((offset, count, first, last, start, length, crc))
+    offset = start + length
+  return found
+
+
+def _mapped(path, function):
+  with open(path, 'rb') as f:
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+      return function(b'', 0)
+    view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      return function(view, size)
+    finally:
+      view.close()
+
+
+def segments(path, verify=False):
+  return _mapped(path, lambda view, size: _scan(view, size, verify))
+
+
+def read_file(path, start_ms=None, end_ms=None):
+  # -> [(times_ms, columns), ...] of the segments overlapping [start_ms, end_ms)
+
+  def decode(view, size):
+    decoded = []
+    for (offset, count, first, last, payload, length, crc) in _scan(view, size):
+      if (start_ms is not None and last < start_ms) or (end_ms is not None and first >= end_ms):
+        continue
+      data = view[payload:payload + length]
+      if zlib.crc32(data) & 0xFFFFFFFF != crc:
+        break
+      decoded.append(decode_segment(count, data))
+    return decoded
+
+  return _mapped(path, decode)
+
+
+def read(directory, start=None, end=None):
+  # yields (unix time, co2, T, rH) of all stored samples with start <= t < end
+  start_ms = None if start is None else int(start * 1000)
+  end_ms = None if end is None else int(end * 1000)
+  for name in sorted(os.listdir(directory)):
+    if not (name.startswith('scd30-') and name.endswith('.seg')):
+      continue
+    for (times, columns) in read_file(os.path.join(directory, name), start_ms, end_ms):
+      for i in range(len(times)):
+        t = times[i]
+        if (start_ms is None or t >= start_ms) and (end_ms is None or t < end_ms):
+          yield (t / 1000.0, columns[0][i], columns[1][i], columns[2][i])
+
+
+class SegmentWriter(object):
+
+  def __init__(self, directory, flush_interval=900, keep_days=0, clock=time):
+    if not flush_interval > 0:
+      raise ValueError("the flush interval has to be > 0 s")
+    self.directory = directory
+    self.flush_interval = flush_interval
+    self.keep_days = keep_days # delete files older than that, 0: keep all
+    self.clock = clock
+    self.times = []
+    self.columns = [array('f') for _ in range(COLUMNS)]
+    self.bytes_written = 0
+    self.samples_written = 0
+    self.segments_written = 0
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.repair()
+
+  def path(self, t):
+    return os.path.join(self.directory, time.strftime('scd30-%Y%m%d.seg', time.gmtime(t)))
+
+  def repair(self):
+    # cut a torn segment off the end of today's file
+    path = self.path(self.clock.time())
+    if not os.path.isfile(path):
+      return
+    found = segments(path, verify=True)
+    end = found[-1][4] + found[-1][5] if found else 0
+    if end != os.path.getsize(path):
+      with open(path, 'r+b') as f:
+        f.truncate(end)
+
+  def append(self, t, values):
+    # t: unix time
+    if self.times and int(t // 86400) != int(self.times[0] // 86400000):
+      self.flush() # new day, new file
+    self.times.append(int(t * 1000))
+    for column, value in zip(self.columns, values):
+      column.append(value)
+    if t - self.times[0] / 1000.0 >= self.flush_interval or len(self.times) == MAX_SAMPLES:
+      self.flush()
+
+  def flush(self):
+    if not self.times:
+      return
+    segment = encode_segment(self.times, self.columns)
+    path = self.path(self.times[0] / 1000.0)
+    with open(path, 'ab') as f:
+      f.write(segment)
+      f.flush()
+      os.fsync(f.fileno())
+    self.bytes_written += len(segment)
+    self.samples_written += len(self.times)
+    self.segments_written += 1
+    self.times = []
+    self.columns = [array('f') for _ in range(COLUMNS)]
+    self.prune()
+
+  def prune(self):
+    if not self.keep_days:
+      return
+    oldest = self.path(self.clock.time() - self.keep_days * 86400)
+    for name in os.listdir(self.directory):
+      path = os.path.join(self.directory, name)
+      if name.startswith('scd30-') and name.endswith('.seg') and path < oldest:
+        os.remove(path)
+
+  def close(self):
+    self.flush()
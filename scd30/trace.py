@@ -0,0 +1,300 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# Recording of the I2C calls of the service, and their replay.
+#
+# TraceRecorder wraps a transport (see scd30.transport) and writes every
+# call to a binary trace: what was written or asked for, what came back
+# or the error raised, when the call started and how long it took. The
+# other inputs of the service that decide what it does next, the cached
+# sensor configuration and the pressure readings, are recorded as well
+# (whenever they change). A trace takes 60-120 B per sample, some 3 MB a
+# day at 2 s; the file is flushed after each record, so it survives a
+# crash of the service.
+#
+# ReplayTransport plays a trace back through the unchanged service: each
+# call returns what the recorded one returned or raises what it raised. As
+# fast as possible, its clock (a VirtualClock) jumps to the recorded time
+# of each call and sleeps return at once; in realtime, the calls wait
+# until their recorded time. Once the service does something else than
+# the recorded call (e.g. run with other options), or the trace is used
+# up, every call raises TraceEnd and ended is set.
+#
+# Format: HEADER, then one RECORD per call followed by its request and
+# response bytes. scd30-bench.py trace records the service against the
+# emulator and replays it.
+
+import struct
+import time
+
+from scd30.emulator import VirtualClock
+from scd30.transport import Transport
+
+MAGIC = b'SCD30TR1'
+HEADER = struct.Struct('<8sd') # magic, wall clock time of the start
+RECORD = struct.Struct('<BBdfHH') # kind, flags, s since the start, s the call took, request and response length
+WRITE = ord('W') # request: the bytes written
+READ = ord('R') # request: n (<H), response: count (<h) and the bytes read
+TRANSFER = ord('T') # request: encode_ops(ops), response: the bytes of all reads
+REOPEN = ord('O')
+RECONNECT = ord('C')
+READY = ord('Y') # wait on the RDY pin, request: timeout (<f), response: 1 or 0
+PRESSURE = ord('P') # input: pressure reading in hPa as text, empty for none
+CONFIG = ord('K') # input: cached configuration as json
+INPUTS = (PRESSURE, CONFIG)
+NAMES = {WRITE: 'write', READ: 'read', TRANSFER: 'transfer', REOPEN: 'reopen', RECONNECT: 'reconnect',
+         READY: 'ready', PRESSURE: 'pressure', CONFIG: 'config'}
+FAILED = 1 # flag: the call raised, the response is the message
+
+
+def encode_ops(ops):
+  # transfer ops (see scd30.transport.Transport) -> bytes
+  out = bytearray()
+  for (op, arg) in ops:
+    if op == 'w':
+      out += b'w' + bytearray([len(arg)]) + bytearray(arg)
+    elif op == 'r':
+      out += b'r' + bytearray([arg])
+    else:
+      out += b'd' + struct.pack('<f', arg)
+  return bytes(out)
+
+
+def read_sizes(request):
+  # encode_ops() bytes -> sizes of the reads
+  request = bytearray(request)
+  sizes = []
+  i = 0
+  while i < len(request):
+    op = request[i]
+    if op == ord('w'):
+      i += 2 + request[i + 1]
+    elif op == ord('r'):
+      sizes.append(request[i + 1])
+      i += 2
+    else:
+      i += 5
+  return sizes
+
+
+def read_trace(path):
+  # -> (wall clock time of the start, [(kind, flags, t, duration, request, response), ...])
+  with open(path, 'rb') as f:
+    data = f.read()
+  if len(data) < HEADER.size or HEADER.unpack_from(data)[0] != MAGIC:
+    raise ValueError(path + " is not an SCD30 trace")
+  start = HEADER.unpack_from(data)[1]
+  records = []
+  offset = HEADER.size
+  while offset + RECORD.size <= len(data):
+    (kind, flags, t, duration, request_length, response_length) = RECORD.unpack_from(data, offset)
+    offset += RECORD.size
+    if offset + request_length + response_length > len(data):
+      break # cut off by a crash
+    request = data[offset:offset + request_length]
+    offset += request_length
+    response = data[offset:offset + response_length]
+    offset += response_length
+    records.append((kind, flags, t, duration, request, response))
+  return (start, records)
+
+
+def describe(kind, request):
+  return NAMES.get(kind, chr(kind)) + ' ' + ' '.join('{0:02x}'.format(b) for b in bytearray(request))
+
+
+class TraceRecorder(object):
+
+  def __init__(self, bus, path, clock=time):
+    self.bus = bus
+    self.clock = clock
+    self.file = open(path, 'wb')
+    self.file.write(HEADER.pack(MAGIC, clock.time()))
+    self.start = clock.monotonic()
+    self.inputs = {} # kind -> last value recorded
+    self.records = 0
+
+  def record(self, kind, start, request, response, flags=0):
+    self.file.write(RECORD.pack(kind, flags, start - self.start, self.clock.monotonic() - start,
+                                len(request), len(response)) + request + response)
+    self.file.flush()
+    self.records += 1
+
+  def call(self, kind, request, encode, function, *args):
+    start = self.clock.monotonic()
+    try:
+      result = function(*args)
+    except Exception as e:
+      self.record(kind, start, request, str(e).encode('utf-8'), FAILED)
+      raise
+    self.record(kind, start, request, encode(result))
+    return result
+
+  def input(self, kind, value):
+    # value (bytes) the service got from elsewhere than the sensor
+    if self.inputs.get(kind) != value:
+      self.inputs[kind] = value
+      self.record(kind, self.clock.monotonic(), b'', value)
+
+  def write_device(self, data):
+    return self.call(WRITE, bytes(bytearray(data)), lambda result: b'', self.bus.write_device, data)
+
+  def read_device(self, n):
+    return self.call(READ, struct.pack('<H', n),
+                     lambda result: struct.pack('<h', result[0]) + bytes(bytearray(result[1])), self.bus.read_device, n)
+
+  def transfer(self, ops):
+    return self.call(TRANSFER, encode_ops(ops), lambda results: b''.join(bytes(r) for r in results),
+                     self.bus.transfer, ops)
+
+  def reopen(self):
+    return self.call(REOPEN, b'', lambda result: b'', self.bus.reopen)
+
+  def reconnect(self):
+    return self.call(RECONNECT, b'', lambda result: b'', self.bus.reconnect)
+
+  def ready_pin(self, gpio):
+    return RecordedReadyPin(self, self.bus.ready_pin(gpio))
+
+  def close(self):
+    try:
+      self.bus.close()
+    finally:
+      self.file.close()
+
+  def __getattr__(self, name):
+    return getattr(self.bus, name)
+
+
+class RecordedReadyPin(object):
+
+  def __init__(self, recorder, pin):
+    self.recorder = recorder
+    self.pin = pin
+
+  def wait(self, timeout):
+    return self.recorder.call(READY, struct.pack('<f', timeout), lambda ready: b'\x01' if ready else b'\x00',
+                              self.pin.wait, timeout)
+
+  def clear(self):
+    self.pin.clear()
+
+  def close(self):
+    self.pin.close()
+
+
+class TraceEnd(IOError):
+  pass
+
+
+class ReplayTransport(Transport):
+
+  def __init__(self, path, realtime=False):
+    (start, self.records) = read_trace(path)
+    self.realtime = realtime
+    self.clock = time if realtime else VirtualClock(start)
+    self.start = self.clock.monotonic() # monotonic time of the start of the trace
+    self.position = 0
+    self.inputs = {}
+    self.ended = False
+    self.error = None # why the replay ended before the trace did
+
+  def take_inputs(self):
+    while self.position < len(self.records) and self.records[self.position][0] in INPUTS:
+      record = self.records[self.position]
+      self.inputs[record[0]] = record[5]
+      self.position += 1
+
+  def input(self, kind):
+    # -> the value of the input (bytes) as recorded at this point, None if there was none
+    self.take_inputs()
+    return self.inputs.get(kind)
+
+  def next(self, kind, request):
+    # -> response to the call, raises what the recorded one raised
+    self.take_inputs()
+    if not self.ended and self.position < len(self.records):
+      (recorded_kind, flags, t, duration, recorded_request, response) = self.records[self.position]
+      if recorded_kind != kind or recorded_request != request:
+        self.error = ("call " + str(self.position) + ": " + describe(kind, request) + " instead of the recorded " +
+                      describe(recorded_kind, recorded_request))
+        self.ended = True
+    else:
+      self.ended = True
+    if self.ended:
+      raise TraceEnd(self.error or "end of trace")
+    self.position += 1
+    delay = self.start + t + duration - self.clock.monotonic()
+    if delay > 0:
+      self.clock.sleep(delay)
+    if flags & FAILED:
+      raise IOError(response.decode('utf-8', 'replace'))
+    return response
+
+  def write_device(self, data):
+    self.next(WRITE, bytes(bytearray(data)))
+
+  def read_device(self, n):
+    response = self.next(READ, struct.pack('<H', n))
+    return (struct.unpack('<h', response[:2])[0], bytearray(response[2:]))
+
+  def transfer(self, ops):
+    request = encode_ops(ops)
+    response = self.next(TRANSFER, request)
+    results = []
+    offset = 0
+    for size in read_sizes(request):
+      results.append(bytearray(response[offset:offset + size]))
+      offset += size
+    return results
+
+  def reopen(self):
+    self.next(REOPEN, b'')
+
+  def reconnect(self):
+    self.next(RECONNECT, b'')
+
+  def ready_pin(self, gpio):
+    return ReplayReadyPin(self)
+
+  def summary(self):
+    return ("replayed " + str(self.position) + " of " + str(len(self.records)) + " records" +
+            (", " + self.error if self.error else ""))
+
+  def close(self):
+    pass
+
+
+class ReplayReadyPin(object):
+
+  def __init__(self, replay):
+    self.replay = replay
+
+  def wait(self, timeout):
+    try:
+      return self.replay.next(READY, struct.pack('<f', timeout)) == b'\x01'
+    except TraceEnd:
+      return False # like a timeout, a real pin does not raise
+
+  def clear(self):
+    pass
+
+  def close(self):
+    pass
@@ -0,0 +1,191 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# I2C transports used by the scd30-*.py scripts.
+#
+# Every transport offers the two calls the scripts need, with the same
+# semantics as the pigpio calls they replace:
+#   write_device(data)  -> raises on failure (e.g. NACK)
+#   read_device(n)      -> (count, data), raises on failure
+# plus close(). Select one with open_transport().
+#
+# transfer(ops) runs a whole sequence of writes, reads and delays and
+# returns the data of all reads at once, one call per write and read. The
+# SCD30 needs a delay between every command and its read (scd30.driver),
+# which neither i2c_zip nor a pigpio script (its I2C reads return no data)
+# can hold, so combining them would not save a round trip.
+#
+# reopen() opens the I2C handle again, reconnect() also the connection
+# behind it (e.g. to pigpiod), for recovery from faults (scd30.recovery).
+#
+# Transports that can watch the SCD30 RDY pin also offer ready_pin(gpio),
+# returning an object with wait(timeout) -> True once new data is ready
+# (False on timeout), clear() to forget an edge that came meanwhile, and
+# close().
+
+from __future__ import print_function
+
+import errno
+import sys
+import threading
+import time
+
+TRANSPORTS = ('pigpio', 'i2cdev', 'emulator')
+
+
+class Transport(object):
+  # ops are tuples: ('w', data) write, ('r', n) read n bytes, ('d', s) wait s seconds
+
+  clock = time
+
+  def transfer(self, ops):
+    return transfer_each(self, ops, self.clock)
+
+  def reopen(self):
+    pass
+
+  def reconnect(self):
+    self.reopen()
+
+
+def transfer_each(bus, ops, clock=time):
+  # runs ops with one write_device()/read_device() call each
+  results = []
+  for op, arg in ops:
+    if op == 'w':
+      bus.write_device(arg)
+    elif op == 'r':
+      (count, data) = bus.read_device(arg)
+      if count != arg:
+        raise IOError(errno.EIO, "read " + str(count) + " B instead of " + str(arg) + " B")
+      results.append(data)
+    else:
+      clock.sleep(arg)
+  return results
+
+
+class PigpioTransport(Transport):
+  # talks to the SCD30 through a pigpio daemon (local or remote); pass pi
+  # to share one pigpiod connection between several sensors. Handles are
+  # pigpiod-wide, so only the owner of stale_handle may ask to close it
+  # first (scd30-service.py, for the one a crashed instance left open).
+
+  def __init__(self, host='127.0.0.1', bus=1, slave=0x61, pi=None, stale_handle=None):
+    self.host = host
+    self.bus = bus
+    self.slave = slave
+    self.own_pi = pi is None
+    if self.own_pi:
+      import pigpio # aptitude install python3-pigpio
+      pi = pigpio.pi(host)
+      if not pi.connected:
+        raise IOError("no connection to pigpio daemon at " + host + ".")
+    self.pi = pi
+
+    if stale_handle is not None:
+      try:
+        self.pi.i2c_close(stale_handle)
+      except Exception as e:
+        if str(e) != "'unknown handle'":
+          print("Unknown error: ", type(e), ":", e, file=sys.stderr)
+
+    self.handle = self.pi.i2c_open(bus, slave)
+
+  def write_device(self, data):
+    self.pi.i2c_write_device(self.handle, data)
+
+  def read_device(self, n):
+    return self.pi.i2c_read_device(self.handle, n)
+
+  def ready_pin(self, gpio):
+    return PigpioReadyPin(self.pi, gpio)
+
+  def reopen(self):
+    try:
+      self.pi.i2c_close(self.handle)
+    except Exception:
+      pass # e.g. pigpiod restarted meanwhile
+    self.handle = self.pi.i2c_open(self.bus, self.slave)
+
+  def reconnect(self):
+    if not self.own_pi:
+      return self.reopen() # the shared connection is not ours to replace
+    import pigpio
+    try:
+      self.pi.i2c_close(self.handle)
+    except Exception:
+      pass
+    self.pi.stop()
+    self.pi = pigpio.pi(self.host)
+    if not self.pi.connected:
+      raise IOError("no connection to pigpio daemon at " + self.host + ".")
+    self.handle = self.pi.i2c_open(self.bus, self.slave)
+
+  def attach(self, pi):
+    # carries on over pi, a new shared connection replacing a dead one (the
+    # handle died with the old one, closing it could hit another's)
+    self.pi = pi
+    self.handle = None # until the open succeeds
+    self.handle = self.pi.i2c_open(self.bus, self.slave)
+
+  def close(self):
+    self.pi.i2c_close(self.handle)
+    self.own_pi and self.pi.stop()
+
+
+class PigpioReadyPin(object):
+  # RDY goes high when a measurement is ready and low once it has been read;
+  # pigpiod notifies us of the rising edge, so no data ready polling needed
+
+  def __init__(self, pi, gpio):
+    import pigpio
+    self.event = threading.Event()
+    pi.set_mode(gpio, pigpio.INPUT)
+    self.callback = pi.callback(gpio, pigpio.RISING_EDGE, self._edge)
+
+  def _edge(self, gpio, level, tick):
+    self.event.set()
+
+  def wait(self, timeout):
+    if self.event.wait(timeout):
+      self.event.clear()
+      return True
+    return False
+
+  def clear(self):
+    # forget an edge, for a sample that was read without waiting for it
+    self.event.clear()
+
+  def close(self):
+    self.callback.cancel()
+
+
+def open_transport(kind='pigpio', host='127.0.0.1', bus=1, slave=0x61, **kwargs):
+  # kwargs are passed on to the emulator (see scd30.emulator.SCD30Emulator),
+  # or pi (a shared pigpio connection) and stale_handle to PigpioTransport
+  if kind == 'pigpio':
+    return PigpioTransport(host, bus, slave, **kwargs)
+  if kind == 'i2cdev':
+    from scd30.i2cdev import I2CDevTransport
+    return I2CDevTransport(bus, slave)
+  if kind == 'emulator':
+    from scd30.emulator import EmulatorTransport
+    return EmulatorTransport(**kwargs)
+  raise ValueError("unknown transport " + repr(kind) + ", use one of " + ", ".join(TRANSPORTS))
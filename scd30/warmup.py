@@ -0,0 +1,170 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# If you want to relicense this code under another license, please contact info+github@unraveltec.com.
+
+# When the readings are stable enough for a forced recalibration (FRC).
+# FRC takes the current reading as the reference value, so a reading that
+# is still settling (after the measurement was started, or the sensor
+# carried to fresh air) ends up as a calibration error.
+#
+# Warmup keeps running sums over the last window samples, and over the
+# newest short of them - count, sum and sum of squares of CO2 and
+# temperature, and their products with time - for mean, standard deviation
+# and least squares slope with its standard error in O(1) per sample. The
+# readings are stable once, over the samples judged,
+#   CO2 standard deviation     <= max_co2_sd (ppm)
+#   |CO2 slope|                <= max_co2_slope (ppm/min)
+#   |temperature slope|        <= max_temperature_slope (degC/min)
+# The slope needs many samples to mean anything: with 3 ppm of noise, it
+# is off by some 3.5 ppm/min over 20 samples at 2 s, 0.7 ppm/min over 60.
+# So the full window is judged, unless the readings have levelled off:
+# the CO2 slope of the samples before the newest short is steeper than
+# theirs by more than levelling standard errors (of the difference). Then
+# only the newest short samples are judged, as a sensor that was just
+# started does not have to wait until a full window holds no settling. A
+# steady rise (a room filling) does not level off, so it still has to pass
+# over the full window. A restart of the measurement starts over
+# (reset()). Times are taken relative to the oldest sample in the window,
+# recomputed every window samples, so the sums stay small.
+
+import math
+from collections import deque
+
+SERIES = ('co2', 'temperature')
+BEFORE = 10 # samples before the newest short ones needed to tell that the readings levelled off
+
+
+def fit(sums, i):
+  # running sums, series i -> (mean, standard deviation, slope per minute,
+  # its standard error), nan where there are too few samples
+  (n, t, tt) = sums[:3]
+  (x, xx, tx) = sums[3 + 3 * i:6 + 3 * i]
+  if n < 3:
+    return (x / n if n else float('nan'), float('nan'), float('nan'), float('nan'))
+  stt = tt - t * t / n
+  sxx = xx - x * x / n
+  stx = tx - t * x / n
+  if stt <= 0:
+    return (x / n, math.sqrt(max(0.0, sxx) / (n - 1)), float('nan'), float('nan'))
+  slope = stx / stt
+  return (x / n, math.sqrt(max(0.0, sxx) / (n - 1)), 60 * slope,
+          60 * math.sqrt(max(0.0, sxx - slope * stx) / (n - 2) / stt))
+
+
+class Warmup(object):
+
+  def __init__(self, window=60, max_co2_sd=10.0, max_co2_slope=2.0, max_temperature_slope=0.1, short=20,
+               levelling=3.0):
+    self.window = window
+    self.max_co2_sd = max_co2_sd
+    self.max_co2_slope = max_co2_slope
+    self.max_temperature_slope = max_temperature_slope
+    self.short = short
+    self.levelling = levelling
+    self.reset()
+
+  def reset(self):
+    self.samples = deque() # (t, co2, temperature)
+    self.origin = None
+    self.added = 0
+    self.sums = [0.0] * (3 + 3 * len(SERIES)) # n, t, t*t, then x, x*x, t*x per series
+    self.recent = [0.0] * len(self.sums) # the same over the newest short samples
+
+  def _account(self, sums, sample, sign):
+    t = sample[0] - self.origin
+    sums[0] += sign
+    sums[1] += sign * t
+    sums[2] += sign * t * t
+    for i, x in enumerate(sample[1:]):
+      sums[3 + 3 * i] += sign * x
+      sums[4 + 3 * i] += sign * x * x
+      sums[5 + 3 * i] += sign * t * x
+
+  def add(self, t, co2, temperature):
+    # t: monotonic s
+    if self.origin is None:
+      self.origin = t
+    sample = (t, co2, temperature)
+    self.samples.append(sample)
+    self._account(self.sums, sample, 1)
+    self._account(self.recent, sample, 1)
+    if len(self.samples) > self.short:
+      self._account(self.recent, self.samples[-self.short - 1], -1)
+    if len(self.samples) > self.window:
+      self._account(self.sums, self.samples.popleft(), -1)
+    self.added += 1
+    if self.added % self.window == 0:
+      self._rebase()
+
+  def _rebase(self):
+    samples = self.samples
+    self.reset()
+    self.origin = samples[0][0]
+    self.samples = samples
+    for i, sample in enumerate(samples):
+      self._account(self.sums, sample, 1)
+      if i >= len(samples) - self.short:
+        self._account(self.recent, sample, 1)
+    self.added = len(samples)
+
+  def full(self):
+    return len(self.samples) >= self.window
+
+  def levelled(self):
+    # -> True if the readings before the newest short samples were rising
+    # or falling faster than those are
+    if len(self.samples) < self.short + BEFORE:
+      return False
+    before = [a - b for (a, b) in zip(self.sums, self.recent)]
+    (_, _, slope_before, error_before) = fit(before, 0)
+    (_, _, slope, error) = fit(self.recent, 0)
+    return abs(slope_before) - abs(slope) > self.levelling * math.hypot(error_before, error)
+
+  def judged(self):
+    # -> the running sums of the samples stable() judges
+    return self.recent if self.levelled() else self.sums
+
+  def mean(self, i):
+    return fit(self.judged(), i)[0]
+
+  def sd(self, i):
+    return fit(self.judged(), i)[1]
+
+  def slope(self, i):
+    # per minute
+    return fit(self.judged(), i)[2]
+
+  def residuals(self):
+    sums = self.judged()
+    (_, co2_sd, co2_slope, co2_slope_error) = fit(sums, 0)
+    (_, temperature_sd, temperature_slope, _) = fit(sums, 1)
+    return {
+      'samples': int(sums[0]),
+      'co2_sd': co2_sd, 'co2_slope': co2_slope, 'co2_slope_error': co2_slope_error,
+      'temperature_sd': temperature_sd, 'temperature_slope': temperature_slope,
+    }
+
+  def stable(self):
+    sums = self.judged()
+    if sums is self.sums and not self.full():
+      return False
+    (_, co2_sd, co2_slope, _) = fit(sums, 0)
+    (_, _, temperature_slope, _) = fit(sums, 1)
+    return (co2_sd <= self.max_co2_sd and abs(co2_slope) <= self.max_co2_slope and
+            abs(temperature_slope) <= self.max_temperature_slope)